@@ -1,26 +1,35 @@
-from gevent import monkey
-monkey.patch_all()
+# Only patch and load the web app when we're actually running the server. Image processing
+# workers are started with spawn, which re-imports this module as __mp_main__ in every worker,
+# and they have no business monkey-patching the world or loading every HTTP module.
+if __name__ == '__main__':
+    from gevent import monkey
+    monkey.patch_all()
 
-import argparse  # noqa
 import logging  # noqa
-from flask.logging import default_handler  # noqa
-from werkzeug.middleware.proxy_fix import ProxyFix  # noqa
 
-from critterchat.http import app, config, socketio  # noqa
+from critterchat.config import Config  # noqa
+
+if __name__ == '__main__':
+    import argparse  # noqa
+    from flask.logging import default_handler  # noqa
+    from werkzeug.middleware.proxy_fix import ProxyFix  # noqa
+
+    from critterchat.http import app, config, socketio  # noqa
+    from critterchat.http.app import frontend_manifest  # noqa
 
-from critterchat.config import Config, load_config  # noqa
-from critterchat.data import Data  # noqa
-from critterchat.service import AttachmentService, MessageService, UserService  # noqa
+    from critterchat.config import load_config  # noqa
+    from critterchat.data import Data  # noqa
+    from critterchat.service import AttachmentService, MessageService, UserService  # noqa
 
-# Since the sockets and REST files use decorators for hooking, simply importing these hooks the desired functions
-import critterchat.http.welcome  # noqa
-import critterchat.http.chat  # noqa
-import critterchat.http.account  # noqa
-import critterchat.http.upload  # noqa
-import critterchat.http.socket  # noqa
+    # Since the sockets and REST files use decorators for hooking, simply importing these hooks the desired functions
+    import critterchat.http.welcome  # noqa
+    import critterchat.http.chat  # noqa
+    import critterchat.http.account  # noqa
+    import critterchat.http.upload  # noqa
+    import critterchat.http.socket  # noqa
 
-# This is only hooked when local storage is enabled.
-from critterchat.http.attachments import attachments  # noqa
+    # This is only hooked when local storage is enabled.
+    from critterchat.http.attachments import attachments  # noqa
 
 
 logger = logging.getLogger(__name__)
@@ -46,9 +55,27 @@ def perform_initialization_work(config: Config) -> None:
     logger.info("Migrating any per-room legacy names to current rules.")
     messageservice.migrate_legacy_names()
 
+    # Load the frontend manifest up front, so the first page render doesn't have to.
+    logger.info("Loading frontend asset manifest.")
+    try:
+        frontend_manifest.get()
+    except OSError:
+        logger.warning("Could not load frontend asset manifest, has the frontend been built?")
+
     logger.info("Done with initialization.")
 
 
+def perform_shutdown_work(config: Config) -> None:
+    # Last seen markers are written out in batches, so save whatever is still waiting.
+    data = Data(config)
+    try:
+        userservice = UserService(config, data)
+        logger.info("Writing out any buffered last seen markers.")
+        userservice.flush_last_seen()
+    finally:
+        data.close()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run the chat application backend.")
     parser.add_argument("-p", "--port", help="Port to listen on. Defaults to 5678", type=int, default=5678)
@@ -81,4 +108,7 @@ if __name__ == '__main__':
         logger.info(f"Fixing proxy headers with a depth of {args.nginx_proxy}")
         app.wsgi_app = ProxyFix(app.wsgi_app, x_host=args.nginx_proxy, x_proto=args.nginx_proxy, x_for=args.nginx_proxy, x_prefix=args.nginx_proxy)  # type: ignore
     logger.info(f"Running server listening on port {args.port}")
-    socketio.run(app, host='0.0.0.0', port=args.port, debug=args.debug)
+    try:
+        socketio.run(app, host='0.0.0.0', port=args.port, debug=args.debug)
+    finally:
+        perform_shutdown_work(config)
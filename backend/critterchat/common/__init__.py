@@ -2,13 +2,35 @@ from .aes import AESCipher
 from .text import convert_spaces, represents_real_text
 from .time import Time
 from .emoji import get_emoji_unicode_dict, get_aliases_unicode_dict
+from .lru import LRUCache
+from .imaging import (
+    ImageJobResult,
+    ImageJobException,
+    VariantResult,
+    image_queue_depth,
+    make_variants,
+    prepare_image,
+    run_image_job,
+    run_variant_job,
+    run_variant_jobs,
+)
 
 
 __all__ = [
     "AESCipher",
+    "ImageJobResult",
+    "ImageJobException",
+    "LRUCache",
     "Time",
     "get_emoji_unicode_dict",
     "get_aliases_unicode_dict",
     "convert_spaces",
     "represents_real_text",
+    "VariantResult",
+    "image_queue_depth",
+    "make_variants",
+    "prepare_image",
+    "run_image_job",
+    "run_variant_job",
+    "run_variant_jobs",
 ]
@@ -0,0 +1,333 @@
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, TimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageFile, ImageOps, features
+from threading import Lock
+from typing import Any, Callable, Dict, Final, FrozenSet, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+from ..config import Config
+
+
+__all__ = [
+    "ImageJobResult",
+    "ImageJobException",
+    "VariantResult",
+    "image_queue_depth",
+    "make_variants",
+    "prepare_image",
+    "run_image_job",
+    "run_variant_job",
+    "run_variant_jobs",
+]
+
+
+# The outcome of processing an image. The first element is None on success, or a short string
+# saying what went wrong. Errors are passed back as values rather than raised so that nothing
+# needs to be pickled back across the process boundary except plain data. When the image was
+# handed over as a path to a file and didn't need converting, the data is left empty since the
+# file itself can be used as-is.
+ImageJobResult = Tuple[Optional[str], bytes, int, int, str]
+
+ERROR_UNSUPPORTED: Final[str] = "unsupported"
+ERROR_UNRECOGNIZED: Final[str] = "unrecognized"
+ERROR_SIZE: Final[str] = "size"
+
+# A single resized variant of an image, as the bounding size it was generated for, the encoded
+# data, its actual width and height and its content type.
+VariantResult = Tuple[int, bytes, int, int, str]
+
+T = TypeVar("T")
+K = TypeVar("K")
+
+
+class ImageJobException(Exception):
+    pass
+
+
+logger = logging.getLogger(__name__)
+
+_pool_lock: Lock = Lock()
+_pool: Optional[ProcessPoolExecutor] = None
+_queue_depth: int = 0
+
+
+def _open_image(source: Union[bytes, str]) -> ImageFile.ImageFile:
+    # Images can be handed over as a path to a file so that large uploads don't have to be read
+    # into memory and copied across the process boundary.
+    if isinstance(source, str):
+        return Image.open(source)
+    return Image.open(io.BytesIO(source))
+
+
+def prepare_image(
+    source: Union[bytes, str],
+    max_width: Optional[int],
+    max_height: Optional[int],
+    supported: FrozenSet[str],
+    convertible: FrozenSet[str],
+) -> ImageJobResult:
+    """
+    Decode an image, verify its dimensions and convert it to PNG if it's in a format we can't
+    serve directly. This is CPU heavy, so it's run in a worker process by run_image_job.
+    """
+    try:
+        img = _open_image(source)
+    except Exception:
+        return (ERROR_UNSUPPORTED, b"", 0, 0, "")
+
+    data = source if isinstance(source, bytes) else b""
+
+    transposed = ImageOps.exif_transpose(img)
+    width, height = transposed.size
+    if max_width is not None and width > max_width:
+        return (ERROR_SIZE, b"", width, height, "")
+    if max_height is not None and height > max_height:
+        return (ERROR_SIZE, b"", width, height, "")
+
+    content_type = img.get_format_mimetype()
+    if not content_type:
+        return (ERROR_UNRECOGNIZED, b"", width, height, "")
+    content_type = content_type.lower()
+
+    if content_type in convertible:
+        # We want to convert this to a PNG file so that we can support uploading it.
+        converted = transposed.convert("RGB")
+        converted_array = io.BytesIO()
+        converted.save(converted_array, format='PNG')
+        data = converted_array.getvalue()
+
+        # We've updated the content type to a PNG now, so reflect that.
+        content_type = "image/png"
+
+    if content_type not in supported:
+        return (ERROR_UNRECOGNIZED, b"", width, height, content_type)
+
+    return (None, data, width, height, content_type)
+
+
+def make_variants(source: Union[bytes, str], sizes: Tuple[int, ...]) -> List[VariantResult]:
+    """
+    Generate downscaled copies of an image that fit within each of the given bounding sizes,
+    for clients to use as previews instead of the original. Sizes that the image already fits
+    in are skipped, as are animated images since a still preview would lose the animation.
+    This is CPU heavy, so it's run in a worker process by run_variant_job.
+    """
+    try:
+        img = _open_image(source)
+    except Exception:
+        return []
+
+    original_size = os.path.getsize(source) if isinstance(source, str) else len(source)
+
+    if getattr(img, "is_animated", False):
+        return []
+
+    transposed = ImageOps.exif_transpose(img)
+    has_alpha = transposed.mode in {"RGBA", "LA", "PA"} or (transposed.mode == "P" and "transparency" in transposed.info)
+    base = transposed.convert("RGBA" if has_alpha else "RGB")
+
+    # WebP is much smaller for the same quality, but Pillow can be built without it.
+    if features.check("webp"):
+        fmt, content_type = "WEBP", "image/webp"
+    elif has_alpha:
+        fmt, content_type = "PNG", "image/png"
+    else:
+        fmt, content_type = "JPEG", "image/jpeg"
+
+    variants: List[VariantResult] = []
+    for size in sorted(sizes):
+        if base.width <= size and base.height <= size:
+            continue
+
+        resized = base.copy()
+        resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+        resized_array = io.BytesIO()
+        if fmt == "PNG":
+            resized.save(resized_array, format=fmt, optimize=True)
+        else:
+            resized.save(resized_array, format=fmt, quality=80)
+        resized_data = resized_array.getvalue()
+
+        if len(resized_data) >= original_size:
+            # No point in serving a "smaller" version that is bigger than the original.
+            continue
+
+        variants.append((size, resized_data, resized.width, resized.height, content_type))
+
+    return variants
+
+
+def _get_pool(config: Config) -> ProcessPoolExecutor:
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            # Use spawn instead of fork so that workers don't inherit the gevent hub or any
+            # open DB connections from the server process.
+            _pool = ProcessPoolExecutor(
+                max_workers=config.attachments.processing_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    # A worker died, probably from running out of memory on a huge image, which takes the
+    # whole pool down with it. Throw it away so a fresh pool is started for the next job.
+    global _pool
+
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+
+
+def _job_finished(future: "Future[Any]") -> None:
+    global _queue_depth
+
+    with _pool_lock:
+        _queue_depth -= 1
+
+
+def image_queue_depth() -> int:
+    """
+    Return the number of image jobs that have been submitted to the worker pool and haven't
+    finished yet, including ones that are currently running.
+    """
+    return _queue_depth
+
+
+def _run_job(config: Config, func: Callable[..., T], *args: object) -> T:
+    global _queue_depth
+
+    if config.attachments.processing_workers <= 0:
+        return func(*args)
+
+    pool = _get_pool(config)
+    try:
+        future = pool.submit(func, *args)
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise ImageJobException("Image processing workers are restarting, try again!")
+
+    with _pool_lock:
+        _queue_depth += 1
+        depth = _queue_depth
+    future.add_done_callback(_job_finished)
+
+    if depth > config.attachments.processing_workers:
+        logger.info(f"Image processing is backed up, {depth} jobs are waiting on {config.attachments.processing_workers} workers.")
+
+    try:
+        return future.result(timeout=config.attachments.processing_timeout)
+    except TimeoutError:
+        # If it hasn't started yet, don't bother running it. If it has, there's no way to stop
+        # just that job, but the worker will pick up new jobs once it finishes.
+        future.cancel()
+        raise ImageJobException("Timed out processing image!")
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise ImageJobException("Failed to process image!")
+
+
+def run_image_job(
+    config: Config,
+    source: Union[bytes, str],
+    max_width: Optional[int],
+    max_height: Optional[int],
+    supported: FrozenSet[str],
+    convertible: FrozenSet[str],
+) -> ImageJobResult:
+    """
+    Process an image, given either as its data or as a path to a file containing it, in the
+    worker pool and wait for the result. Under gevent the threading
+    primitives used to wait on the result are cooperative, so this only blocks the calling
+    greenlet and other sockets keep being serviced while the image is processed. If the pool
+    is disabled in the config, the image is processed inline instead.
+
+    Raises:
+        ImageJobException if the job didn't finish within the configured timeout, or if the
+        worker processing it died.
+    """
+    return _run_job(config, prepare_image, source, max_width, max_height, supported, convertible)
+
+
+def run_variant_job(config: Config, source: Union[bytes, str], sizes: Tuple[int, ...]) -> List[VariantResult]:
+    """
+    Generate preview variants of an image in the worker pool and wait for the result, in the
+    same manner as run_image_job.
+
+    Raises:
+        ImageJobException if the job didn't finish within the configured timeout, or if the
+        worker processing it died.
+    """
+    return _run_job(config, make_variants, source, sizes)
+
+
+def run_variant_jobs(
+    config: Config,
+    jobs: Iterable[Tuple[K, bytes]],
+    sizes: Tuple[int, ...],
+) -> Iterator[Tuple[K, Optional[List[VariantResult]]]]:
+    """
+    Generate preview variants for many images at once, spreading them across every worker in the
+    pool. This is meant for batch work such as backfilling from the manage script, so unlike the
+    other jobs it doesn't count towards the queue depth. Jobs are pulled lazily and only a couple
+    per worker are in flight at a time, so the caller can load image data as it goes.
+
+    Parameters:
+        jobs - An iterable of a caller-chosen key and the image data to process for that key.
+        sizes - The bounding sizes to generate variants for.
+
+    Returns:
+        An iterator of the key and the generated variants for each job, in whatever order they
+        finish. If a job failed or timed out, the variants are None instead.
+    """
+    if config.attachments.processing_workers <= 0:
+        for key, data in jobs:
+            yield key, make_variants(data, sizes)
+        return
+
+    pool = _get_pool(config)
+    pending: Dict["Future[List[VariantResult]]", K] = {}
+    jobiter = iter(jobs)
+    exhausted = False
+
+    while pending or not exhausted:
+        while not exhausted and len(pending) < config.attachments.processing_workers * 2:
+            try:
+                key, data = next(jobiter)
+            except StopIteration:
+                exhausted = True
+                break
+            try:
+                pending[pool.submit(make_variants, data, sizes)] = key
+            except BrokenProcessPool:
+                _discard_pool(pool)
+                pool = _get_pool(config)
+                pending[pool.submit(make_variants, data, sizes)] = key
+
+        if not pending:
+            break
+
+        done, _ = wait(list(pending), timeout=config.attachments.processing_timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            # Nothing finished in time, so give up on everything that's in flight.
+            for future, key in pending.items():
+                future.cancel()
+                yield key, None
+            pending = {}
+            continue
+
+        for future in done:
+            key = pending.pop(future)
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                _discard_pool(pool)
+                result = None
+            except Exception:
+                result = None
+            yield key, result
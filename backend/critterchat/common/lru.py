@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Generic, Hashable, Optional, TypeVar
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A thread-safe cache that holds onto a fixed number of entries, throwing away whichever
+    entry was used least recently when it fills up. Keeps running counts of hits, misses and
+    evictions so that it's possible to tell whether the capacity is reasonable.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.__lock = Lock()
+        self.__entries: "OrderedDict[K, V]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: K) -> Optional[V]:
+        """
+        Look up an entry, marking it as recently used if present.
+
+        Returns:
+            The cached value, or None if it isn't cached.
+        """
+        with self.__lock:
+            try:
+                value = self.__entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        """
+        Remember an entry, evicting the least recently used one if we're full.
+        """
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.capacity:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Throw away every entry, leaving the statistics alone.
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the current size and running statistics of the cache.
+        """
+        with self.__lock:
+            return {
+                "size": len(self.__entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self) -> int:
+        return len(self.__entries)
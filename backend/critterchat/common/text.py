@@ -1,3 +1,4 @@
+import re
 from typing import List
 
 
@@ -140,7 +141,7 @@ KNOWN_CONTROL: List[str] = [
 ]
 
 
-KNOWN_MUSICAL_SYMBOLS = [
+KNOWN_MUSICAL_SYMBOLS: List[str] = [
     "\U0001D150",
     "\U0001D159",
     "\U0001D173",
@@ -154,32 +155,43 @@ KNOWN_MUSICAL_SYMBOLS = [
 ]
 
 
-def convert_spaces(string: str) -> str:
-    for space in KNOWN_SPACES:
-        string = string.replace(space, " ")
-    return string
+def _char_class(chars: List[str]) -> str:
+    return "".join(re.escape(char) for char in chars)
 
 
-def represents_real_text(string: str) -> bool:
+# Every character other than a plain space that convert_spaces() turns into a plain space.
+_SPACES_RE = re.compile("[" + _char_class([char for char in KNOWN_SPACES if char != " "]) + "]")
+
+# A single character that represents_real_text() would consider real text, meaning anything that
+# isn't whitespace or one of the characters below. Built once at import, so checking a message is
+# a single search that stops at the first real character instead of a replace per character.
+_REAL_TEXT_RE = re.compile(
+    "[^\\s"
     # Equivalent to space but different widths and such.
-    for char in KNOWN_SPACES:
-        string = string.replace(char, "")
+    + _char_class(KNOWN_SPACES)
     # Rendered as whitespace but often has different semantic meaning.
-    for char in KNOWN_WHITE_SPACE:
-        string = string.replace(char, "")
+    + _char_class(KNOWN_WHITE_SPACE)
     # Control characters that aren't rendered directly.
-    for char in KNOWN_CONTROL:
-        string = string.replace(char, "")
+    + _char_class(KNOWN_CONTROL)
     # Musical symbols that on their own don't represent anything.
-    for char in KNOWN_MUSICAL_SYMBOLS:
-        string = string.replace(char, "")
+    + _char_class(KNOWN_MUSICAL_SYMBOLS)
     # Language tags, deprecated but somebody could still use one.
-    for val in range(0xE0001, 0xE0080):
-        string = string.replace(chr(val), "")
+    + "\U000E0001-\U000E007F"
     # Variation selectors.
-    for val in range(0xFE00, 0xFE10):
-        string = string.replace(chr(val), "")
-    for val in range(0xE0100, 0xE01F0):
-        string = string.replace(chr(val), "")
+    + "\uFE00-\uFE0F"
+    + "\U000E0100-\U000E01EF"
+    + "]"
+)
+
 
-    return bool(string.strip())
+def convert_spaces(string: str) -> str:
+    if string.isascii():
+        # None of the spaces we convert are ASCII, and this check is far quicker than a search.
+        return string
+    return _SPACES_RE.sub(" ", string)
+
+
+def represents_real_text(string: str) -> bool:
+    # Note that \s matches exactly what str.strip() would remove, so this is the same as removing
+    # every known non-text character and then checking if anything is left after stripping.
+    return _REAL_TEXT_RE.search(string) is not None
@@ -1,6 +1,6 @@
 import copy
 from sqlalchemy.engine import Engine
-from typing import Any, List, Dict, Optional
+from typing import Any, List, Dict, Optional, Tuple
 
 
 def _bool(val: Any, default: bool) -> bool:
@@ -29,6 +29,29 @@ class Database:
     def password(self) -> str:
         return str(self.__config.get("database", {}).get("password") or "critterchat")
 
+    @property
+    def pool_size(self) -> int:
+        return int(self.__config.get("database", {}).get("pool_size") or 10)
+
+    @property
+    def max_overflow(self) -> int:
+        # Specifically allow 0 so operators can cap the number of connections at the pool size.
+        max_overflow = self.__config.get("database", {}).get("max_overflow")
+        if max_overflow is None:
+            max_overflow = 20
+        return int(max_overflow)
+
+    @property
+    def pool_timeout(self) -> float:
+        return float(self.__config.get("database", {}).get("pool_timeout") or 30)
+
+    @property
+    def pool_pre_ping(self) -> bool:
+        pool_pre_ping = self.__config.get("database", {}).get("pool_pre_ping")
+        if pool_pre_ping is None:
+            pool_pre_ping = True
+        return bool(pool_pre_ping)
+
     @property
     def engine(self) -> Engine:
         engine = self.__config.get("database", {}).get("engine")
@@ -39,14 +62,34 @@ class Database:
         return engine
 
 
+def _join_url_prefix(prefix: str, base_url: str) -> str:
+    prefix = prefix.rstrip("/") + "/"
+    if prefix.startswith("http://") or prefix.startswith("https://"):
+        # Attachments are served from somewhere else entirely.
+        return prefix
+
+    return base_url.rstrip("/") + "/" + prefix.lstrip("/")
+
+
 class Attachments:
     def __init__(self, parent_config: "Config") -> None:
         self.__config = parent_config
+        self.__url_prefix: Optional[Tuple[Tuple[str, str], str]] = None
 
     @property
     def prefix(self) -> str:
         return str(self.__config.get("attachments", {}).get("prefix") or "/attachments/")
 
+    @property
+    def url_prefix(self) -> str:
+        # The full URL that attachment names get appended to, worked out from the prefix and the
+        # base URL. This is needed for every attachment URL we hand out, so it's only computed
+        # once and then again only if either of those settings change.
+        key = (self.prefix, self.__config.base_url)
+        if self.__url_prefix is None or self.__url_prefix[0] != key:
+            self.__url_prefix = (key, _join_url_prefix(*key))
+        return self.__url_prefix[1]
+
     @property
     def system(self) -> str:
         return str(self.__config.get("attachments", {}).get("system") or "local")
@@ -60,6 +103,18 @@ class Attachments:
     def attachment_key(self) -> str:
         return str(self.__config.get("attachments", {}).get("attachment_key") or "youalsoreallyshouldhavechangedthistoo")
 
+    @property
+    def processing_workers(self) -> int:
+        # Specifically allow 0 so operators can process images inline instead of in worker processes.
+        processing_workers = self.__config.get("attachments", {}).get("processing_workers")
+        if processing_workers is None:
+            processing_workers = 2
+        return int(processing_workers)
+
+    @property
+    def processing_timeout(self) -> float:
+        return float(self.__config.get("attachments", {}).get("processing_timeout") or 30)
+
 
 class Limits:
     def __init__(self, parent_config: "Config") -> None:
@@ -1,8 +1,11 @@
 from .data import Data, DBCreateException
+from .events import EventBus, PendingEvents, event_bus
+from .lastseen import LastSeenBuffer, last_seen_buffer
 from .types import (
     Action,
     ActionType,
     Attachment,
+    AttachmentVariant,
     Emote,
     MastodonInstance,
     MetadataType,
@@ -34,6 +37,11 @@ from .types import (
 __all__ = [
     "Data",
     "DBCreateException",
+    "EventBus",
+    "PendingEvents",
+    "event_bus",
+    "LastSeenBuffer",
+    "last_seen_buffer",
     "NewActionID",
     "NewOccupantID",
     "NewRoomID",
@@ -49,6 +57,7 @@ __all__ = [
     "Action",
     "ActionType",
     "Attachment",
+    "AttachmentVariant",
     "Emote",
     "MastodonInstance",
     "MetadataType",
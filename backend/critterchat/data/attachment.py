@@ -1,11 +1,11 @@
-import contextlib
 import json
 from sqlalchemy import Table, Column
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.types import String, Integer, JSON
-from typing import Dict, Iterable, Iterator, List, Optional, Union
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 from .base import BaseData, metadata
+from .events import event_bus
 from .types import MetadataType, ActionID, AttachmentID, NewActionID, NewAttachmentID, UserID, NewUserID
 
 """
@@ -19,6 +19,21 @@ attachment = Table(
     Column("content_type", String(128), nullable=False),
     Column("original_filename", String(256), nullable=True),
     Column("metadata", JSON),
+    Column("blob_id", Integer, nullable=True, index=True),
+    mysql_charset="utf8mb4",
+)
+
+"""
+Table representing the actual stored contents of one or more attachments, keyed by a hash of
+those contents so that identical uploads share storage.
+"""
+attachment_blob = Table(
+    "attachment_blob",
+    metadata,
+    Column("id", Integer, nullable=False, primary_key=True, autoincrement=True),
+    Column("hash", String(64), nullable=False, unique=True),
+    Column("size", Integer, nullable=False),
+    Column("refcount", Integer, nullable=False),
     mysql_charset="utf8mb4",
 )
 
@@ -34,6 +49,19 @@ emote = Table(
     mysql_charset="utf8mb4",
 )
 
+"""
+Table representing a log of changes to custom emotes. Every time an emote is added or removed
+a row is written here, so the newest ID doubles as a version for the whole emote set and anybody
+who knows an older version can fetch just the aliases that changed since then.
+"""
+emote_change = Table(
+    "emote_change",
+    metadata,
+    Column("id", Integer, nullable=False, primary_key=True, autoincrement=True),
+    Column("alias", String(64), nullable=False),
+    mysql_charset="utf8mb4",
+)
+
 """
 Table representing a user's custom notification sounds.
 """
@@ -70,12 +98,14 @@ class Attachment:
         content_type: str,
         original_filename: Optional[str],
         metadata: Dict[MetadataType, object],
+        blobid: Optional[int] = None,
     ) -> None:
         self.id = attachmentid
         self.system = system
         self.content_type = content_type
         self.original_filename = original_filename
         self.metadata = metadata
+        self.blobid = blobid
 
 
 class Emote:
@@ -205,8 +235,11 @@ class AttachmentData(BaseData):
         if attachmentid == NewAttachmentID:
             return None
 
+        return self.cached("attachment", attachmentid, lambda: self.__fetch_attachment(attachmentid))
+
+    def __fetch_attachment(self, attachmentid: AttachmentID) -> Optional[Attachment]:
         sql = """
-            SELECT `system`, `content_type`, `original_filename`, `metadata` FROM attachment WHERE id = :id
+            SELECT `system`, `content_type`, `original_filename`, `metadata`, `blob_id` FROM attachment WHERE id = :id
         """
         cursor = self.execute(sql, {"id": attachmentid})
         if cursor.rowcount != 1:
@@ -219,16 +252,155 @@ class AttachmentData(BaseData):
             str(result["content_type"] or ""),
             str(result["original_filename"] or "") or None,
             json.loads(str(result["metadata"] or "{}")),
+            int(result["blob_id"]) if result["blob_id"] is not None else None,
         )
 
+    def lookup_attachments(self, attachmentids: Iterable[AttachmentID]) -> Dict[AttachmentID, Attachment]:
+        """
+        Given a bunch of attachment IDs, look all of them up in one go.
+
+        Parameters:
+            attachmentids - The attachment IDs we're curious about.
+
+        Returns:
+            A dictionary keyed by attachment ID of every attachment that was found.
+        """
+
+        ids = [aid for aid in attachmentids if aid != NewAttachmentID]
+        if not ids:
+            return {}
+
+        sql = """
+            SELECT `id`, `system`, `content_type`, `original_filename`, `metadata`, `blob_id`
+            FROM attachment
+            WHERE id IN :ids
+        """
+        cursor = self.execute(sql, {"ids": ids})
+        return {
+            AttachmentID(result['id']): Attachment(
+                AttachmentID(result['id']),
+                str(result['system'] or ""),
+                str(result['content_type'] or ""),
+                str(result['original_filename'] or "") or None,
+                json.loads(str(result["metadata"] or "{}")),
+                int(result["blob_id"]) if result["blob_id"] is not None else None,
+            ) for result in cursor.mappings()
+        }
+
     def get_attachments(self) -> List[Attachment]:
         """
         Look up all known attachments in the system.
         """
 
+        sql = """
+            SELECT `id`, `system`, `content_type`, `original_filename`, `metadata`, `blob_id`
+            FROM attachment
+        """
+        cursor = self.execute(sql, {})
+        return [
+            Attachment(
+                AttachmentID(result['id']),
+                str(result['system'] or ""),
+                str(result['content_type'] or ""),
+                str(result['original_filename'] or "") or None,
+                json.loads(str(result["metadata"] or "{}")),
+                int(result["blob_id"]) if result["blob_id"] is not None else None,
+            ) for result in cursor.mappings()
+        ]
+
+    def reference_blob(self, hashval: str, size: int) -> Tuple[int, bool]:
+        """
+        Given the hash of some attachment contents, take a reference to the blob holding those
+        contents, creating the blob if nobody has stored these contents yet.
+
+        Parameters:
+            hashval - The hex SHA-256 hash of the contents.
+            size - The size of the contents in bytes.
+
+        Returns:
+            A tuple of the blob ID and whether the blob was newly created, in which case the caller
+            is responsible for actually storing the contents.
+        """
+
+        # LAST_INSERT_ID(id) makes the existing blob's ID come back when we bump its refcount instead.
+        sql = """
+            INSERT INTO attachment_blob (`hash`, `size`, `refcount`)
+            VALUES (:hash, :size, 1)
+            ON DUPLICATE KEY UPDATE `refcount` = `refcount` + 1, `id` = LAST_INSERT_ID(`id`)
+        """
+        cursor = self.execute(sql, {"hash": hashval, "size": size})
+
+        # MySQL reports one row affected for a fresh insert and two for an update.
+        return int(cursor.lastrowid), cursor.rowcount == 1
+
+    def release_blob(self, blobid: int) -> Optional[str]:
+        """
+        Given a blob ID, drop a reference to it, removing the blob once nothing refers to it.
+
+        Parameters:
+            blobid - The blob ID that an attachment no longer points at.
+
+        Returns:
+            The hash of the blob if this was the last reference and the caller should remove the
+            stored contents, or None if the blob is still in use.
+        """
+
+        with self.transaction():
+            sql = "SELECT `hash`, `refcount` FROM attachment_blob WHERE id = :id FOR UPDATE"
+            cursor = self.execute(sql, {"id": blobid})
+            if cursor.rowcount != 1:
+                return None
+
+            result = cursor.mappings().fetchone()
+            if int(result['refcount']) > 1:
+                sql = "UPDATE attachment_blob SET `refcount` = `refcount` - 1 WHERE id = :id LIMIT 1"
+                self.execute(sql, {"id": blobid})
+                return None
+
+            sql = "DELETE FROM attachment_blob WHERE id = :id LIMIT 1"
+            self.execute(sql, {"id": blobid})
+            return str(result['hash'])
+
+    def set_attachment_blob(self, attachmentid: AttachmentID, blobid: Optional[int]) -> None:
+        """
+        Given an existing attachment, point it at the blob holding its contents.
+        """
+
+        sql = """
+            UPDATE attachment
+            SET blob_id = :blobid
+            WHERE id = :id
+            LIMIT 1
+        """
+        self.execute(sql, {"id": attachmentid, "blobid": blobid})
+
+    def get_blob_stats(self) -> Tuple[int, int, int]:
+        """
+        Look up how well deduplication is doing.
+
+        Returns:
+            A tuple of the number of blobs, the total number of references to them and the total
+            number of bytes stored.
+        """
+
+        sql = """
+            SELECT COUNT(id) AS blobs, COALESCE(SUM(refcount), 0) AS refs, COALESCE(SUM(size), 0) AS size
+            FROM attachment_blob
+        """
+        cursor = self.execute(sql, {})
+        result = cursor.mappings().fetchone()
+        return int(result['blobs']), int(result['refs']), int(result['size'])
+
+    def get_message_attachments(self) -> List[Attachment]:
+        """
+        Look up all attachments in the system that are attached to at least one action, which
+        excludes things like icons, emotes and notification sounds.
+        """
+
         sql = """
             SELECT `id`, `system`, `content_type`, `original_filename`, `metadata`
             FROM attachment
+            WHERE id IN (SELECT attachment_id FROM action_attachment)
         """
         cursor = self.execute(sql, {})
         return [
@@ -241,9 +413,13 @@ class AttachmentData(BaseData):
             ) for result in cursor.mappings()
         ]
 
-    def get_emotes(self) -> List[Emote]:
+    def get_emotes(self, aliases: Optional[Iterable[str]] = None) -> List[Emote]:
         """
         Look up all custom emotes in the DB.
+
+        Parameters:
+            aliases - Optional aliases to restrict the lookup to. Aliases which don't exist
+                      are silently left out of the results.
         """
 
         sql = """
@@ -256,7 +432,12 @@ class AttachmentData(BaseData):
             FROM emote
             JOIN attachment ON attachment.id = emote.attachment_id
         """
-        cursor = self.execute(sql, {})
+        if aliases is not None:
+            aliases = list(aliases)
+            if not aliases:
+                return []
+            sql += " WHERE emote.alias IN :aliases"
+        cursor = self.execute(sql, {"aliases": aliases})
         return [
             Emote(
                 result['alias'],
@@ -301,20 +482,70 @@ class AttachmentData(BaseData):
         Given an alias and an attachment ID, insert a new emote.
         """
 
-        sql = """
-            INSERT INTO emote (`alias`, `attachment_id`) VALUES (:alias, :attachmentid)
-        """
-        self.execute(sql, {"alias": alias, "attachmentid": attachmentid})
+        with self.transaction():
+            sql = """
+                INSERT INTO emote (`alias`, `attachment_id`) VALUES (:alias, :attachmentid)
+            """
+            self.execute(sql, {"alias": alias, "attachmentid": attachmentid})
+            self.__log_emote_change(alias)
 
     def remove_emote(self, alias: str) -> None:
         """
         Given an alias for an existing emote, remove it from our tracking list.
         """
 
+        with self.transaction():
+            sql = """
+                DELETE FROM emote WHERE `alias` = :alias LIMIT 1
+            """
+            self.execute(sql, {"alias": alias})
+            self.__log_emote_change(alias)
+
+    def __log_emote_change(self, alias: str) -> None:
         sql = """
-            DELETE FROM emote WHERE `alias` = :alias LIMIT 1
+            INSERT INTO emote_change (`alias`) VALUES (:alias)
         """
         self.execute(sql, {"alias": alias})
+        self.after_commit(event_bus.publish_emotes)
+
+    def get_emote_version(self) -> int:
+        """
+        Look up the current version of the custom emote set. This is cheap enough to call
+        often, and only changes when an emote is added or removed.
+
+        Returns:
+            An integer which increases every time the emote set changes, or 0 if it never has.
+        """
+
+        sql = """
+            SELECT MAX(id) AS version FROM emote_change
+        """
+        cursor = self.execute(sql, {})
+        result = cursor.mappings().fetchone()
+        return int(result['version'] or 0) if result else 0
+
+    def get_emote_changes(self, version: int) -> Tuple[int, List[str]]:
+        """
+        Look up which custom emotes were added or removed since a given version.
+
+        Parameters:
+            version - A version previously returned by get_emote_version() or this function.
+
+        Returns:
+            A tuple of the new version and a list of aliases which changed since the given
+            version. Look the aliases up again to find out whether they were added or removed.
+        """
+
+        sql = """
+            SELECT id, alias FROM emote_change WHERE id > :version ORDER BY id ASC
+        """
+        cursor = self.execute(sql, {"version": version})
+        aliases: List[str] = []
+        for result in cursor.mappings():
+            version = max(version, int(result['id']))
+            if result['alias'] not in aliases:
+                aliases.append(str(result['alias']))
+        return version, aliases
 
     def get_notifications(self, userid: UserID) -> Dict[str, Attachment]:
         """
@@ -404,20 +635,6 @@ class AttachmentData(BaseData):
         """
         self.execute(sql, {"userid": userid, "type": notificationtype})
 
-    @contextlib.contextmanager
-    def lock_action_attachments(self) -> Iterator[None]:
-        """
-        Locks the action attachments table for exclusive write, when needing to attach data to a new
-        attachment without other clients polling incomplete actions. Use in a with block.
-        """
-        sql = "LOCK TABLES attachment WRITE, action_attachment WRITE"
-        self.execute(sql, {})
-        try:
-            yield
-        finally:
-            sql = "UNLOCK TABLES"
-            self.execute(sql, {})
-
     def get_action_attachments(self, actionid: Union[ActionID, Iterable[ActionID]]) -> Dict[ActionID, List[ActionAttachment]]:
         """
         Look up all action attachments for a given action or actions in the system.
@@ -1,7 +1,7 @@
 import json
 import random
 from contextlib import contextmanager
-from typing import Dict, Iterator, List, Optional, cast
+from typing import Callable, Dict, Iterator, List, Optional, TypeVar, cast
 
 from sqlalchemy import MetaData
 from sqlalchemy.orm import scoped_session
@@ -9,9 +9,11 @@ from sqlalchemy.engine import CursorResult  # type: ignore
 from sqlalchemy.sql import text
 
 from ..config import Config
+from .cache import IdentityMap
 
 
 metadata = MetaData()
+T = TypeVar("T")
 
 
 class _BytesEncoder(json.JSONEncoder):
@@ -23,7 +25,7 @@ class _BytesEncoder(json.JSONEncoder):
 
 
 class BaseData:
-    def __init__(self, config: Config, session: scoped_session) -> None:
+    def __init__(self, config: Config, session: scoped_session, cache: IdentityMap) -> None:
         """
         Initializes any DB singleton.
 
@@ -32,15 +34,28 @@ class BaseData:
         Parameters:
             config - Global application configuration structure.
             session - An established DB session which will be used for all queries.
+            cache - The identity map shared by every data class on the same Data object.
         """
         self.__config = config
         self.__session = session
-        self.__depth: List[int] = []
+        self.__cache = cache
 
     @property
     def config(self) -> Config:
         return self.__config
 
+    @property
+    def __depth(self) -> List[int]:
+        # Every data object in the same greenlet shares one session, so how deep in a transaction
+        # we are has to live on the session too. Otherwise one data object would happily commit
+        # a transaction that another one opened.
+        return cast(List[int], self.__session.info.setdefault("transaction_depth", []))
+
+    @property
+    def __pending(self) -> List[Callable[[], None]]:
+        # Callbacks waiting on the current transaction, kept on the session for the same reason.
+        return cast(List[Callable[[], None]], self.__session.info.setdefault("after_commit", []))
+
     def serialize(self, data: Dict[str, object]) -> str:
         """
         Given an arbitrary dict, serialize it to JSON.
@@ -77,13 +92,36 @@ class BaseData:
 
         return cast(Dict[str, object], fix(json.loads(data)))
 
+    def cached(self, kind: str, key: object, fetch: Callable[[], T]) -> T:
+        """
+        Look up an entity through the identity map, only going to the DB if nothing was cached
+        for it since the last write.
+
+        Parameters:
+            kind - The kind of entity, such as "user" or "room".
+            key - The key that the entity is looked up by, usually its ID.
+            fetch - A function taking no arguments that loads the entity from the DB.
+        """
+        return self.__cache.lookup(kind, key, fetch)
+
     @contextmanager
     def transaction(self) -> Iterator[None]:
         with self.__session.begin():
             nonce = random.randint(0, 2 ** 31)
             self.__depth.append(nonce)
-
-            yield
+            queued = len(self.__pending)
+
+            try:
+                yield
+            except BaseException:
+                # Everything done inside this transaction is about to be rolled back, so forget
+                # anything we cached, and drop any callbacks waiting to announce the writes since
+                # they will never be committed. We're also no longer inside this transaction.
+                self.__cache.invalidate()
+                del self.__pending[queued:]
+                if self.__depth and self.__depth[-1] == nonce:
+                    self.__depth.pop()
+                raise
 
             newnonce = self.__depth.pop()
             if nonce != newnonce:
@@ -91,6 +129,40 @@ class BaseData:
 
             self.__session.commit()
 
+        if not self.__depth:
+            # We're out of the outermost transaction, so anything waiting on the data to be
+            # visible to other connections can now run.
+            pending = list(self.__pending)
+            del self.__pending[:]
+            for callback in pending:
+                callback()
+
+    @contextmanager
+    def atomic(self) -> Iterator[None]:
+        """
+        Run a block of statements as one unit. If we're already inside a transaction then the block
+        is simply part of it, otherwise a new transaction is started for just the block. Use this
+        instead of transaction() in methods that are called both inside and outside of one.
+        """
+        if self.__depth:
+            yield
+        else:
+            with self.transaction():
+                yield
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """
+        Run a callback once everything written so far is committed. If we're not currently inside
+        a transaction then execute() already committed for us, so the callback runs immediately.
+
+        Parameters:
+            callback - A function taking no arguments to call after commit.
+        """
+        if self.__depth:
+            self.__pending.append(callback)
+        else:
+            callback()
+
     def execute(
         self,
         sql: str,
@@ -109,6 +181,12 @@ class BaseData:
         if self.__session is None:
             raise Exception("Logic error, our database connection was not created!")
 
+        # Anything other than a read could change an entity we've cached, so throw them all away
+        # rather than trying to figure out which ones are affected.
+        self.__cache.queries += 1
+        if not sql.lstrip().upper().startswith(("SELECT", "EXPLAIN")):
+            self.__cache.invalidate()
+
         result = self.__session.execute(
             text(sql),
             params if params is not None else {},
@@ -0,0 +1,145 @@
+import copy
+import time
+from threading import Lock
+from typing import Callable, Dict, Final, Optional, Tuple, TypeVar
+
+from .types import User, UserID
+
+
+T = TypeVar("T")
+
+
+class IdentityMap:
+    """
+    A short-lived cache of entities looked up by ID, shared between every data class on a single
+    Data object. A Data object is created per web request and per socket event, so this lets
+    the various services look up the same user, room, occupant or attachment as many times as
+    they like while only hitting the DB once. Any write through the same Data object throws
+    away everything, so this will never serve something older than our own writes. Long-lived
+    Data objects such as the one owned by the message pump should call reset() periodically.
+    """
+
+    def __init__(self) -> None:
+        self.__entries: Dict[Tuple[str, object], object] = {}
+
+        # Running statistics, useful for auditing how many queries a request makes.
+        self.queries = 0
+        self.hits = 0
+
+    def lookup(self, kind: str, key: object, fetch: Callable[[], T]) -> T:
+        """
+        Return the cached entity of a given kind and key, fetching it if we haven't seen it yet.
+        Misses are cached as well, so repeatedly looking up something that doesn't exist is free.
+
+        Parameters:
+            kind - The kind of entity, such as "user" or "room".
+            key - The key that the entity was looked up by, usually its ID.
+            fetch - A function taking no arguments that loads the entity from the DB.
+
+        Returns:
+            A copy of the entity, so that callers are free to modify what they get back.
+        """
+        if (kind, key) in self.__entries:
+            self.hits += 1
+            return copy.deepcopy(self.__entries[(kind, key)])  # type: ignore
+
+        value = fetch()
+        self.__entries[(kind, key)] = copy.deepcopy(value)
+        return value
+
+    def invalidate(self) -> None:
+        """
+        Throw away every cached entity, because something was written.
+        """
+        self.__entries = {}
+
+    def reset(self) -> None:
+        """
+        Throw away every cached entity and start statistics over.
+        """
+        self.__entries = {}
+        self.queries = 0
+        self.hits = 0
+
+
+class SessionCache:
+    """
+    A process-wide cache of which user each login session belongs to. Every socket event has to
+    re-validate its session, so this saves a pair of queries per event for chatty clients. Entries
+    only live for a few seconds so that changes made by other processes (such as the manage script)
+    are still noticed quickly, and anything in this process that logs a session out or changes a
+    user invalidates the affected entries right away.
+    """
+
+    TTL_SECONDS: Final[float] = 10.0
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__entries: Dict[str, Tuple[float, User]] = {}
+        self.__last_sweep = time.monotonic()
+
+    def get(self, session: str) -> Optional[User]:
+        """
+        Look up a session in the cache. Note that only valid sessions are ever cached, so a miss
+        doesn't mean anything about whether the session is valid.
+
+        Parameters:
+            session - The session string we're curious about.
+
+        Returns:
+            A copy of the user the session belongs to, or None if it isn't cached.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(session)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self.__entries[session]
+                return None
+            return copy.deepcopy(entry[1])
+
+    def put(self, session: str, user: User, expiration: Optional[int] = None) -> None:
+        """
+        Remember which user a valid session belongs to.
+
+        Parameters:
+            session - The session string we looked up.
+            user - The user the session belongs to.
+            expiration - Optional number of seconds until the session itself expires, so that we
+                         never remember a session past its expiration.
+        """
+        now = time.monotonic()
+        ttl = self.TTL_SECONDS
+        if expiration is not None:
+            ttl = min(ttl, float(expiration))
+
+        with self.__lock:
+            self.__entries[session] = (now + ttl, copy.deepcopy(user))
+
+            # Sessions that stop being used never get looked up again, so every so often throw
+            # away anything that has expired to keep this from growing forever.
+            if now - self.__last_sweep >= self.TTL_SECONDS:
+                self.__last_sweep = now
+                self.__entries = {k: v for k, v in self.__entries.items() if v[0] > now}
+
+    def invalidate_session(self, session: str) -> None:
+        """
+        Forget a single session, such as when it is logged out.
+        """
+        with self.__lock:
+            self.__entries.pop(session, None)
+
+    def invalidate_user(self, userid: UserID) -> None:
+        """
+        Forget every session belonging to a user, such as when their permissions change.
+        """
+        with self.__lock:
+            self.__entries = {
+                session: entry for session, entry in self.__entries.items()
+                if entry[1].id != userid
+            }
+
+
+# The single process-wide session cache that the data layer validates sessions against.
+session_cache = SessionCache()
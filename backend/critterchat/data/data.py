@@ -1,5 +1,6 @@
 import os
-from typing import Optional
+from threading import Lock
+from typing import Dict, Optional
 
 import alembic.config
 from alembic.migration import MigrationContext
@@ -12,11 +13,14 @@ from sqlalchemy.exc import ProgrammingError
 
 from ..config import Config
 from .base import metadata
+from .cache import IdentityMap
+from .pool import MeteredQueuePool
 from .user import UserData
 from .room import RoomData
 from .attachment import AttachmentData
 from .migration import MigrationData
 from .mastodon import MastodonData
+from .search import SearchData
 
 
 __all__ = [
@@ -30,6 +34,20 @@ class DBCreateException(Exception):
     pass
 
 
+# Every Data object for the same engine shares one session registry. Sessions are scoped to the
+# current thread, which under gevent means the current greenlet, so every socket event and web
+# request gets its own session while not having to build a new session factory each time.
+_session_lock: Lock = Lock()
+_sessions: Dict[Engine, scoped_session] = {}
+
+
+def _get_session_registry(engine: Engine) -> scoped_session:
+    with _session_lock:
+        if engine not in _sessions:
+            _sessions[engine] = scoped_session(sessionmaker(bind=engine, autoflush=True))
+        return _sessions[engine]
+
+
 class Data:
     """
     An object that is meant to be used as a singleton, in order to hold DB configuration
@@ -44,19 +62,39 @@ class Data:
             config - A config structure with a 'database' section which is used
                      to initialize an internal DB connection.
         """
-        session_factory = sessionmaker(
-            bind=config.database.engine,
-            autoflush=True,
-        )
         self.__config = config
-        self.__session: Optional[scoped_session] = scoped_session(session_factory)
+        self.__session: Optional[scoped_session] = _get_session_registry(config.database.engine)
         self.__url = Data.sqlalchemy_url(config)
+        self.__cache = IdentityMap()
+
+        self.user = UserData(config, self.__session, self.__cache)
+        self.room = RoomData(config, self.__session, self.__cache)
+        self.attachment = AttachmentData(config, self.__session, self.__cache)
+        self.migration = MigrationData(config, self.__session, self.__cache)
+        self.mastodon = MastodonData(config, self.__session, self.__cache)
+        self.search = SearchData(config, self.__session, self.__cache)
+
+    @property
+    def query_count(self) -> int:
+        """
+        The number of queries that have been run since this object was created or last reset.
+        """
+        return self.__cache.queries
 
-        self.user = UserData(config, self.__session)
-        self.room = RoomData(config, self.__session)
-        self.attachment = AttachmentData(config, self.__session)
-        self.migration = MigrationData(config, self.__session)
-        self.mastodon = MastodonData(config, self.__session)
+    @property
+    def cache_hits(self) -> int:
+        """
+        The number of lookups that were served from the identity map instead of the DB since this
+        object was created or last reset.
+        """
+        return self.__cache.hits
+
+    def reset_cache(self) -> None:
+        """
+        Throw away any cached entities and reset the query statistics. Data objects are meant to be
+        created per web request or socket event, so this only needs calling on long-lived ones.
+        """
+        self.__cache.reset()
 
     @classmethod
     def sqlalchemy_url(cls, config: Config) -> str:
@@ -66,9 +104,25 @@ class Data:
     def create_engine(cls, config: Config) -> Engine:
         return create_engine(
             Data.sqlalchemy_url(config),
+            poolclass=MeteredQueuePool,
+            pool_size=config.database.pool_size,
+            max_overflow=config.database.max_overflow,
+            pool_timeout=config.database.pool_timeout,
+            pool_pre_ping=config.database.pool_pre_ping,
             pool_recycle=3600,
         )
 
+    @classmethod
+    def pool_stats(cls, config: Config) -> Dict[str, object]:
+        """
+        Return the number of connections in the DB pool and how long requests have had to wait
+        to get one, for keeping an eye on whether the pool is sized correctly.
+        """
+        pool = config.database.engine.pool
+        if isinstance(pool, MeteredQueuePool):
+            return pool.pool_stats()
+        return {"status": pool.status()}
+
     def __exists(self) -> bool:
         # See if the DB was already created
         if self.__session is None:
@@ -167,7 +221,9 @@ class Data:
         """
         Close any open data connection.
         """
-        # Make sure we don't leak connections between web requests
+        # Make sure we don't leak connections between web requests. This throws away the session for
+        # the current greenlet, which hands its connection back to the pool right away.
         if self.__session is not None:
-            self.__session.close()
+            self.__session.remove()  # type: ignore[no-untyped-call]
             self.__session = None
+        self.__cache.invalidate()
@@ -0,0 +1,116 @@
+from threading import Event, Lock
+from typing import Dict, Iterable, Optional, Set
+
+from .types import ActionID, RoomID, UserID
+
+
+class PendingEvents:
+    """
+    A snapshot of everything that was published to the event bus since the last time
+    somebody drained it.
+    """
+
+    def __init__(self, rooms: Dict[RoomID, ActionID], users: Set[UserID], emotes: bool = False) -> None:
+        # The newest action ID that was written to each room that changed.
+        self.rooms = rooms
+
+        # Any users whose profile, preferences, permissions, last seen markers or joined
+        # rooms changed.
+        self.users = users
+
+        # Whether any custom emotes were added or removed.
+        self.emotes = emotes
+
+    def __bool__(self) -> bool:
+        return bool(self.rooms or self.users or self.emotes)
+
+
+class EventBus:
+    """
+    An in-process notification bus. Anything that writes data which connected clients should
+    hear about publishes to this, so that the message pump can wake up right away and only look
+    at what actually changed instead of polling the database on a fixed tick. Note that this only
+    sees writes made by this process, so anything that can be changed by other processes (such as
+    the manage script) still needs a slower fallback poll on the consuming side.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__event = Event()
+        self.__rooms: Dict[RoomID, ActionID] = {}
+        self.__users: Set[UserID] = set()
+        self.__emotes = False
+
+    def publish_action(self, roomid: RoomID, actionid: ActionID) -> None:
+        """
+        Notify listeners that a new action was persisted to a given room.
+
+        Parameters:
+            roomid - The ID of the room that received a new action.
+            actionid - The ID of the new action itself.
+        """
+        with self.__lock:
+            existing = self.__rooms.get(roomid)
+            if existing is None or existing < actionid:
+                self.__rooms[roomid] = actionid
+        self.__event.set()
+
+    def publish_user(self, userid: UserID) -> None:
+        """
+        Notify listeners that something about a given user changed.
+
+        Parameters:
+            userid - The ID of the user that changed.
+        """
+        with self.__lock:
+            self.__users.add(userid)
+        self.__event.set()
+
+    def publish_users(self, userids: Iterable[UserID]) -> None:
+        """
+        Notify listeners that something about many users changed at once, such as when a whole
+        instance is joined to a new room.
+
+        Parameters:
+            userids - The IDs of every user that changed.
+        """
+        with self.__lock:
+            self.__users.update(userids)
+        self.__event.set()
+
+    def publish_emotes(self) -> None:
+        """
+        Notify listeners that custom emotes were added or removed.
+        """
+        with self.__lock:
+            self.__emotes = True
+        self.__event.set()
+
+    def wait(self, timeout: Optional[float] = None) -> PendingEvents:
+        """
+        Block until something is published or the timeout elapses, and then return everything
+        that has been published since the last call. This is safe to call under gevent since the
+        threading primitives are monkey-patched to cooperative versions.
+
+        Parameters:
+            timeout - Optional maximum number of seconds to wait for an event.
+
+        Returns:
+            A PendingEvents object, which will be empty if we timed out with nothing published.
+        """
+        self.__event.wait(timeout)
+
+        with self.__lock:
+            self.__event.clear()
+            rooms = self.__rooms
+            users = self.__users
+            emotes = self.__emotes
+            self.__rooms = {}
+            self.__users = set()
+            self.__emotes = False
+
+        return PendingEvents(rooms, users, emotes)
+
+
+# The single process-wide bus that the data layer publishes to.
+event_bus = EventBus()
@@ -0,0 +1,93 @@
+import time
+from threading import Lock
+from typing import Dict, Final, Optional, Tuple
+
+from .types import ActionID, RoomID, UserID
+
+
+class LastSeenBuffer:
+    """
+    A process-wide write-behind buffer of last seen markers. Clients report the newest action
+    they've seen as messages scroll into view, which in a busy room can be several times a second
+    per user. Only the newest action per user and room is kept here, and the message pump writes
+    everything out in a handful of batched queries every so often. Anything that reads last seen
+    markers should take what's pending here into account so that it never sees stale data.
+    """
+
+    FLUSH_SECONDS: Final[float] = 0.25
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__marks: Dict[Tuple[UserID, RoomID], ActionID] = {}
+        self.__last_flush = time.monotonic()
+
+    def mark(self, userid: UserID, roomid: RoomID, actionid: ActionID) -> None:
+        """
+        Remember that a user has seen up to a given action in a room.
+
+        Parameters:
+            userid - The ID of the user who saw the action.
+            roomid - The ID of the room the action is in.
+            actionid - The ID of the newest action the user has seen.
+        """
+        key = (userid, roomid)
+        with self.__lock:
+            existing = self.__marks.get(key)
+            if existing is None or existing < actionid:
+                self.__marks[key] = actionid
+
+    def pending(self, userid: UserID) -> Dict[RoomID, ActionID]:
+        """
+        Return the markers for a given user that haven't been written out yet.
+
+        Returns:
+            A dictionary keyed by room ID of the newest action seen in that room.
+        """
+        with self.__lock:
+            return {roomid: actionid for (uid, roomid), actionid in self.__marks.items() if uid == userid}
+
+    def due(self) -> bool:
+        """
+        Return whether there's anything pending and it has been long enough since the last flush.
+        """
+        with self.__lock:
+            return bool(self.__marks) and (time.monotonic() - self.__last_flush) >= self.FLUSH_SECONDS
+
+    def drain(self, userid: Optional[UserID] = None) -> Dict[Tuple[UserID, RoomID], ActionID]:
+        """
+        Take every pending marker out of the buffer so that it can be written out.
+
+        Parameters:
+            userid - Optional ID of a single user to take markers for, such as when they disconnect.
+
+        Returns:
+            A dictionary keyed by user and room ID of the newest action seen.
+        """
+        with self.__lock:
+            if userid is None:
+                marks = self.__marks
+                self.__marks = {}
+                self.__last_flush = time.monotonic()
+            else:
+                marks = {key: actionid for key, actionid in self.__marks.items() if key[0] == userid}
+                for key in marks:
+                    del self.__marks[key]
+            return marks
+
+    def restore(self, marks: Dict[Tuple[UserID, RoomID], ActionID]) -> None:
+        """
+        Put markers that we failed to write back into the buffer, so they're retried on the next
+        flush. Anything that was marked since they were drained is newer and wins.
+        """
+        with self.__lock:
+            for key, actionid in marks.items():
+                existing = self.__marks.get(key)
+                if existing is None or existing < actionid:
+                    self.__marks[key] = actionid
+
+    def __len__(self) -> int:
+        return len(self.__marks)
+
+
+# The single process-wide buffer that last seen markers are written through.
+last_seen_buffer = LastSeenBuffer()
@@ -0,0 +1,88 @@
+import time
+from threading import Lock
+from typing import Any, Dict, cast
+
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMetrics:
+    """
+    Running statistics about how long requests waited to get a DB connection out of the pool. If
+    the average or worst wait starts climbing, or checkouts start timing out, the pool is too small
+    for the number of sockets being served and pool_size or max_overflow should be raised.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float, timed_out: bool) -> None:
+        """
+        Record a single attempt to check a connection out of the pool.
+
+        Parameters:
+            wait - The number of seconds spent waiting for the connection.
+            timed_out - Whether we gave up waiting without getting one.
+        """
+        with self.__lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Return the running statistics, with wait times in milliseconds.
+        """
+        with self.__lock:
+            attempts = self.checkouts + self.timeouts
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "average_wait_ms": (self.total_wait * 1000.0 / attempts) if attempts else 0.0,
+                "max_wait_ms": self.max_wait * 1000.0,
+            }
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    A regular SQLAlchemy queue pool that also times how long each checkout had to wait.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def recreate(self) -> QueuePool:
+        # The pool is thrown away and recreated on dispose, so carry the running statistics over.
+        pool = cast(QueuePool, super().recreate())  # type: ignore[no-untyped-call]
+        if isinstance(pool, MeteredQueuePool):
+            pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self) -> Any:
+        start = time.monotonic()
+        try:
+            entry = super()._do_get()  # type: ignore[misc]
+        except Exception:
+            self.metrics.record(time.monotonic() - start, True)
+            raise
+        self.metrics.record(time.monotonic() - start, False)
+        return entry
+
+    def pool_stats(self) -> Dict[str, object]:
+        """
+        Return the current number of connections along with the running checkout statistics.
+        """
+        return {
+            "size": cast(int, self.size()),  # type: ignore[no-untyped-call]
+            "checked_in": cast(int, self.checkedin()),  # type: ignore[no-untyped-call]
+            "checked_out": cast(int, self.checkedout()),  # type: ignore[no-untyped-call]
+            "overflow": cast(int, self.overflow()),  # type: ignore[no-untyped-call]
+            **self.metrics.stats(),
+        }
@@ -1,13 +1,14 @@
-import contextlib
 import json
-from typing import Any, Dict, Iterator, List, Optional
+from typing import Any, Dict, Final, Iterable, List, Optional, Tuple
 
-from sqlalchemy import Table, Column
+from sqlalchemy import Table, Column, Index
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.types import String, Integer, Boolean, JSON
 
 from ..common import Time
 from .base import BaseData, metadata
+from .events import event_bus
+from .search import SEARCH_KIND_ROOM, get_search_prefix, index_search_terms
 from .types import (
     Action,
     ActionType,
@@ -41,6 +42,9 @@ room = Table(
     Column("icon", Integer),
     Column("purpose", String(10), nullable=False),
     Column("last_action", Integer, nullable=False),
+    Column("badge_seq", Integer, nullable=False),
+    Column("first_action_id", Integer),
+    Column("last_action_id", Integer),
     mysql_charset="utf8mb4",
 )
 
@@ -70,49 +74,26 @@ action = Table(
     metadata,
     Column("id", Integer, nullable=False, primary_key=True, autoincrement=True),
     Column("timestamp", Integer, nullable=False),
-    Column("room_id", Integer, nullable=False, index=True),
+    Column("room_id", Integer, nullable=False),
     Column("occupant_id", Integer),
     Column("action", String(32)),
     Column("details", JSON),
+    Column("badge_seq", Integer),
+    # Almost every query against this table picks a room and then walks or orders by ID, so
+    # make sure both of those are served by an index even in rooms with huge histories.
+    Index("ix_action_room_id_id", "room_id", "id"),
+    # Queries that additionally filter on action type, such as paging through room history.
+    Index("ix_action_room_id_action_id", "room_id", "action", "id"),
     mysql_charset="utf8mb4",
 )
 
 
-class RoomData(BaseData):
-    def _get_oldest_action(self, room_ids: List[RoomID]) -> Dict[RoomID, Optional[ActionID]]:
-        if not room_ids:
-            return {}
-
-        sql = """
-            SELECT room_id, MIN(id) AS action_id FROM action WHERE room_id IN :room_ids GROUP BY room_id
-        """
-        cursor = self.execute(sql, {'room_ids': room_ids})
-        retval: Dict[RoomID, Optional[ActionID]] = {rid: None for rid in room_ids}
-        for result in cursor.mappings():
-            retval[RoomID(result['room_id'])] = ActionID(result['action_id'])
-        return retval
-
-    def _get_newest_action(self, room_ids: List[RoomID]) -> Dict[RoomID, Optional[ActionID]]:
-        if not room_ids:
-            return {}
-
-        sql = """
-            SELECT room_id, MAX(id) AS action_id FROM action WHERE room_id IN :room_ids GROUP BY room_id
-        """
-        cursor = self.execute(sql, {'room_ids': room_ids})
-        retval: Dict[RoomID, Optional[ActionID]] = {rid: None for rid in room_ids}
-        for result in cursor.mappings():
-            retval[RoomID(result['room_id'])] = ActionID(result['action_id'])
-        return retval
+# How many JOIN actions to write per INSERT when joining many users to a room at once. This
+# keeps each statement comfortably under the server's packet size limit.
+JOIN_ACTION_BATCH_SIZE: Final[int] = 500
 
-    def _hydrate_actions(self, rooms: List[Room]) -> List[Room]:
-        oldest_actions = self._get_oldest_action([r.id for r in rooms])
-        newest_actions = self._get_newest_action([r.id for r in rooms])
-        for room in rooms:
-            room.oldest_action = oldest_actions[room.id]
-            room.newest_action = newest_actions[room.id]
-        return rooms
 
+class RoomData(BaseData):
     def _get_purpose(self, purpose: str) -> RoomPurpose:
         if purpose == RoomPurpose.ROOM:
             return RoomPurpose.ROOM
@@ -142,12 +123,12 @@ class RoomData(BaseData):
             extra = "AND inactive != TRUE"
 
         sql = f"""
-            SELECT id, name, topic, icon, purpose, moderated, last_action FROM room WHERE id in (
+            SELECT id, name, topic, icon, purpose, moderated, last_action, first_action_id, last_action_id FROM room WHERE id in (
                 SELECT room_id FROM occupant WHERE user_id = :userid {extra}
             )
         """
         cursor = self.execute(sql, {"userid": userid})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -155,11 +136,13 @@ class RoomData(BaseData):
                 purpose=self._get_purpose(str(result['purpose'])),
                 moderated=bool(result['moderated']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['first_action_id']) if result['first_action_id'] else None,
+                newest_action=ActionID(result['last_action_id']) if result['last_action_id'] else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def get_left_rooms(self, userid: UserID) -> List[Room]:
         """
@@ -175,12 +158,12 @@ class RoomData(BaseData):
             return []
 
         sql = """
-            SELECT id, name, topic, icon, purpose, moderated, last_action FROM room WHERE id in (
+            SELECT id, name, topic, icon, purpose, moderated, last_action, first_action_id, last_action_id FROM room WHERE id in (
                 SELECT room_id FROM occupant WHERE user_id = :userid AND inactive = TRUE
             )
         """
         cursor = self.execute(sql, {"userid": userid})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -188,11 +171,13 @@ class RoomData(BaseData):
                 purpose=self._get_purpose(str(result['purpose'])),
                 moderated=bool(result['moderated']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['first_action_id']) if result['first_action_id'] else None,
+                newest_action=ActionID(result['last_action_id']) if result['last_action_id'] else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def get_joined_room_occupants(self, userid: UserID) -> Dict[RoomID, Occupant]:
         """
@@ -243,7 +228,7 @@ class RoomData(BaseData):
             return []
 
         sql = """
-            SELECT id, name, topic, icon, purpose, moderated, last_action FROM room WHERE id in (
+            SELECT id, name, topic, icon, purpose, moderated, last_action, first_action_id, last_action_id FROM room WHERE id in (
                 SELECT room_id FROM occupant WHERE user_id = :userid AND inactive != TRUE
             )
         """
@@ -251,7 +236,7 @@ class RoomData(BaseData):
             sql += " AND (name IS NULL OR name = '' OR name COLLATE utf8mb4_general_ci LIKE :name)"
 
         cursor = self.execute(sql, {"userid": userid, "name": f"%{name}%"})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -259,11 +244,13 @@ class RoomData(BaseData):
                 purpose=self._get_purpose(str(result['purpose'])),
                 moderated=bool(result['moderated']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['first_action_id']) if result['first_action_id'] else None,
+                newest_action=ActionID(result['last_action_id']) if result['last_action_id'] else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def get_rooms(self, name: Optional[str] = None) -> List[Room]:
         """
@@ -276,13 +263,13 @@ class RoomData(BaseData):
             list of Room objects representing the rooms on the network
         """
         sql = """
-            SELECT id, name, topic, icon, purpose, moderated, last_action FROM room
+            SELECT id, name, topic, icon, purpose, moderated, last_action, first_action_id, last_action_id FROM room
         """
         if name is not None:
             sql += " WHERE (name IS NULL OR name = '' OR name COLLATE utf8mb4_general_ci LIKE :name)"
 
         cursor = self.execute(sql, {"name": f"%{name}%"})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -290,11 +277,13 @@ class RoomData(BaseData):
                 purpose=self._get_purpose(str(result['purpose'])),
                 moderated=bool(result['moderated']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['first_action_id']) if result['first_action_id'] else None,
+                newest_action=ActionID(result['last_action_id']) if result['last_action_id'] else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def get_public_rooms(self, name: Optional[str] = None) -> List[Room]:
         """
@@ -307,13 +296,13 @@ class RoomData(BaseData):
             list of Room objects representing the public rooms on the network
         """
         sql = """
-            SELECT id, name, topic, icon, purpose, moderated, last_action FROM room WHERE purpose = :purpose
+            SELECT id, name, topic, icon, purpose, moderated, last_action, first_action_id, last_action_id FROM room WHERE purpose = :purpose
         """
         if name is not None:
             sql += " AND (name IS NULL OR name = '' OR name COLLATE utf8mb4_general_ci LIKE :name)"
 
         cursor = self.execute(sql, {"name": f"%{name}%", "purpose": RoomPurpose.ROOM})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -321,48 +310,86 @@ class RoomData(BaseData):
                 purpose=self._get_purpose(str(result['purpose'])),
                 moderated=bool(result['moderated']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['first_action_id']) if result['first_action_id'] else None,
+                newest_action=ActionID(result['last_action_id']) if result['last_action_id'] else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
-    def get_visible_rooms(self, userid: UserID, name: Optional[str] = None) -> List[Room]:
+    def search_visible_rooms(self, userid: UserID, name: str, limit: int) -> List[Room]:
         """
-        Given a user ID, look up the rooms that user can see that match the search criteria.
-        Note that this will also return rooms with unset names if you specify the name,
-        because the calling layer will infer the room name.
+        Given a user ID, look up the named rooms that user can see whose names contain the search
+        criteria, using the search index. Rooms whose names start with the criteria come first, in
+        alphabetical order, followed by any others. An empty search matches every room. Note that
+        this never returns rooms with unset names, since there's nothing in the index for them.
 
         Parameters:
-            userid - The ID of the user that we want rooms for.
-            name - The name of the room we want to match.
+            userid - The ID of the user that is searching.
+            name - The text to search room names for.
+            limit - The maximum number of rooms to return.
 
         Returns:
-            list of Room objects representing the rooms the user is in.
+            list of Room objects representing the matching rooms.
         """
         if userid == NewUserID:
             return []
 
-        sql = """
-            SELECT id, name, topic, icon, purpose, moderated, last_action FROM room WHERE purpose = :purpose
-        """
-        if name is not None:
-            sql += " AND (name IS NULL OR name = '' OR name COLLATE utf8mb4_general_ci LIKE :name)"
+        rooms: Dict[RoomID, Room] = {}
+        for infix in [False, True]:
+            remaining = limit - len(rooms)
+            if remaining <= 0:
+                break
+
+            # Anything we already found by prefix may turn up again here, so ask for enough extra
+            # to fill the limit regardless.
+            fetch = (remaining + len(rooms)) if infix else remaining
+
+            # Each room has exactly one term for its name starting at position zero, so the first
+            # query needs no DISTINCT and can be read straight off of the index in order. Note that
+            # MySQL stops a DISTINCT query as soon as it has found enough rows for the limit.
+            sql = f"""
+                SELECT {'DISTINCT' if infix else ''}
+                    room.id AS id, room.name AS name, room.topic AS topic, room.icon AS icon, room.purpose AS purpose,
+                    room.moderated AS moderated, room.last_action AS last_action, room.first_action_id AS first_action_id,
+                    room.last_action_id AS last_action_id
+                FROM search_term
+                JOIN room ON room.id = search_term.target_id
+                WHERE search_term.kind = :kind AND search_term.position {'>' if infix else '='} 0 AND search_term.term LIKE :prefix
+                AND (
+                    room.purpose = :purpose OR
+                    room.id IN (SELECT room_id FROM occupant WHERE user_id = :userid AND inactive != TRUE)
+                )
+                {'' if infix else 'ORDER BY search_term.term'}
+                LIMIT :limit
+            """
+            cursor = self.execute(sql, {
+                "kind": SEARCH_KIND_ROOM,
+                "prefix": get_search_prefix(name),
+                "purpose": RoomPurpose.ROOM,
+                "userid": userid,
+                "limit": fetch,
+            })
+            for result in cursor.mappings():
+                roomid = RoomID(result['id'])
+                if roomid in rooms or len(rooms) >= limit:
+                    continue
+
+                rooms[roomid] = Room(
+                    roomid=roomid,
+                    name=result['name'],
+                    topic=result['topic'],
+                    purpose=self._get_purpose(str(result['purpose'])),
+                    moderated=bool(result['moderated']),
+                    last_action_timestamp=result['last_action'],
+                    oldest_action=ActionID(result['first_action_id']) if result['first_action_id'] else None,
+                    newest_action=ActionID(result['last_action_id']) if result['last_action_id'] else None,
+                    iconid=AttachmentID(result['icon']) if result['icon'] else None,
+                    deficonid=None,
+                )
 
-        cursor = self.execute(sql, {"userid": userid, "name": f"%{name}%", "purpose": RoomPurpose.ROOM})
-        return self._hydrate_actions([
-            Room(
-                roomid=RoomID(result['id']),
-                name=result['name'],
-                topic=result['topic'],
-                purpose=self._get_purpose(str(result['purpose'])),
-                moderated=bool(result['moderated']),
-                last_action_timestamp=result['last_action'],
-                iconid=AttachmentID(result['icon']) if result['icon'] else None,
-                deficonid=None,
-            )
-            for result in cursor.mappings()
-        ])
+        return list(rooms.values())
 
     def get_autojoin_rooms(self) -> List[Room]:
         """
@@ -372,11 +399,11 @@ class RoomData(BaseData):
             list of Room objects representing the rooms the user will auto-join.
         """
         sql = """
-            SELECT id, name, topic, icon, purpose, moderated, last_action FROM room WHERE autojoin = TRUE
+            SELECT id, name, topic, icon, purpose, moderated, last_action, first_action_id, last_action_id FROM room WHERE autojoin = TRUE
         """
 
         cursor = self.execute(sql, {})
-        return self._hydrate_actions([
+        return [
             Room(
                 roomid=RoomID(result['id']),
                 name=result['name'],
@@ -384,11 +411,13 @@ class RoomData(BaseData):
                 purpose=self._get_purpose(str(result['purpose'])),
                 moderated=bool(result['moderated']),
                 last_action_timestamp=result['last_action'],
+                oldest_action=ActionID(result['first_action_id']) if result['first_action_id'] else None,
+                newest_action=ActionID(result['last_action_id']) if result['last_action_id'] else None,
                 iconid=AttachmentID(result['icon']) if result['icon'] else None,
                 deficonid=None,
             )
             for result in cursor.mappings()
-        ])
+        ]
 
     def set_room_autojoin(self, roomid: RoomID, autojoin: bool) -> None:
         """
@@ -417,6 +446,9 @@ class RoomData(BaseData):
         if roomid == NewRoomID:
             return None
 
+        return self.cached("room", roomid, lambda: self.__fetch_room(roomid))
+
+    def __fetch_room(self, roomid: RoomID) -> Optional[Room]:
         sql = """
             SELECT * FROM room WHERE id = :roomid
         """
@@ -424,19 +456,15 @@ class RoomData(BaseData):
         if cursor.rowcount != 1:
             return None
         result = cursor.mappings().fetchone()
-        room_id = RoomID(result['id'])
-        oldest_actions = self._get_oldest_action([room_id])
-        newest_actions = self._get_newest_action([room_id])
-
         return Room(
-            roomid=room_id,
+            roomid=RoomID(result['id']),
             name=result['name'],
             topic=result['topic'],
             purpose=self._get_purpose(str(result['purpose'])),
             moderated=bool(result['moderated']),
             last_action_timestamp=result['last_action'],
-            oldest_action=oldest_actions.get(room_id),
-            newest_action=newest_actions.get(room_id),
+            oldest_action=ActionID(result['first_action_id']) if result['first_action_id'] else None,
+            newest_action=ActionID(result['last_action_id']) if result['last_action_id'] else None,
             iconid=AttachmentID(result['icon']) if result['icon'] else None,
             deficonid=None,
         )
@@ -475,13 +503,14 @@ class RoomData(BaseData):
 
         timestamp = Time.now()
         sql = """
-            INSERT INTO room (`name`, `topic`, `moderated`, `purpose`, `last_action`, `icon`) VALUES (:name, :topic, :moderated, :purpose, :timestamp, :icon)
+            INSERT INTO room (`name`, `topic`, `moderated`, `purpose`, `last_action`, `badge_seq`, `icon`) VALUES (:name, :topic, :moderated, :purpose, :timestamp, 0, :icon)
         """
         cursor = self.execute(sql, {"name": room.name, "topic": room.topic, "moderated": room.moderated, "purpose": room.purpose, "timestamp": timestamp, "icon": room.iconid})
         if cursor.rowcount != 1:
             return None
         newroom = self.get_room(RoomID(cursor.lastrowid))
         if newroom:
+            index_search_terms(self, SEARCH_KIND_ROOM, newroom.id, [newroom.name])
             room.id = newroom.id
             room.name = newroom.name
             room.topic = newroom.topic
@@ -557,6 +586,174 @@ class RoomData(BaseData):
                 """
                 self.execute(sql, {"userid": userid, "roomid": roomid})
 
+    def join_activated_users(self, roomid: RoomID) -> int:
+        """
+        Join every activated user to a room at once, such as when creating an auto-join room. This
+        does the same thing as calling join_room for each user, but all of the occupants are written
+        with a single query and the resulting JOIN actions are written in batches.
+
+        Parameters:
+            roomid - ID of the room that every activated user should join.
+
+        Returns:
+            The number of users that were newly joined to the room.
+        """
+        if roomid == NewRoomID:
+            return 0
+
+        with self.transaction():
+            # First, figure out who isn't already joined, since only they get a JOIN action.
+            sql = """
+                SELECT user.id AS id FROM user
+                LEFT JOIN occupant ON occupant.user_id = user.id AND occupant.room_id = :roomid
+                WHERE (user.permissions & :activated) = :activated
+                AND (occupant.id IS NULL OR occupant.inactive = TRUE)
+            """
+            cursor = self.execute(sql, {"roomid": roomid, "activated": UserPermission.ACTIVATED})
+            joining = {UserID(result['id']) for result in cursor.mappings()}
+            if not joining:
+                return 0
+
+            sql = """
+                INSERT INTO occupant (`user_id`, `room_id`, `inactive`)
+                SELECT user.id, :roomid, FALSE FROM user WHERE (user.permissions & :activated) = :activated
+                ON DUPLICATE KEY UPDATE `inactive` = FALSE
+            """
+            self.execute(sql, {"roomid": roomid, "activated": UserPermission.ACTIVATED})
+
+            # Now, look up the occupant IDs of everyone we just joined so we can attribute actions.
+            sql = """
+                SELECT id, user_id FROM occupant WHERE `room_id` = :roomid AND `inactive` != TRUE
+            """
+            cursor = self.execute(sql, {"roomid": roomid})
+            occupants = [
+                (OccupantID(result['id']), UserID(result['user_id']))
+                for result in cursor.mappings()
+                if UserID(result['user_id']) in joining
+            ]
+            self.__insert_join_actions(roomid, occupants)
+
+        return len(occupants)
+
+    def join_autojoin_rooms(self, userid: UserID) -> List[RoomID]:
+        """
+        Join a user to every room that is marked for auto-join at once, such as when a new user
+        accepts the welcome message. This does the same thing as calling join_room for each room,
+        but all of the occupants are written with a single query.
+
+        Parameters:
+            userid - ID of the user that should join every auto-join room.
+
+        Returns:
+            A list of IDs of the rooms that the user was newly joined to.
+        """
+        if userid == NewUserID:
+            return []
+
+        with self.transaction():
+            # First, figure out which rooms we aren't already in, since only they get a JOIN action.
+            sql = """
+                SELECT room.id AS id FROM room
+                LEFT JOIN occupant ON occupant.room_id = room.id AND occupant.user_id = :userid
+                WHERE room.autojoin = TRUE
+                AND (occupant.id IS NULL OR occupant.inactive = TRUE)
+            """
+            cursor = self.execute(sql, {"userid": userid})
+            joining = {RoomID(result['id']) for result in cursor.mappings()}
+            if not joining:
+                return []
+
+            sql = """
+                INSERT INTO occupant (`user_id`, `room_id`, `inactive`)
+                SELECT :userid, room.id, FALSE FROM room WHERE room.autojoin = TRUE
+                ON DUPLICATE KEY UPDATE `inactive` = FALSE
+            """
+            self.execute(sql, {"userid": userid})
+
+            # Now, look up our occupant ID in each room we just joined so we can attribute actions.
+            sql = """
+                SELECT id, room_id FROM occupant WHERE `user_id` = :userid AND `inactive` != TRUE
+            """
+            cursor = self.execute(sql, {"userid": userid})
+            occupants = {
+                RoomID(result['room_id']): OccupantID(result['id'])
+                for result in cursor.mappings()
+                if RoomID(result['room_id']) in joining
+            }
+            for roomid, occupantid in occupants.items():
+                self.__insert_join_actions(roomid, [(occupantid, userid)])
+
+        return list(occupants.keys())
+
+    def __insert_join_actions(self, roomid: RoomID, occupants: List[Tuple[OccupantID, UserID]]) -> None:
+        # This is the bulk equivalent of calling insert_action with a JOIN for each occupant, which
+        # the caller has already verified are newly joined. The badge sequence is bumped once for the
+        # whole batch and then handed out to each action in turn, so marking any one of these as seen
+        # covers exactly the same badging actions as if they had been inserted one at a time.
+        if not occupants:
+            return
+
+        sql = "SELECT purpose, badge_seq FROM room WHERE id = :roomid FOR UPDATE"
+        cursor = self.execute(sql, {"roomid": roomid})
+        if cursor.rowcount != 1:
+            # Trying to insert actions and the room doesn't exist?
+            return
+
+        result = cursor.mappings().fetchone()
+        purpose = self._get_purpose(result['purpose'])
+        badge_seq = int(result['badge_seq'])
+
+        if purpose == RoomPurpose.DIRECT_MESSAGE:
+            badging = ActionType.JOIN in ActionType.unread_dm_types()
+        else:
+            badging = ActionType.JOIN in ActionType.unread_types()
+
+        timestamp = Time.now()
+        if badging:
+            sql = """
+                UPDATE room SET `badge_seq` = LAST_INSERT_ID(`badge_seq` + :count), `last_action` = GREATEST(`last_action`, :ts)
+                WHERE `id` = :roomid
+            """
+            cursor = self.execute(sql, {"roomid": roomid, "count": len(occupants), "ts": timestamp})
+            if cursor.rowcount == 1:
+                badge_seq = int(cursor.lastrowid) - len(occupants)
+
+        firstid: Optional[int] = None
+        for start in range(0, len(occupants), JOIN_ACTION_BATCH_SIZE):
+            params: Dict[str, object] = {"roomid": roomid, "ts": timestamp, "action": ActionType.JOIN, "details": json.dumps({})}
+            values: List[str] = []
+            for i, (occupantid, _) in enumerate(occupants[start:(start + JOIN_ACTION_BATCH_SIZE)]):
+                if badging:
+                    badge_seq += 1
+                values.append(f"(:roomid, :ts, :oid{i}, :action, :details, :seq{i})")
+                params[f"oid{i}"] = occupantid
+                params[f"seq{i}"] = badge_seq
+
+            sql = "INSERT INTO action (`room_id`, `timestamp`, `occupant_id`, `action`, `details`, `badge_seq`) VALUES " + ", ".join(values)
+            cursor = self.execute(sql, params)
+            if firstid is None:
+                # For a multi-row insert, this is the ID of the first row that was inserted.
+                firstid = int(cursor.lastrowid)
+
+        sql = "SELECT MAX(id) AS id FROM action WHERE room_id = :roomid"
+        cursor = self.execute(sql, {"roomid": roomid})
+        result = cursor.mappings().fetchone()
+        lastid = ActionID(result['id'])
+
+        # Keep the room's bounds up to date, in the same manner as insert_action.
+        sql = """
+            UPDATE room SET
+                `first_action_id` = LEAST(COALESCE(`first_action_id`, :firstid), :firstid),
+                `last_action_id` = GREATEST(COALESCE(`last_action_id`, 0), :lastid)
+            WHERE `id` = :roomid
+        """
+        self.execute(sql, {"roomid": roomid, "firstid": firstid, "lastid": lastid})
+
+        # Let the message pump know about the whole batch at once, rather than once per action.
+        userids = [userid for _, userid in occupants]
+        self.after_commit(lambda: event_bus.publish_action(roomid, lastid))
+        self.after_commit(lambda: event_bus.publish_users(userids))
+
     def leave_room(self, roomid: RoomID, userid: UserID) -> None:
         """
         Given a room to leave and a user who wants to leave, try leaving that room.
@@ -568,24 +765,27 @@ class RoomData(BaseData):
         if userid == NewUserID or roomid == NewRoomID:
             return
 
-        # insert_action will ignore actions for anyone already out of the room.
-        occupant = Occupant(
-            occupantid=NewOccupantID,
-            userid=userid,
-        )
-        action = Action(
-            actionid=NewActionID,
-            timestamp=Time.now(),
-            occupant=occupant,
-            action=ActionType.LEAVE,
-            details={},
-        )
-        self.insert_action(roomid, action)
+        # Do this in one transaction so that nobody notified about the leave action sees the
+        # user as still being in the room.
+        with self.transaction():
+            # insert_action will ignore actions for anyone already out of the room.
+            occupant = Occupant(
+                occupantid=NewOccupantID,
+                userid=userid,
+            )
+            action = Action(
+                actionid=NewActionID,
+                timestamp=Time.now(),
+                occupant=occupant,
+                action=ActionType.LEAVE,
+                details={},
+            )
+            self.insert_action(roomid, action)
 
-        sql = """
-            UPDATE occupant SET inactive = TRUE WHERE `user_id` = :userid AND `room_id` = :roomid
-        """
-        self.execute(sql, {"userid": userid, "roomid": roomid})
+            sql = """
+                UPDATE occupant SET inactive = TRUE WHERE `user_id` = :userid AND `room_id` = :roomid
+            """
+            self.execute(sql, {"userid": userid, "roomid": roomid})
 
     def grant_room_moderator(self, roomid: RoomID, userid: UserID) -> None:
         """
@@ -778,6 +978,7 @@ class RoomData(BaseData):
             UPDATE room SET name = :name, topic = :topic, icon = :iconid, moderated = :moderated WHERE id = :roomid
         """
         self.execute(sql, {"roomid": room.id, "name": room.name, "topic": room.topic, "iconid": iconid, "moderated": room.moderated})
+        index_search_terms(self, SEARCH_KIND_ROOM, room.id, [room.name])
 
         if userid == NewUserID:
             occupant = None
@@ -876,6 +1077,53 @@ class RoomData(BaseData):
         cursor = self.execute(sql, {"roomid": roomid})
         return [self.__to_occupant(o) for o in cursor.mappings()]
 
+    def get_room_occupants_many(self, room_ids: List[RoomID], include_left: bool = False) -> Dict[RoomID, List[Occupant]]:
+        """
+        Given a list of room IDs, look up all occupants of each of those rooms and their names
+        and avatars in one go.
+
+        Parameters:
+            room_ids - The IDs of the rooms that we want occupants for.
+            include_left - Whether to include occupants that have since left each room.
+
+        Returns:
+            A dictionary keyed by room ID of the occupants in that room. Every requested room is
+            present, even if it has no occupants.
+        """
+        room_ids = [r for r in room_ids if r != NewRoomID]
+        if not room_ids:
+            return {}
+
+        if include_left:
+            extra = ""
+        else:
+            extra = "AND occupant.inactive != TRUE"
+
+        sql = f"""
+            SELECT
+                occupant.id AS id,
+                occupant.user_id AS user_id,
+                occupant.room_id AS room_id,
+                occupant.nickname AS onick,
+                occupant.inactive AS inactive,
+                occupant.moderator AS moderator,
+                occupant.muted AS muted,
+                occupant.icon AS oicon,
+                profile.nickname AS pnick,
+                profile.icon AS picon,
+                user.username AS unick,
+                user.permissions AS permissions
+            FROM occupant
+            LEFT JOIN profile ON occupant.user_id = profile.user_id
+            LEFT JOIN user ON occupant.user_id = user.id
+            WHERE occupant.room_id IN :room_ids {extra}
+        """
+        cursor = self.execute(sql, {"room_ids": room_ids})
+        retval: Dict[RoomID, List[Occupant]] = {rid: [] for rid in room_ids}
+        for o in cursor.mappings():
+            retval[RoomID(o['room_id'])].append(self.__to_occupant(o))
+        return retval
+
     def get_room_occupant(self, occupantid: OccupantID) -> Optional[Occupant]:
         """
         Given an occupant ID, look up that occupant. Note that this will return occupants
@@ -887,6 +1135,9 @@ class RoomData(BaseData):
         if occupantid == NewOccupantID:
             return None
 
+        return self.cached("occupant", occupantid, lambda: self.__fetch_room_occupant(occupantid))
+
+    def __fetch_room_occupant(self, occupantid: OccupantID) -> Optional[Occupant]:
         sql = """
             SELECT
                 occupant.id AS id,
@@ -912,6 +1163,64 @@ class RoomData(BaseData):
         result = cursor.mappings().fetchone()
         return self.__to_occupant(result)
 
+    def is_room_member(self, roomid: RoomID, userid: UserID) -> bool:
+        """
+        Given a room ID and a user ID, figure out whether that user is currently in that room.
+        This is a single lookup against the user/room unique key, so it is cheap enough to
+        use for authorizing every request.
+
+        Parameters:
+            roomid - The ID of the room we're checking.
+            userid - The ID of the user we're checking.
+
+        Returns:
+            True if the user is in the room and hasn't left, False otherwise.
+        """
+        return self.get_membership(roomid, userid) is not None
+
+    def get_membership(self, roomid: RoomID, userid: UserID) -> Optional[Occupant]:
+        """
+        Given a room ID and a user ID, look up that user's occupant in the room if they're
+        currently in it. Like is_room_member, this uses the user/room unique key.
+
+        Parameters:
+            roomid - The ID of the room we're checking.
+            userid - The ID of the user we're checking.
+
+        Returns:
+            The Occupant for the user in the room, or None if they aren't in the room.
+        """
+        if roomid == NewRoomID or userid == NewUserID:
+            return None
+
+        return self.cached("membership", (roomid, userid), lambda: self.__fetch_membership(roomid, userid))
+
+    def __fetch_membership(self, roomid: RoomID, userid: UserID) -> Optional[Occupant]:
+        sql = """
+            SELECT
+                occupant.id AS id,
+                occupant.user_id AS user_id,
+                occupant.nickname AS onick,
+                occupant.inactive AS inactive,
+                occupant.moderator AS moderator,
+                occupant.muted AS muted,
+                occupant.icon AS oicon,
+                profile.nickname AS pnick,
+                profile.icon AS picon,
+                user.username AS unick,
+                user.permissions AS permissions
+            FROM occupant
+            LEFT JOIN profile ON occupant.user_id = profile.user_id
+            LEFT JOIN user ON occupant.user_id = user.id
+            WHERE occupant.user_id = :userid AND occupant.room_id = :roomid AND occupant.inactive != TRUE
+        """
+        cursor = self.execute(sql, {"userid": userid, "roomid": roomid})
+        if cursor.rowcount != 1:
+            return None
+
+        result = cursor.mappings().fetchone()
+        return self.__to_occupant(result)
+
     def get_last_action(self) -> Optional[ActionID]:
         """
         Gets the last action that was performed for this entire application.
@@ -933,6 +1242,7 @@ class RoomData(BaseData):
         before: Optional[ActionID] = None,
         after: Optional[ActionID] = None,
         limit: Optional[int] = None,
+        types: Optional[Iterable[ActionType]] = None,
     ) -> List[Action]:
         """
         Given a room ID, and possibly a pagination offset, fetch recent room history.
@@ -940,9 +1250,13 @@ class RoomData(BaseData):
         Parameters:
             before - Optional ActionID that we should fetch actions before.
             after - Optional ActionID that we should fetch actions after.
+            limit - Optional maximum number of actions to fetch. If only after is given, this
+                    picks the actions right after it, otherwise the actions right before
+                    before (or the newest actions in the room if neither is given).
+            types - Optional collection of action types to restrict the history to.
 
         Returns:
-            list of Action objects representing actions taken in the room.
+            list of Action objects representing actions taken in the room, newest first.
         """
         if roomid == NewRoomID:
             return []
@@ -953,19 +1267,31 @@ class RoomData(BaseData):
             limitclauses += " AND id < :before"
         if after:
             limitclauses += " AND id > :after"
+        typelist: Optional[List[str]] = None
+        if types is not None:
+            typelist = [str(t) for t in types]
+            if not typelist:
+                return []
+            limitclauses += " AND action IN :types"
 
         querylimit = ""
         if limit:
             querylimit = " LIMIT :limit"
 
+        # When paging forward from an action, we want the ones closest to it, which means walking
+        # the index in the other direction. Either way, callers always get history newest first.
+        forwards = bool(after and not before and limit)
+
         sql = f"""
             SELECT id, timestamp, occupant_id, action, details
             FROM action
             WHERE room_id = :roomid {limitclauses}
-            ORDER BY id DESC {querylimit}
+            ORDER BY id {'ASC' if forwards else 'DESC'} {querylimit}
         """
-        cursor = self.execute(sql, {"roomid": roomid, "limit": limit, "before": before, "after": after})
+        cursor = self.execute(sql, {"roomid": roomid, "limit": limit, "before": before, "after": after, "types": typelist})
         data = [x for x in cursor.mappings()]
+        if forwards:
+            data.reverse()
 
         if not data:
             return []
@@ -1010,20 +1336,6 @@ class RoomData(BaseData):
             for x in data
         ]
 
-    @contextlib.contextmanager
-    def lock_actions(self) -> Iterator[None]:
-        """
-        Locks the actions table for exclusive write, when needing to attach data to a new
-        attachment without other clients polling incomplete actions. Use in a with block.
-        """
-        sql = "LOCK TABLES room WRITE, action WRITE, occupant READ, profile READ, user READ"
-        self.execute(sql, {})
-        try:
-            yield
-        finally:
-            sql = "UNLOCK TABLES"
-            self.execute(sql, {})
-
     def insert_action(self, roomid: RoomID, action: Action) -> None:
         """
         Given a room ID and an action, insert that action into the room's history.
@@ -1032,6 +1344,14 @@ class RoomData(BaseData):
             roomid - ID of the room that the action should go into.
             action - The action itself that should be added.
         """
+        # Bumping the room's badge sequence and inserting the action have to happen as one unit,
+        # with the room row locked until the action is committed. Otherwise two actions inserted
+        # at once can end up with badge sequences in the opposite order to their IDs, and marking
+        # the newer one as seen would leave a badge behind.
+        with self.atomic():
+            self.__insert_action(roomid, action)
+
+    def __insert_action(self, roomid: RoomID, action: Action) -> None:
         if roomid == NewRoomID:
             raise Exception("Logic error, should not try to insert an action to a new room ID!")
 
@@ -1045,14 +1365,12 @@ class RoomData(BaseData):
                 return
 
             # First, find the occupant ID.
-            sql = "SELECT id FROM occupant WHERE room_id = :roomid AND user_id = :userid AND inactive != TRUE LIMIT 1"
-            cursor = self.execute(sql, {"roomid": roomid, "userid": action.occupant.userid})
-            if cursor.rowcount != 1:
+            membership = self.get_membership(roomid, action.occupant.userid)
+            if membership is None:
                 # Trying to insert an action and we're not in the room?
                 return
 
-            result = cursor.mappings().fetchone()
-            occupant = result['id']
+            occupant = membership.id
 
             if action.occupant.id != NewOccupantID:
                 if action.occupant.id != OccupantID(occupant):
@@ -1064,10 +1382,12 @@ class RoomData(BaseData):
                 # Cannot insert this action type without an occupant to link to.
                 return
 
+            membership = None
             occupant = None
 
-        # Now, figure out the room type for last action calculations.
-        sql = "SELECT purpose FROM room WHERE id = :roomid"
+        # Now, figure out the room type for last action and badge calculations. This locks the room
+        # so that actions which don't badge also see every badging action inserted before them.
+        sql = "SELECT purpose, badge_seq FROM room WHERE id = :roomid FOR UPDATE"
         cursor = self.execute(sql, {"roomid": roomid})
         if cursor.rowcount != 1:
             # Trying to insert an action and the room doesn't exist?
@@ -1075,40 +1395,100 @@ class RoomData(BaseData):
 
         result = cursor.mappings().fetchone()
         purpose = self._get_purpose(result['purpose'])
+        badge_seq = int(result['badge_seq'])
+
+        if purpose == RoomPurpose.DIRECT_MESSAGE:
+            types = ActionType.unread_dm_types()
+        else:
+            types = ActionType.unread_types()
+
+        # If this is an action that causes badging, bump the room's badge sequence and record the
+        # action timestamp into the room. We use LAST_INSERT_ID() so we get the incremented value
+        # back from this same statement even if somebody else is inserting at the same time.
+        if action.action in types:
+            sql = """
+                UPDATE room SET `badge_seq` = LAST_INSERT_ID(`badge_seq` + 1), `last_action` = GREATEST(`last_action`, :ts)
+                WHERE `id` = :roomid
+            """
+            cursor = self.execute(sql, {"roomid": roomid, "ts": action.timestamp})
+            if cursor.rowcount == 1:
+                badge_seq = int(cursor.lastrowid)
 
-        # Now, attempt to insert the action itself.
+        # Now, attempt to insert the action itself, remembering where the badge sequence was
+        # at so that marking this action as seen knows how many badging actions that covers.
         sql = """
             INSERT INTO action
-                (`room_id`, `timestamp`, `occupant_id`, `action`, `details`)
+                (`room_id`, `timestamp`, `occupant_id`, `action`, `details`, `badge_seq`)
             VALUES
-                (:roomid, :ts, :oid, :action, :details)
+                (:roomid, :ts, :oid, :action, :details, :seq)
         """
         cursor = self.execute(sql, {
-            "roomid": roomid, "ts": action.timestamp, "oid": occupant, "action": action.action, "details": json.dumps(action.details)
+            "roomid": roomid, "ts": action.timestamp, "oid": occupant, "action": action.action, "details": json.dumps(action.details), "seq": badge_seq,
         })
         if cursor.rowcount != 1:
             return
 
         # Hydrate what we've just persisted.
         action.id = ActionID(cursor.lastrowid)
-        if action.occupant and occupant is not None:
-            action.occupant.id = OccupantID(occupant)
 
-            # Now, hydrate the occupant itself so the nickname is present on the response.
-            newoccupant = self.get_room_occupant(action.occupant.id)
-            if newoccupant:
-                action.occupant.nickname = newoccupant.nickname
-                action.occupant.inactive = newoccupant.inactive
-                action.occupant.iconid = newoccupant.iconid
-
-        if purpose == RoomPurpose.DIRECT_MESSAGE:
-            types = ActionType.unread_dm_types()
-        else:
-            types = ActionType.unread_types()
+        # Keep the room's bounds up to date so that loading rooms never has to aggregate over the
+        # action table. This is written so that concurrent inserts can only ever widen the bounds.
+        sql = """
+            UPDATE room SET
+                `first_action_id` = LEAST(COALESCE(`first_action_id`, :actionid), :actionid),
+                `last_action_id` = GREATEST(COALESCE(`last_action_id`, 0), :actionid)
+            WHERE `id` = :roomid
+        """
+        self.execute(sql, {"roomid": roomid, "actionid": action.id})
+
+        # Let the message pump know about this action as soon as other connections can see it.
+        # Joins and leaves also change the user's room list, so let their sessions know too.
+        actionid = action.id
+        self.after_commit(lambda: event_bus.publish_action(roomid, actionid))
+        if action.action in {ActionType.JOIN, ActionType.LEAVE} and action.occupant:
+            joinerid = action.occupant.userid
+            self.after_commit(lambda: event_bus.publish_user(joinerid))
+        if action.occupant and membership is not None:
+            action.occupant.id = membership.id
+
+            # Now, hydrate the occupant itself so the nickname is present on the response. Inserting
+            # an action doesn't change the occupant, so what we looked up above is still current.
+            action.occupant.nickname = membership.nickname
+            action.occupant.inactive = membership.inactive
+            action.occupant.iconid = membership.iconid
+
+    def rebuild_badge_sequences(self) -> None:
+        """
+        Recompute every action's and room's badge sequence from scratch, based on the history of
+        badging actions in each room. The badge sequences are maintained by insert_action, so this
+        only needs to be run if they somehow get out of sync with the action history.
+        """
+        # Number every action with the running count of badging actions in its room. Which
+        # actions cause a badge depends on the room's purpose, so pick the type list per row.
+        sql = """
+            UPDATE action
+            JOIN (
+                SELECT
+                    action.id AS id,
+                    SUM(
+                        CASE WHEN
+                            (room.purpose = :dm AND action.action IN :dmtypes) OR
+                            (room.purpose != :dm AND action.action IN :types)
+                        THEN 1 ELSE 0 END
+                    ) OVER (PARTITION BY action.room_id ORDER BY action.id) AS seq
+                FROM action
+                JOIN room ON room.id = action.room_id
+            ) AS sequenced ON sequenced.id = action.id
+            SET action.badge_seq = sequenced.seq
+        """
+        self.execute(sql, {
+            "dm": RoomPurpose.DIRECT_MESSAGE,
+            "types": [str(t) for t in ActionType.unread_types()],
+            "dmtypes": [str(t) for t in ActionType.unread_dm_types()],
+        })
 
-        # Finally, record the action timestamp into the room if it is an action that causes badging.
-        if action.action in types:
-            sql = """
-                UPDATE room SET `last_action` = :ts WHERE `id` = :roomid AND `last_action` < :ts
-            """
-            self.execute(sql, {"roomid": roomid, "ts": action.timestamp})
+        # Now, each room's sequence is just where its newest action left off.
+        sql = """
+            UPDATE room SET badge_seq = COALESCE((SELECT MAX(action.badge_seq) FROM action WHERE action.room_id = room.id), 0)
+        """
+        self.execute(sql, {})
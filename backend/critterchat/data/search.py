@@ -0,0 +1,134 @@
+from sqlalchemy import Table, Column, Index
+from sqlalchemy.types import String, Integer
+from typing import Dict, Final, Iterable, List, Optional, Tuple
+
+from .base import BaseData, metadata
+
+"""
+Table representing a search index over room names, usernames and nicknames. Every suffix of each
+name is stored lowercased along with the position it starts at, so that a substring search becomes
+an indexed prefix search over the terms, and a term at position zero means the name itself starts
+with what was searched for.
+"""
+search_term = Table(
+    "search_term",
+    metadata,
+    Column("id", Integer, nullable=False, primary_key=True, autoincrement=True),
+    Column("kind", String(8), nullable=False),
+    Column("target_id", Integer, nullable=False),
+    Column("term", String(64), nullable=False),
+    Column("position", Integer, nullable=False),
+    Index("ix_search_term_kind_position_term", "kind", "position", "term"),
+    Index("ix_search_term_kind_term_target_id", "kind", "term", "target_id"),
+    Index("ix_search_term_kind_target_id", "kind", "target_id"),
+    mysql_charset="utf8mb4",
+)
+
+
+# What a search term belongs to.
+SEARCH_KIND_ROOM: Final[str] = "room"
+SEARCH_KIND_USER: Final[str] = "user"
+
+# The longest term we store, and also how far into a name we'll find a match. Names are short
+# enough that this covers nearly everything, and searches for longer strings are still correct
+# since callers check the actual names of whatever we find.
+SEARCH_TERM_LENGTH: Final[int] = 64
+
+
+def get_search_terms(names: Iterable[Optional[str]]) -> List[Tuple[str, int]]:
+    """
+    Given the names that something should be found by, return every term to index it under.
+
+    Returns:
+        A list of tuples of the term and the earliest position it was found at.
+    """
+    terms: Dict[str, int] = {}
+    for name in names:
+        if not name:
+            continue
+
+        name = name.lower()
+        for position in range(min(len(name), SEARCH_TERM_LENGTH)):
+            term = name[position:(position + SEARCH_TERM_LENGTH)]
+            if term not in terms or terms[term] > position:
+                terms[term] = position
+
+    return list(terms.items())
+
+
+def get_search_prefix(name: str) -> str:
+    """
+    Given something a user typed into search, return a LIKE pattern for the terms that match it.
+    """
+    name = name.lower()[:SEARCH_TERM_LENGTH]
+    for char in ("\\", "%", "_"):
+        name = name.replace(char, "\\" + char)
+    return name + "%"
+
+
+def index_search_terms(data: BaseData, kind: str, targetid: int, names: Iterable[Optional[str]]) -> None:
+    """
+    Replace the search terms for a room or user with ones for its current names. This is called
+    by the data layer whenever a name changes, so the index never needs rebuilding in practice.
+
+    Parameters:
+        data - The data object to run the queries with.
+        kind - Either SEARCH_KIND_ROOM or SEARCH_KIND_USER.
+        targetid - The ID of the room or user.
+        names - Every name that the room or user should be found by.
+    """
+
+    sql = """
+        DELETE FROM search_term WHERE `kind` = :kind AND `target_id` = :targetid
+    """
+    data.execute(sql, {"kind": kind, "targetid": targetid})
+
+    terms = get_search_terms(names)
+    if not terms:
+        return
+
+    params: Dict[str, object] = {"kind": kind, "targetid": targetid}
+    values: List[str] = []
+    for i, (term, position) in enumerate(terms):
+        values.append(f"(:kind, :targetid, :term{i}, :position{i})")
+        params[f"term{i}"] = term
+        params[f"position{i}"] = position
+
+    sql = "INSERT INTO search_term (`kind`, `target_id`, `term`, `position`) VALUES " + ", ".join(values)
+    data.execute(sql, params)
+
+
+class SearchData(BaseData):
+    def rebuild_search_index(self) -> Tuple[int, int]:
+        """
+        Throw away the search index and rebuild it from every room and user. The index is maintained
+        whenever a name changes, so this only needs to be run if it somehow gets out of sync.
+
+        Returns:
+            A tuple of the number of rooms and users that were indexed.
+        """
+
+        sql = """
+            DELETE FROM search_term
+        """
+        self.execute(sql, {})
+
+        sql = """
+            SELECT id, name FROM room WHERE name IS NOT NULL AND name != ''
+        """
+        cursor = self.execute(sql, {})
+        rooms = [(int(result['id']), str(result['name'])) for result in cursor.mappings()]
+        for roomid, name in rooms:
+            index_search_terms(self, SEARCH_KIND_ROOM, roomid, [name])
+
+        sql = """
+            SELECT user.id AS id, user.username AS username, profile.nickname AS nickname
+            FROM user
+            LEFT JOIN profile ON profile.user_id = user.id
+        """
+        cursor = self.execute(sql, {})
+        users = [(int(result['id']), str(result['username']), result['nickname']) for result in cursor.mappings()]
+        for userid, username, nickname in users:
+            index_search_terms(self, SEARCH_KIND_USER, userid, [username, nickname])
+
+        return len(rooms), len(users)
@@ -193,6 +193,26 @@ class MetadataType(StrEnum):
     ALT_TEXT = 'alt_text'
     SENSITIVE = 'sensitive'
 
+    # Internal bookkeeping for the downscaled variants generated for an image. This is never
+    # sent to clients as-is, it's turned into a list of AttachmentVariant instead.
+    VARIANTS = 'variants'
+
+
+class AttachmentVariant:
+    def __init__(self, uri: str, mimetype: str, width: int, height: int) -> None:
+        self.uri = uri
+        self.mimetype = mimetype
+        self.width = width
+        self.height = height
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "uri": self.uri,
+            "mimetype": self.mimetype,
+            "width": self.width,
+            "height": self.height,
+        }
+
 
 class Attachment:
     def __init__(
@@ -200,11 +220,13 @@ class Attachment:
         uri: str,
         mimetype: str,
         metadata: Dict[MetadataType, object],
+        variants: Optional[List[AttachmentVariant]] = None,
     ) -> None:
         self.id = attachmentid
         self.uri = uri
         self.mimetype = mimetype
         self.metadata = metadata
+        self.variants = variants or []
 
     def to_dict(self) -> Dict[str, object]:
         return {
@@ -214,6 +236,7 @@ class Attachment:
             "uri": self.uri,
             "mimetype": self.mimetype,
             "metadata": self.metadata,
+            "variants": [v.to_dict() for v in self.variants],
         }
 
     @staticmethod
@@ -5,13 +5,16 @@ from sqlalchemy import Table, Column
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.types import Boolean, String, Integer
 from sqlalchemy.dialects.mysql import MEDIUMTEXT as MediumText
-from typing import Any, Final, List, Optional, Tuple
+from typing import Any, Dict, Final, List, Optional, Tuple
 from passlib.hash import pbkdf2_sha512  # type: ignore
 
 from ..common import Time
 from .base import BaseData, metadata
+from .cache import session_cache
+from .events import event_bus
+from .lastseen import last_seen_buffer
+from .search import SEARCH_KIND_USER, get_search_prefix, index_search_terms
 from .types import (
-    ActionType,
     RoomPurpose,
     User,
     UserPreferences,
@@ -112,6 +115,7 @@ lastseen = Table(
     Column("user_id", Integer, nullable=False),
     Column("room_id", Integer, nullable=False),
     Column("action_id", Integer, nullable=False),
+    Column("badge_seq", Integer, nullable=False),
     UniqueConstraint("user_id", "room_id", name='uidrid'),
     mysql_charset="utf8mb4",
 )
@@ -122,6 +126,7 @@ class UserData(BaseData):
     RECOVERY_LENGTH: Final[int] = 12
     INVITE_LENGTH: Final[int] = 6
     PASSWORD_SALT_LENGTH: Final[int] = 32
+    LAST_SEEN_BATCH_SIZE: Final[int] = 250
 
     SESSION_TYPE_LOGIN: Final[str] = "login"
     SESSION_TYPE_RECOVERY: Final[str] = "recovery"
@@ -246,9 +251,14 @@ class UserData(BaseData):
         Returns:
             User as a class if found, or None if the session is expired or doesn't exist.
         """
+        # Every socket event validates its session, so check the process-wide cache first.
+        user = session_cache.get(session)
+        if user is not None:
+            return user
+
         # Look up the user account, making sure to expire old sessions
         now = Time.now()
-        sql = "SELECT id FROM session WHERE session = :session AND type = :type AND expiration > :timestamp"
+        sql = "SELECT id, expiration FROM session WHERE session = :session AND type = :type AND expiration > :timestamp"
         cursor = self.execute(sql, {"session": session, "type": self.SESSION_TYPE_LOGIN, "timestamp": now})
         if cursor.rowcount != 1:
             # Possibly expired, so let's delete any expired ones.
@@ -258,7 +268,10 @@ class UserData(BaseData):
             return None
 
         result = cursor.mappings().fetchone()
-        return self.get_user(UserID(result["id"]))
+        user = self.get_user(UserID(result["id"]))
+        if user is not None:
+            session_cache.put(session, user, int(result["expiration"]) - now)
+        return user
 
     def from_recovery(self, recovery: str) -> Optional[User]:
         """
@@ -448,10 +461,22 @@ class UserData(BaseData):
         Parameters:
             session - A session string as returned from create_session.
         """
+        # Find out who this belonged to, so their connected clients can be told to log out.
+        sql = "SELECT id FROM session WHERE session = :session AND type = :sesstype"
+        cursor = self.execute(sql, {"session": session, "sesstype": self.SESSION_TYPE_LOGIN})
+        result = cursor.mappings().fetchone() if cursor.rowcount == 1 else None
+
         # Remove the session token
         sql = "DELETE FROM session WHERE session = :session AND type = :sesstype"
         self.execute(sql, {"session": session, "sesstype": self.SESSION_TYPE_LOGIN})
 
+        # Only forget the cached session once the delete is visible to everybody, otherwise another
+        # request could cache it again from the old row and keep it alive until it expires.
+        self.after_commit(lambda: session_cache.invalidate_session(session))
+        if result is not None:
+            loggedout = UserID(result["id"])
+            self.after_commit(lambda: event_bus.publish_user(loggedout))
+
         sql = "DELETE FROM settings WHERE session = :session"
         self.execute(sql, {"session": session})
 
@@ -490,6 +515,7 @@ class UserData(BaseData):
         cursor = self.execute(sql, {"hash": passhash, "salt": salt, "username": username})
         if cursor.rowcount != 1:
             return None
+        index_search_terms(self, SEARCH_KIND_USER, cursor.lastrowid, [username])
         return self.get_user(UserID(cursor.lastrowid))
 
     def get_settings(self, session: str) -> Optional[UserSettings]:
@@ -641,6 +667,8 @@ class UserData(BaseData):
             "audio_notifs": audio_notifs,
             "ts": Time.now()
         })
+        prefsuserid = preferences.userid
+        self.after_commit(lambda: event_bus.publish_user(prefsuserid))
 
     def __to_user(self, result: Any) -> User:
         """
@@ -672,6 +700,9 @@ class UserData(BaseData):
         if userid == NewUserID:
             return None
 
+        return self.cached("user", userid, lambda: self.__fetch_user(userid))
+
+    def __fetch_user(self, userid: UserID) -> Optional[User]:
         sql = """
             SELECT user.id AS id, user.username AS uname, user.permissions AS permissions, profile.nickname AS pname, profile.about AS about, profile.icon AS icon
             FROM user
@@ -726,6 +757,7 @@ class UserData(BaseData):
             `nickname` = :name, `about` = :about, `icon` = :iconid, `timestamp` = :ts
         """
         self.execute(sql, {"userid": user.id, "name": nickname, "about": user.about, "iconid": iconid, "ts": Time.now()})
+        index_search_terms(self, SEARCH_KIND_USER, user.id, [user.username, nickname])
 
         permissions: int = 0
         for perm in user.permissions:
@@ -736,6 +768,12 @@ class UserData(BaseData):
         """
         self.execute(sql, {"userid": user.id, "perms": permissions})
 
+        # Same as with destroying sessions, the cached copies can only be thrown away once the
+        # update has been committed, and before anybody is told to go look at it.
+        updateduserid = user.id
+        self.after_commit(lambda: session_cache.invalidate_user(updateduserid))
+        self.after_commit(lambda: event_bus.publish_user(updateduserid))
+
     def get_users(self, name: Optional[str] = None) -> List[User]:
         """
         Return a list of all users on the network.
@@ -759,141 +797,205 @@ class UserData(BaseData):
 
         return users
 
-    def get_visible_users(self, userid: UserID, name: Optional[str] = None) -> List[User]:
+    def search_visible_users(self, userid: UserID, name: str, limit: int) -> List[User]:
         """
-        Given a user searching, return a list of visible users (users that haven't blocked the
-        user, etc). If the name is specified, returns all users with that name.
+        Given a user searching, look up activated users whose username or nickname contains the
+        search criteria, using the search index. Users with a name that starts with the criteria
+        come first, in alphabetical order, followed by any others. An empty search matches every
+        activated user.
+
+        Parameters:
+            userid - The ID of the user that is searching.
+            name - The text to search usernames and nicknames for.
+            limit - The maximum number of users to return.
+
+        Returns:
+            list of User objects representing the matching users.
         """
         if userid == NewUserID:
             return []
 
-        sql = """
-            SELECT user.id AS id, user.username AS uname, user.permissions AS permissions, profile.nickname AS pname, profile.about AS about, profile.icon AS icon
-            FROM user
-            LEFT JOIN profile ON profile.user_id = user.id
-            WHERE user.id = :myid
-        """
+        users: Dict[UserID, User] = {}
+        for infix in [False, True]:
+            remaining = limit - len(users)
+            if remaining <= 0:
+                break
+
+            # A user can start with the criteria by both username and nickname, and anybody we
+            # already found that way may turn up again by infix, so ask for enough extra to fill
+            # the limit regardless.
+            fetch = (remaining + len(users)) if infix else (remaining * 2)
+
+            sql = f"""
+                SELECT {'DISTINCT' if infix else ''}
+                    user.id AS id, user.username AS uname, user.permissions AS permissions,
+                    profile.nickname AS pname, profile.about AS about, profile.icon AS icon
+                FROM search_term
+                JOIN user ON user.id = search_term.target_id
+                LEFT JOIN profile ON profile.user_id = user.id
+                WHERE search_term.kind = :kind AND search_term.position {'>' if infix else '='} 0 AND search_term.term LIKE :prefix
+                AND (user.permissions & :activated) = :activated
+                {'' if infix else 'ORDER BY search_term.term'}
+                LIMIT :limit
+            """
+            cursor = self.execute(sql, {
+                "kind": SEARCH_KIND_USER,
+                "prefix": get_search_prefix(name),
+                "activated": UserPermission.ACTIVATED,
+                "limit": fetch,
+            })
+            for result in cursor.mappings():
+                user = self.__to_user(result)
+                if user.id not in users and len(users) < limit:
+                    users[user.id] = user
+
+        return list(users.values())
 
-        if name is not None:
-            sql += " OR (user.username COLLATE utf8mb4_general_ci LIKE :name OR profile.nickname COLLATE utf8mb4_general_ci LIKE :name)"
-        cursor = self.execute(sql, {"myid": userid, "name": f"%{name}%"})
-        users = [self.__to_user(u) for u in cursor.mappings()]
+    def mark_last_seen(self, userid: UserID, roomid: RoomID, actionid: ActionID) -> None:
+        """
+        Given a user, a room they're in and an action they've seen, mark this action as
+        having been seen by this user for this room. This writes the marker right away, so
+        use buffer_last_seen instead for markers coming from clients.
+        """
 
-        # Post-filter by users who are activated, so we don't display deactivated users.
-        users = [u for u in users if UserPermission.ACTIVATED in u.permissions]
+        if userid == NewUserID or roomid == NewRoomID or actionid == NewActionID:
+            return
 
-        # Post-filter by name if requested, so we don't find ourselves all the time.
-        if name:
-            users = [u for u in users if (name in u.username) or (name in u.nickname)]
+        self.__write_last_seen({(userid, roomid): actionid})
 
-        return users
+        # Other sessions for this user will want to clear their badges.
+        self.after_commit(lambda: event_bus.publish_user(userid))
 
-    def mark_last_seen(self, userid: UserID, roomid: RoomID, actionid: ActionID) -> None:
+    def buffer_last_seen(self, userid: UserID, roomid: RoomID, actionid: ActionID) -> None:
         """
-        Given a user, a room they're in and an action they've seen, mark this action as
-        having been seen by this user for this room.
+        Given a user, a room they're in and an action they've seen, remember that this action
+        was seen without writing it yet. Clients mark actions as seen as they scroll into view,
+        so these are coalesced and written out in batches by flush_last_seen.
         """
 
         if userid == NewUserID or roomid == NewRoomID or actionid == NewActionID:
             return
 
-        with self.transaction():
-            sql = """
-                SELECT action_id FROM lastseen WHERE user_id = :userid AND room_id = :roomid LIMIT 1
-            """
-            cursor = self.execute(sql, {"userid": userid, "roomid": roomid})
-            if cursor.rowcount != 1:
-                last = ActionID(0)
-            else:
-                result = cursor.mappings().fetchone()
-                last = ActionID(result['action_id'])
-
-            if actionid <= last:
-                # Nothing to do, this is older than our newest message.
-                return
-
-            sql = """
-                INSERT INTO lastseen (`user_id`, `room_id`, `action_id`)
-                VALUES (:userid, :roomid, :actionid)
-                ON DUPLICATE KEY UPDATE
-                `action_id` = :actionid
-            """
-            self.execute(sql, {"userid": userid, "roomid": roomid, "actionid": actionid})
+        last_seen_buffer.mark(userid, roomid, actionid)
+
+    def flush_last_seen(self, userid: Optional[UserID] = None) -> int:
+        """
+        Write out any buffered last seen markers.
+
+        Parameters:
+            userid - Optional ID of a single user to write markers for, such as when they disconnect.
+
+        Returns:
+            The number of markers that were written.
+        """
+
+        marks = last_seen_buffer.drain(userid)
+        if not marks:
+            return 0
+
+        try:
+            self.__write_last_seen(marks)
+        except Exception:
+            # Don't lose markers just because the DB hiccuped, they'll go out with the next flush.
+            last_seen_buffer.restore(marks)
+            raise
+
+        # Other sessions for these users will want to clear their badges.
+        seenuserids = {uid for uid, _ in marks}
+        self.after_commit(lambda: event_bus.publish_users(seenuserids))
+        return len(marks)
+
+    def __write_last_seen(self, marks: Dict[Tuple[UserID, RoomID], ActionID]) -> None:
+        # Markers only ever move forward, so a marker older than what's already stored is left
+        # alone. Each marker also remembers how far into the room's badge sequence the action is,
+        # so that unread counts are a simple subtraction from the room's current sequence. Note
+        # that MySQL applies the update assignments in order, so the badge sequence has to be
+        # updated while action_id still holds the old value. The incoming row is referred to by a
+        # row alias rather than VALUES(), which MySQL deprecated in 8.0.20.
+        items = list(marks.items())
+        for start in range(0, len(items), self.LAST_SEEN_BATCH_SIZE):
+            params: Dict[str, object] = {}
+            values: List[str] = []
+            for i, ((userid, roomid), actionid) in enumerate(items[start:(start + self.LAST_SEEN_BATCH_SIZE)]):
+                values.append(
+                    f"(:userid{i}, :roomid{i}, :actionid{i}, COALESCE(("
+                    f"SELECT COALESCE(badge_seq, 0) FROM action WHERE room_id = :roomid{i} AND id <= :actionid{i} ORDER BY id DESC LIMIT 1"
+                    f"), 0))"
+                )
+                params[f"userid{i}"] = userid
+                params[f"roomid{i}"] = roomid
+                params[f"actionid{i}"] = actionid
+
+            sql = (
+                "INSERT INTO lastseen (`user_id`, `room_id`, `action_id`, `badge_seq`) VALUES " + ", ".join(values) + " AS new "
+                "ON DUPLICATE KEY UPDATE "
+                "`badge_seq` = IF(new.`action_id` > `action_id`, new.`badge_seq`, `badge_seq`), "
+                "`action_id` = GREATEST(`action_id`, new.`action_id`)"
+            )
+            self.execute(sql, params)
 
     def get_last_seen_counts(self, userid: UserID) -> List[Tuple[RoomID, int]]:
         """
-        Given a user, grab all of the last seen room/action counts.
+        Given a user, grab all of the last seen room/action counts. This includes a count for
+        every room the user has a last seen marker in, as well as every room they're in but have
+        never looked at, where every badging action counts as unread.
         """
 
         if userid == NewUserID:
             return []
 
+        # Rooms keep a running sequence of badging actions and last seen markers remember where
+        # in that sequence the user was, so the unread count is just the difference. Rooms that
+        # we were joined to while we were completely gone have every badging action unread.
         sql = """
-            SELECT lastseen.room_id AS room_id, lastseen.action_id AS action_id, room.purpose AS purpose
+            SELECT lastseen.room_id AS room_id, GREATEST(room.badge_seq - lastseen.badge_seq, 0) AS count
             FROM lastseen
             JOIN room ON room.id = lastseen.room_id
-            WHERE user_id = :userid
+            WHERE lastseen.user_id = :userid
+            UNION ALL
+            SELECT occupant.room_id AS room_id, room.badge_seq AS count
+            FROM occupant
+            JOIN room ON room.id = occupant.room_id
+            LEFT JOIN lastseen ON lastseen.user_id = occupant.user_id AND lastseen.room_id = occupant.room_id
+            WHERE occupant.user_id = :userid AND occupant.inactive != TRUE AND lastseen.id IS NULL
         """
         cursor = self.execute(sql, {"userid": userid})
-        counts = [
-            (RoomID(result['room_id']), ActionID(result['action_id']), self._get_purpose(result['purpose']))
-            for result in cursor.mappings()
-        ]
-
-        def hydrate_existing_count(roomid: RoomID, actionid: ActionID, purpose: RoomPurpose) -> int:
-            if purpose == RoomPurpose.DIRECT_MESSAGE:
-                types = list(ActionType.unread_dm_types())
-            else:
-                types = list(ActionType.unread_types())
-
-            sql = """
-                SELECT COUNT(id) AS count FROM action WHERE `room_id` = :roomid AND `id` > :actionid AND `action` IN :types
-            """
-            cursor = self.execute(sql, {"roomid": roomid, "actionid": actionid, "types": types})
-            if cursor.rowcount != 1:
-                return 0
-            result = cursor.mappings().fetchone()
-            return int(result["count"])
-
-        # There's probably a SQL way to do this, but I don't want to bang my head against
-        # it right now, so it can come in a future improvement.
-        computed_counts = [(c[0], hydrate_existing_count(c[0], c[1], c[2])) for c in counts]
-
-        # Now, make sure if we were joined to a room or a chat while we were completely gone
-        # that we still count the actions for that room or chat as well.
-        seen = [c[0] for c in computed_counts]
-        if seen:
-            sql = """
-                SELECT id, purpose FROM room WHERE id NOT IN :seen AND id IN (
-                    SELECT room_id FROM occupant WHERE user_id = :userid AND inactive != TRUE
+        counts = {RoomID(result['room_id']): int(result['count']) for result in cursor.mappings()}
+
+        # Markers that haven't been written out yet can only ever lower the count, so work out
+        # what each one would leave unread and take whichever is lower.
+        pending = last_seen_buffer.pending(userid)
+        if pending:
+            params: Dict[str, object] = {}
+            selects: List[str] = []
+            for i, (roomid, actionid) in enumerate(pending.items()):
+                selects.append(
+                    f"SELECT room.id AS room_id, GREATEST(room.badge_seq - COALESCE(("
+                    f"SELECT COALESCE(badge_seq, 0) FROM action WHERE room_id = :roomid{i} AND id <= :actionid{i} ORDER BY id DESC LIMIT 1"
+                    f"), 0), 0) AS count FROM room WHERE room.id = :roomid{i}"
                 )
-            """
-        else:
-            sql = """
-                SELECT id, purpose FROM room WHERE id IN (
-                    SELECT room_id FROM occupant WHERE user_id = :userid AND inactive != TRUE
-                )
-            """
-        cursor = self.execute(sql, {"seen": seen, "userid": userid})
-        extra_rooms = [(RoomID(result['id']), self._get_purpose(result['purpose'])) for result in cursor.mappings()]
+                params[f"roomid{i}"] = roomid
+                params[f"actionid{i}"] = actionid
 
-        def hydrate_new_count(roomid: RoomID, purpose: RoomPurpose) -> int:
-            if purpose == RoomPurpose.DIRECT_MESSAGE:
-                types = list(ActionType.unread_dm_types())
-            else:
-                types = list(ActionType.unread_types())
+            cursor = self.execute(" UNION ALL ".join(selects), params)
+            for result in cursor.mappings():
+                roomid = RoomID(result['room_id'])
+                count = int(result['count'])
+                counts[roomid] = min(counts.get(roomid, count), count)
 
-            sql = """
-                SELECT COUNT(id) AS count FROM action WHERE `room_id` = :roomid AND `action` IN :types
-            """
-            cursor = self.execute(sql, {"roomid": roomid, "types": types})
-            if cursor.rowcount != 1:
-                return 0
-            result = cursor.mappings().fetchone()
-            return int(result["count"])
+        return list(counts.items())
 
-        computed_counts += [(c[0], hydrate_new_count(c[0], c[1])) for c in extra_rooms]
-        return computed_counts
+    def rebuild_last_seen_sequences(self) -> None:
+        """
+        Recompute where in each room's badge sequence every last seen marker is. This should be
+        run after RoomData.rebuild_badge_sequences so that unread counts stay correct.
+        """
+        sql = """
+            UPDATE lastseen SET badge_seq = COALESCE((
+                SELECT MAX(action.badge_seq) FROM action WHERE action.room_id = lastseen.room_id AND action.id <= lastseen.action_id
+            ), 0)
+        """
+        self.execute(sql, {})
 
     def get_last_seen_actions(self, userid: UserID) -> List[Tuple[RoomID, ActionID]]:
         """
@@ -907,4 +1009,11 @@ class UserData(BaseData):
             SELECT room_id, action_id FROM lastseen WHERE user_id = :userid
         """
         cursor = self.execute(sql, {"userid": userid})
-        return [(RoomID(result['room_id']), ActionID(result['action_id'])) for result in cursor.mappings()]
+        actions = {RoomID(result['room_id']): ActionID(result['action_id']) for result in cursor.mappings()}
+
+        # Include any markers that haven't been written out yet.
+        for roomid, actionid in last_seen_buffer.pending(userid).items():
+            if roomid not in actions or actions[roomid] < actionid:
+                actions[roomid] = actionid
+
+        return list(actions.items())
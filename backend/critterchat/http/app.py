@@ -2,9 +2,11 @@ import hashlib
 import json
 import logging
 import os
+import time
 import traceback
 from functools import wraps
-from typing import Any, Callable, Dict, Optional, cast
+from threading import Lock
+from typing import Any, Callable, Dict, Final, List, Optional, Tuple, cast
 
 from flask import (
     Flask,
@@ -25,6 +27,7 @@ from flask_cors import CORS  # type: ignore
 from ..common import AESCipher
 from ..config import Config
 from ..data import Data, User, UserPermission
+from . import payload
 from .templates import templates_location
 from .static import static_location
 
@@ -63,7 +66,7 @@ class CritterChatFlask(Flask):
 logger = logging.getLogger(__name__)
 app = CritterChatFlask(__name__)
 CORS(app)
-socketio = SocketIO(app, logger=logger, async_mode='gevent', cors_allowed_origins='*')
+socketio = SocketIO(app, logger=logger, async_mode='gevent', cors_allowed_origins='*', json=payload)
 config: Config = Config()
 
 
@@ -99,8 +102,8 @@ def before_request() -> None:
     g.sessionID = None
     g.user = None
 
-    if request.endpoint in {"static"}:
-        # This is just serving cached compiled frontends, skip loading from DB
+    if request.endpoint in {"static", "attachments.get_attachment"}:
+        # This is just serving cached compiled frontends or attachments, skip loading from DB
         return
 
     g.data = Data(config)
@@ -139,6 +142,7 @@ def after_request(response: Response) -> Response:
 def teardown_request(exception: Any) -> None:
     data = getattr(g, "data", None)
     if data is not None:
+        logger.debug(f"{request.endpoint} ran {data.query_count} queries with {data.cache_hits} cache hits")
         data.close()
 
 
@@ -189,36 +193,103 @@ FINGERPRINT_INCLUDE_FILES = [
 ]
 
 
-def get_fingerprint_hash() -> str:
-    # Intentionally not caching, because if we cache this but not the below chat.js,
-    # then on deploy users might get two notifications for an update instead of one
-    # depending on how fast the deploy happens.
+class FrontendManifest:
+    """
+    The built frontend's asset manifest along with a fingerprint of the CSS that goes with it,
+    which together determine the cache-busting version that clients compare against to know
+    when to reload. Both are loaded together and only reloaded once the files on disk change,
+    so rendering a page or answering a version poll only costs a handful of stat calls.
+    """
+
+    # How long the files must go unmodified before we pick up changes to them. A deploy writes
+    # the manifest and CSS one after another, so if we reloaded partway through then clients
+    # would see one version for the new JS with the old CSS and then another once the CSS
+    # landed, and get two notifications for an update instead of one.
+    SETTLE_SECONDS: Final[float] = 2.0
+
+    def __init__(self, location: str, manifest: str, fingerprinted: List[str]) -> None:
+        self.__location = location
+        self.__manifest = manifest
+        self.__fingerprinted = fingerprinted
+        self.__lock = Lock()
+        self.__stats: Optional[Tuple[Tuple[int, int], ...]] = None
+        self.__assets: Dict[str, Any] = {}
+        self.__fingerprint = ""
+
+    def __stat(self) -> Tuple[Tuple[int, int], ...]:
+        stats: List[Tuple[int, int]] = []
+        for file in [self.__manifest, *self.__fingerprinted]:
+            stat = os.stat(os.path.join(self.__location, file))
+            stats.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(stats)
+
+    def __load(self) -> Tuple[Dict[str, Any], str]:
+        with open(os.path.join(self.__location, self.__manifest), "rb") as bfp:
+            assets = json.loads(bfp.read().decode('utf-8'))
+
+        file_hash = hashlib.md5()
+        for file in self.__fingerprinted:
+            with open(os.path.join(self.__location, file), "rb") as bfp:
+                file_hash.update(bfp.read())
+
+        return assets, file_hash.hexdigest()
+
+    def get(self) -> Tuple[Dict[str, Any], str]:
+        """
+        Return the asset manifest and CSS fingerprint, reloading them if the files changed.
+
+        Returns:
+            A tuple of the parsed asset manifest and the fingerprint hash, always taken from
+            the same snapshot of the files on disk.
+        """
+        with self.__lock:
+            try:
+                stats = self.__stat()
+            except OSError:
+                # Files can briefly go missing while a deploy replaces them.
+                if self.__stats is None:
+                    raise
+                return self.__assets, self.__fingerprint
+
+            if stats != self.__stats:
+                newest = max(mtime for mtime, _ in stats) / 1_000_000_000
+                if self.__stats is None or (time.time() - newest) >= self.SETTLE_SECONDS:
+                    # If the files change again while we're reading them, the stats won't match
+                    # next time around so we'll just load them again.
+                    self.__assets, self.__fingerprint = self.__load()
+                    self.__stats = stats
+
+            return self.__assets, self.__fingerprint
+
+
+frontend_manifest = FrontendManifest(static_location, "webpack-assets.json", FINGERPRINT_INCLUDE_FILES)
 
-    file_hash = hashlib.md5()
-    for file in FINGERPRINT_INCLUDE_FILES:
-        filepath = os.path.join(static_location, file)
-        with open(filepath, "rb") as bfp:
-            file_hash.update(bfp.read())
 
-    return file_hash.hexdigest()
+def get_fingerprint_hash() -> str:
+    return frontend_manifest.get()[1]
 
 
 def get_frontend_filename(entry: str = 'chat') -> str:
     # Attempt to look up our frontend JS, used also for cache-busting.
-    jspath = os.path.join(static_location, "webpack-assets.json")
-    with open(jspath, "rb") as bfp:
-        jsdata = bfp.read().decode('utf-8')
-        jsblob = json.loads(jsdata)
-        return str(jsblob[entry]['js'])
+    assets, _ = frontend_manifest.get()
+    return str(assets[entry]['js'])
 
 
 def get_frontend_version() -> str:
     return get_frontend_filename().replace('.js', '').replace('chat.', '')
 
 
+def get_cachebust() -> str:
+    # Take both halves from the same snapshot, so that we never mix a new version with an old
+    # fingerprint if the files are picked up between looking at one and the other.
+    assets, fingerprint = frontend_manifest.get()
+    version = str(assets['chat']['js']).replace('.js', '').replace('chat.', '')
+    return version + "-" + fingerprint
+
+
 @app.context_processor
 def extrafunctions() -> Dict[str, Any]:
-    cachebust = get_frontend_version() + "-" + get_fingerprint_hash()
+    cachebust = get_cachebust()
 
     return {
         "absolute_url_for": absolute_url_for,
@@ -1,8 +1,10 @@
-from flask import Blueprint, Response
+import os
+
+from flask import Blueprint, Response, send_file
 
 from .app import cacheable, static_location, templates_location, g
 from ..data import Data
-from ..service import AttachmentService
+from ..service import AttachmentService, local_attachment_file
 
 
 attachments = Blueprint(
@@ -16,17 +18,33 @@ attachments = Blueprint(
 @attachments.route("/attachments/<attachment>")
 @cacheable(86400)
 def get_attachment(attachment: str) -> Response:
-    # Look up and return data for attachment.
-    data = Data(g.config)
-    attachmentservice = AttachmentService(g.config, data)
-
-    # This is a debug endpoint only, not meant for production use. So, it's fine
-    # to pull a little shenanigans here.
-    attachmentid = attachmentservice.id_from_path(attachment)
-    if attachmentid is not None:
-        response = attachmentservice.get_attachment_data(attachmentid)
-        if response:
-            mime_type, attachmentbytes = response
-            return Response(attachmentbytes, content_type=mime_type)
-
-    return Response("Attachment not found", 404)
+    # Figure out where the attachment lives purely from its name where we can, so serving most
+    # attachments never needs the DB. Attachments whose name doesn't say what they are, such as
+    # ones that kept an unusual extension from their original filename, get looked up instead.
+    # Attachments can be large animated images, so stream them from disk instead of reading them
+    # into memory, and let send_file handle range and conditional requests.
+    location = local_attachment_file(g.config, attachment)
+    if location is None:
+        # We skipped opening a DB session for this request, so open one now. It's closed along
+        # with the request just like any other.
+        g.data = Data(g.config)
+        location = AttachmentService(g.config, g.data).get_local_attachment_file(attachment)
+    if location is None:
+        return Response("Attachment not found", 404)
+
+    path, content_type = location
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return Response("Attachment not found", 404)
+
+    # Attachments can be overwritten in place by the manage script, so the ETag can't just be
+    # the hashed name on its own.
+    return send_file(
+        path,
+        mimetype=content_type,
+        conditional=True,
+        etag=f"{attachment}-{int(stat.st_mtime)}-{stat.st_size}",
+        last_modified=stat.st_mtime,
+        max_age=86400,
+    )
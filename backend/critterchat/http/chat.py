@@ -1,4 +1,6 @@
-from flask import Blueprint, Response, render_template
+import hashlib
+import json
+from flask import Blueprint, Response, render_template, request
 from typing import Dict
 
 from .app import (
@@ -10,11 +12,12 @@ from .app import (
     uncacheable,
     get_frontend_version,
     get_frontend_filename,
-    get_fingerprint_hash,
+    get_cachebust,
     g,
+    UserException,
 )
-from ..common import get_emoji_unicode_dict, get_aliases_unicode_dict
-from ..data import DefaultAvatarID, DefaultRoomID, FaviconID, User, UserPermission
+from ..common import get_emoji_unicode_dict, get_aliases_unicode_dict, image_queue_depth
+from ..data import Data, DefaultAvatarID, DefaultRoomID, FaviconID, User, UserPermission
 from ..service import AttachmentService, EmoteService
 
 
@@ -43,7 +46,7 @@ def home() -> Response:
     username = None if (not g.user) else g.user.username
     permissions = set() if (not g.user) else g.user.permissions
     jsname = get_frontend_filename()
-    cachebust = get_frontend_version() + "-" + get_fingerprint_hash()
+    cachebust = get_cachebust()
 
     return Response(render_template(
         "home/chat.html",
@@ -69,29 +72,13 @@ def home() -> Response:
     ))
 
 
-@chat.route("/chat/config.json")
-@loginrequired
-@uncacheable
-@jsonify
-def config() -> Dict[str, object]:
-    attachmentservice = AttachmentService(g.config, g.data)
-    emoteservice = EmoteService(g.config, g.data)
-
-    emojis = {
-        **get_emoji_unicode_dict('en'),
-        **get_aliases_unicode_dict(),
-    }
-    emojis = {key: emojis[key] for key in emojis if "__" not in key}
-    emotes = {f":{key}:": val.to_dict() for key, val in emoteservice.get_all_emotes().items()}
-
+def _get_config_settings(attachmentservice: AttachmentService) -> Dict[str, object]:
     userid = None if (not g.user) else User.from_id(g.user.id)
     username = None if (not g.user) else g.user.username
     permissions = set() if (not g.user) else g.user.permissions
 
     return {
         "title": g.config.name,
-        "emojis": emojis,
-        "emotes": emotes,
         "userid": userid,
         "username": username,
         "admin": UserPermission.ADMINISTRATOR in permissions,
@@ -109,11 +96,73 @@ def config() -> Dict[str, object]:
     }
 
 
+@jsonify
+def _get_config(settings: Dict[str, object], emoteversion: int) -> Dict[str, object]:
+    emoteservice = EmoteService(g.config, g.data)
+
+    emojis = {
+        **get_emoji_unicode_dict('en'),
+        **get_aliases_unicode_dict(),
+    }
+    emojis = {key: emojis[key] for key in emojis if "__" not in key}
+    emotes = {f":{key}:": val.to_dict() for key, val in emoteservice.get_all_emotes(emoteversion).items()}
+
+    return {
+        **settings,
+        "emojis": emojis,
+        "emotes": emotes,
+    }
+
+
+@chat.route("/chat/config.json")
+@loginrequired
+@uncacheable
+def config() -> Response:
+    attachmentservice = AttachmentService(g.config, g.data)
+    emoteservice = EmoteService(g.config, g.data)
+
+    # The bulk of this is the emoji and emote lists, which almost never change. So, tag the response
+    # with the emote version and everything else that goes into it, letting clients that already
+    # have the current config skip downloading it again and letting us skip building it.
+    settings = _get_config_settings(attachmentservice)
+    emoteversion = emoteservice.get_emote_version()
+    etag = hashlib.sha1(
+        json.dumps([emoteversion, get_frontend_version(), settings], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = _get_config(settings, emoteversion)
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    return response
+
+
 @chat.route("/chat/version.json")
 @uncacheable
 @jsonify
 def version() -> Dict[str, object]:
-    return {"js": get_frontend_version() + "-" + get_fingerprint_hash()}
+    return {"js": get_cachebust()}
+
+
+@chat.route("/chat/metrics.json")
+@loginrequired
+@uncacheable
+@jsonify
+def metrics() -> Dict[str, object]:
+    # Only administrators get to see how busy the server is.
+    if g.user is None or UserPermission.ADMINISTRATOR not in g.user.permissions:
+        exc = UserException("You do not have permission to view server metrics.")
+        exc.code = 403
+        raise exc
+
+    return {
+        "db_pool": Data.pool_stats(g.config),
+        "attachment_urls": AttachmentService.url_cache_stats(),
+        "image_queue_depth": image_queue_depth(),
+    }
 
 
 app.register_blueprint(chat)
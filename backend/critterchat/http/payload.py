@@ -0,0 +1,39 @@
+import json
+from typing import Any
+
+
+__all__ = [
+    "PreSerialized",
+    "dumps",
+    "loads",
+]
+
+
+class PreSerialized:
+    """
+    A socket event payload that has already been encoded to JSON. Emitting one of these sends
+    the encoded text as-is, so the same payload can be sent to many clients while only paying
+    for serialization once.
+    """
+
+    def __init__(self, data: object) -> None:
+        self.json = json.dumps(data, separators=(',', ':'))
+
+
+def dumps(obj: Any, *args: Any, **kwargs: Any) -> str:
+    """
+    Drop-in replacement for json.dumps that the socket server uses to encode packets. Packets
+    are encoded as a list of the event name followed by its arguments, so splice in any
+    pre-serialized arguments directly and encode everything else normally.
+    """
+    if isinstance(obj, list) and any(isinstance(o, PreSerialized) for o in obj):
+        return "[" + ",".join(
+            o.json if isinstance(o, PreSerialized) else json.dumps(o, *args, **kwargs)
+            for o in obj
+        ) + "]"
+
+    return json.dumps(obj, *args, **kwargs)
+
+
+def loads(*args: Any, **kwargs: Any) -> Any:
+    return json.loads(*args, **kwargs)
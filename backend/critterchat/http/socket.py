@@ -1,9 +1,10 @@
 import logging
 import traceback
 from threading import Lock
-from typing import Any, Dict, Final, List, Literal, Optional, Set, cast
+from typing import Any, Dict, Final, List, Literal, Optional, Set, Tuple, cast
 
-from .app import socketio, config, request
+from .app import socketio, config, request, g
+from .payload import PreSerialized
 from ..common import AESCipher, Time, represents_real_text
 from ..service import (
     EmoteService,
@@ -14,6 +15,8 @@ from ..service import (
 )
 from ..data import (
     Data,
+    event_bus,
+    last_seen_buffer,
     Action,
     ActionType,
     Attachment,
@@ -37,13 +40,15 @@ class SocketInfo:
         self.userid = userid
         self.fetchlimit: Dict[RoomID, Optional[ActionID]] = {}
         self.lastseen: Dict[RoomID, int] = {}
+        self.memberof: Set[RoomID] = set()
         self.profilets: Optional[int] = None
         self.prefsts: Optional[int] = None
         self.lock: Lock = Lock()
 
 
 MESSAGE_PUMP_TICK_SECONDS: Final[float] = 0.05
-MESSAGE_PUMP_ALWAYS_TICK_SECONDS: Final[int] = 1
+MESSAGE_PUMP_FALLBACK_POLL_SECONDS: Final[int] = 1
+MESSAGE_PUMP_FULL_SWEEP_SECONDS: Final[int] = 15
 EMOJI_REFRESH_TICK_SECONDS: Final[int] = 5
 
 
@@ -53,55 +58,87 @@ MAX_ICON_HEIGHT: Final[int] = 256
 
 socket_lock: Lock = Lock()
 socket_to_info: Dict[Any, SocketInfo] = {}
+room_to_sockets: Dict[RoomID, Set[Any]] = {}
 background_thread: Optional[object] = None
 logger = logging.getLogger(__name__)
 
 
 def background_thread_proc() -> None:
     while True:
+        data = Data(config)
         try:
-            background_thread_proc_impl()
+            background_thread_proc_impl(data)
             return
         except Exception:
             logger.error(traceback.format_exc())
             logger.info("Background polling thread died with an exception, restarting!")
+        finally:
+            # The pump holds onto its data object for as long as it runs, so make sure its
+            # connection goes back to the pool when it stops or dies.
+            data.close()
 
 
-def background_thread_proc_impl() -> None:
+def event_data() -> Data:
+    """
+    Return the data object for the socket event currently being handled, creating it if needed.
+    Every socket event is handled inside its own request context, so the data object is closed by
+    the same teardown that closes it for regular web requests once the event is done, returning
+    its connection to the pool instead of waiting for it to be garbage collected.
+    """
+    data = getattr(g, "data", None)
+    if data is None:
+        data = Data(config)
+        g.data = data
+    return data
+
+
+def background_thread_proc_impl(data: Data) -> None:
     """
     The background polling thread that manages asynchronous messages from the database.
     """
 
-    data = Data(config)
     messageservice = MessageService(config, data)
     userservice = UserService(config, data)
     emoteservice = EmoteService(config, data)
 
     # Make sure we can send emote additions and subtractions to the connected clients.
-    emotes = {k for k in emoteservice.get_all_emotes()}
+    emote_version = emoteservice.get_emote_version()
     last_emote_update = Time.now()
-    last_user_update = Time.now()
-    last_action: Optional[ActionID] = None
-
-    while True:
-        # Just yield to the async system.
-        socketio.sleep(MESSAGE_PUMP_TICK_SECONDS)
-
-        # See if we need to update emotes on clients.
-        if (Time.now() - last_emote_update) >= EMOJI_REFRESH_TICK_SECONDS:
-            newemotes = emoteservice.get_all_emotes()
-            additions: Set[str] = set()
-            deletions: Set[str] = set()
+    last_poll = Time.now()
+    last_sweep = Time.now()
+    last_action: Optional[ActionID] = messageservice.get_last_action()
 
-            for emote in newemotes:
-                if emote not in emotes:
-                    # This was an addition.
-                    additions.add(emote)
+    # Sockets that we wanted to update but couldn't because somebody else held their lock.
+    retry: Set[Any] = set()
 
-            for emote in emotes:
-                if emote not in newemotes:
-                    # This was a deletion.
-                    deletions.add(emote)
+    while True:
+        # Sleep until something is published to the event bus, which also yields to the async
+        # system. If there are clients we still owe an update to, come back around quickly.
+        # If there are last seen markers waiting to be written, come back in time to write them.
+        if retry:
+            timeout = MESSAGE_PUMP_TICK_SECONDS
+        elif last_seen_buffer:
+            timeout = last_seen_buffer.FLUSH_SECONDS
+        else:
+            timeout = MESSAGE_PUMP_FALLBACK_POLL_SECONDS
+        changes = event_bus.wait(timeout)
+
+        # Our data object lives as long as the pump does, so only let it cache for one wakeup.
+        data.reset_cache()
+
+        # Write out any last seen markers that clients have sent since the last flush. This
+        # publishes the affected users, so other sessions for them get their badges cleared on
+        # the next wakeup.
+        if last_seen_buffer.due():
+            userservice.flush_last_seen()
+
+        # See if we need to update emotes on clients. We hear about changes made by this process
+        # right away, but still occasionally check the version for changes made elsewhere (such
+        # as by the manage script). Both only look at what changed since the last time.
+        if changes.emotes or (Time.now() - last_emote_update) >= EMOJI_REFRESH_TICK_SECONDS:
+            emote_version, emotechanges = emoteservice.get_emote_changes(emote_version)
+            additions = {alias: emote for alias, emote in emotechanges.items() if emote is not None}
+            deletions = [alias for alias, emote in emotechanges.items() if emote is None]
 
             # Send the delta to the clients, intentionally not choosing a room here.
             if additions or deletions:
@@ -110,21 +147,35 @@ def background_thread_proc_impl() -> None:
                 if deletions:
                     logger.info("Detected the following removed emotes: " + ", ".join(deletions))
                 socketio.emit('emotechanges', {
-                    'additions': {f":{alias}:": newemotes[alias].to_dict() for alias in additions},
+                    'additions': {f":{alias}:": emote.to_dict() for alias, emote in additions.items()},
                     'deletions': [f":{d}:" for d in deletions],
                 })
-                emotes = {k for k in newemotes}
             last_emote_update = Time.now()
 
-        # Look for any new actions that should be relayed.
-        current_action = messageservice.get_last_action()
-        if current_action == last_action:
-            if (Time.now() - last_user_update) < MESSAGE_PUMP_ALWAYS_TICK_SECONDS:
-                # Nothing to do, skip the expensive part below.
-                continue
-
-        last_action = current_action
-        last_user_update = Time.now()
+        # Keep track of the newest action we've been told about, so the fallback poll below
+        # only triggers for actions that we didn't hear about over the event bus.
+        for actionid in changes.rooms.values():
+            if last_action is None or actionid > last_action:
+                last_action = actionid
+
+        # The event bus only hears about writes from this process, so every so often check
+        # the database for actions written elsewhere (such as by the manage script). We also
+        # occasionally sweep everyone to catch user changes made elsewhere.
+        full = False
+        if (Time.now() - last_poll) >= MESSAGE_PUMP_FALLBACK_POLL_SECONDS:
+            current_action = messageservice.get_last_action()
+            if current_action is not None and (last_action is None or current_action > last_action):
+                full = True
+            last_action = current_action if current_action is not None else last_action
+            last_poll = Time.now()
+        if (Time.now() - last_sweep) >= MESSAGE_PUMP_FULL_SWEEP_SECONDS:
+            full = True
+        if full:
+            last_sweep = Time.now()
+
+        if not full and not changes and not retry:
+            # Nothing to do, skip the expensive part below.
+            continue
 
         # If we have actual actions, grab who we need to act on and then individually lock.
         # This prevents a misbehaving client from locking the whole network.
@@ -132,116 +183,176 @@ def background_thread_proc_impl() -> None:
             if not socket_to_info:
                 logger.info("Shutting down message pump thread due to no more client sockets.")
 
+                # Nobody is around to send markers anymore, so make sure what we have is saved.
+                userservice.flush_last_seen()
+
                 global background_thread
                 background_thread = None
 
                 return
 
-            sockets: List[SocketInfo] = list(socket_to_info.values())
-
-        # Keep a lookup of room occupants so we don't look this up repeatedly during CHANGE_USERS events.
+            # Figure out which rooms changed that somebody is actually watching, and who is
+            # watching them, so we only look at affected clients.
+            if full:
+                changedrooms = set(room_to_sockets.keys())
+                sockets: List[SocketInfo] = list(socket_to_info.values())
+            else:
+                changedrooms = {roomid for roomid in changes.rooms if roomid in room_to_sockets}
+                affected: Set[Any] = {sid for sid in retry if sid in socket_to_info}
+                for roomid in changedrooms:
+                    affected.update(room_to_sockets[roomid])
+                if changes.users:
+                    affected.update(sid for sid, info in socket_to_info.items() if info.userid in changes.users)
+                sockets = [socket_to_info[sid] for sid in affected if sid in socket_to_info]
+
+        # Each changed room's delta is fetched once for all watchers, starting after the oldest
+        # action that any of them has seen, and then filtered per client below.
+        floors: Dict[RoomID, ActionID] = {}
+        for info in sockets:
+            for roomid, fetchlimit in list(info.fetchlimit.items()):
+                if fetchlimit is not None and (roomid not in floors or fetchlimit < floors[roomid]):
+                    floors[roomid] = fetchlimit
+        deltas: Dict[RoomID, Tuple[ActionID, List[Action]]] = {}
+
+        def get_room_updates(roomid: RoomID, after: ActionID) -> List[Action]:
+            delta = deltas.get(roomid)
+            if delta is None or delta[0] > after:
+                # Either the first client to ask, or a client whose position moved backwards
+                # since we computed the floors, so we need to go to the database.
+                floor = min(floors.get(roomid, after), after)
+                delta = (floor, messageservice.get_room_updates(roomid, after=floor))
+                deltas[roomid] = delta
+            return [action for action in delta[1] if action.id > after]
+
+        # Clients in the same room that have seen the same actions get identical deltas, so only
+        # build and encode each distinct one once per wakeup.
+        actiondicts: Dict[ActionID, Dict[str, object]] = {}
+        payloads: Dict[Tuple[RoomID, ActionID], PreSerialized] = {}
+
+        def action_to_dict(action: Action) -> Dict[str, object]:
+            if action.id not in actiondicts:
+                actiondicts[action.id] = action.to_dict()
+            return actiondicts[action.id]
+
+        # Keep a lookup of room occupants so we don't look this up repeatedly during CHANGE_USERS events,
+        # and so that clients sharing rooms share the occupant lookups when refreshing their room list.
         occupantcache: Dict[RoomID, List[Occupant]] = {}
+        newretry: Set[Any] = set()
 
         for info in sockets:
+            # Figure out which of this client's rooms we need to look at.
+            if full or info.sid in retry:
+                checkrooms = set(info.fetchlimit.keys())
+            else:
+                checkrooms = {roomid for roomid in info.fetchlimit if roomid in changedrooms}
+
             # Lock this so other communication with this client doesn't get out of order.
             locked = info.lock.acquire(blocking=False)
-            if locked:
-                try:
-                    # First, if they were deactivated, inform them now.
-                    user = userservice.lookup_user(info.userid) if info.userid is not None else None
-                    if user is None or UserPermission.ACTIVATED not in user.permissions:
-                        socketio.emit('reload', {}, room=info.sid)
-                        continue
-
-                    updated = False
-                    for roomid, fetchlimit in info.fetchlimit.items():
-                        # Only fetch deltas for clients that have gotten an initial fetch for a room.
-                        if fetchlimit is not None:
-                            actions = messageservice.get_room_updates(roomid, after=fetchlimit)
-
-                            if actions:
-                                for action in actions:
-                                    fetchlimit = action.id if fetchlimit is None else max(fetchlimit, action.id)
-                                    if action.action == ActionType.CHANGE_USERS:
-                                        if roomid not in occupantcache:
-                                            room = messageservice.lookup_room(roomid, user.id)
-                                            if room:
-                                                occupantcache[roomid] = room.occupants
-
-                                        if roomid in occupantcache:
-                                            action.details = {
-                                                "occupants": [o.to_dict() for o in occupantcache[roomid]],
-                                            }
-
-                                info.fetchlimit[roomid] = fetchlimit or NewActionID
-
-                                socketio.emit('chatactions', {
+            if not locked:
+                # Try again shortly, since we don't want to drop this update on the floor.
+                newretry.add(info.sid)
+                continue
+
+            try:
+                # First, if they were deactivated or logged out, inform them now. Sessions are cached and
+                # the cache is invalidated whenever a user changes or logs out, which also wakes us up here.
+                user = data.user.from_session(info.sessionid) if info.sessionid is not None else None
+                if user is None or user.id != info.userid or UserPermission.ACTIVATED not in user.permissions:
+                    socketio.emit('reload', {}, room=info.sid)
+                    continue
+
+                updated = False
+                for roomid, fetchlimit in info.fetchlimit.items():
+                    # Only fetch deltas for clients that have gotten an initial fetch for a room.
+                    if roomid in checkrooms and fetchlimit is not None:
+                        key = (roomid, fetchlimit)
+                        actions = get_room_updates(roomid, fetchlimit)
+
+                        if actions:
+                            for action in actions:
+                                fetchlimit = action.id if fetchlimit is None else max(fetchlimit, action.id)
+                                if action.action == ActionType.CHANGE_USERS:
+                                    if roomid not in occupantcache:
+                                        room = messageservice.lookup_room(roomid, user.id)
+                                        if room:
+                                            occupantcache[roomid] = room.occupants
+
+                                    if roomid in occupantcache:
+                                        action.details = {
+                                            "occupants": [o.to_dict() for o in occupantcache[roomid]],
+                                        }
+
+                            info.fetchlimit[roomid] = fetchlimit or NewActionID
+
+                            if key not in payloads:
+                                payloads[key] = PreSerialized({
                                     'roomid': Room.from_id(roomid),
-                                    'actions': [action.to_dict() for action in actions],
-                                }, room=info.sid)
-                                updated = True
-
-                    # Figure out if this user has been joined to a new chat.
-                    # Figure out if rooms have changed, so we can start monitoring.
-                    rooms = messageservice.get_joined_rooms(user.id)
-
-                    includes: Set[RoomID] = set()
-                    for room in rooms:
-                        if room.id not in info.fetchlimit:
-                            includes.add(room.id)
+                                    'actions': [action_to_dict(action) for action in actions],
+                                })
+                            socketio.emit('chatactions', payloads[key], room=info.sid)
                             updated = True
 
-                            lastaction = messageservice.get_last_room_action(room.id)
-                            if lastaction:
-                                info.fetchlimit[room.id] = lastaction.id
-                            else:
-                                info.fetchlimit[room.id] = NewActionID
-
-                    # Calculate any badge updates that the client needs to know about, including
-                    # badges on newly-joined rooms.
-                    lastseen = userservice.get_last_seen_counts(user.id)
-                    counts: Dict[RoomID, int] = {}
-                    for roomid, count in lastseen.items():
-                        if roomid in includes or count < info.lastseen.get(roomid, 0):
-                            counts[roomid] = count
-                        info.lastseen[roomid] = count
-
-                    if updated or counts:
-                        clientdata: Dict[str, object] = {}
-                        if updated:
-                            clientdata['rooms'] = [room.to_dict() for room in rooms]
-                        if counts:
-                            clientdata['counts'] = [{'roomid': Room.from_id(k), 'count': v} for k, v in counts.items()]
-
-                        # Notify the client of any room rearranges, or any new rooms.
-                        socketio.emit('roomlist', clientdata, room=info.sid)
-
-                    # Figure out if preferences or profile changed since our last poll,
-                    # and send an updated "preferences" or "profile" response to said
-                    # client if it has. This should keep prefs and profiles in sync
-                    # across multiple sessions at once.
-                    profilets = info.profilets
-                    prefsts = info.prefsts
-
-                    if profilets is not None:
-                        ts = Time.now()
-                        if userservice.has_updated_user(user.id, profilets):
-                            userprofile = userservice.lookup_user(user.id)
-                            admin = userprofile is not None and UserPermission.ADMINISTRATOR in userprofile.permissions
-                            if userprofile:
-                                info.profilets = ts
-                                socketio.emit('profile', userprofile.to_dict(config=config, admin=admin), room=info.sid)
-
-                    if prefsts is not None:
-                        ts = Time.now()
-                        if userservice.has_updated_preferences(user.id, prefsts):
-                            userpreferences = userservice.get_preferences(user.id)
-                            if userpreferences:
-                                info.prefsts = ts
-                                socketio.emit('preferences', userpreferences.to_dict(), room=info.sid)
-
-                finally:
-                    info.lock.release()
+                # Figure out if this user has been joined to a new chat.
+                # Figure out if rooms have changed, so we can start monitoring.
+                rooms = messageservice.get_joined_rooms(user.id, occupantcache)
+                info.memberof.intersection_update(room.id for room in rooms)
+
+                includes: Set[RoomID] = set()
+                for room in rooms:
+                    if room.id not in info.fetchlimit:
+                        includes.add(room.id)
+                        updated = True
+
+                        lastaction = messageservice.get_last_room_action(room.id)
+                        subscribe_room(info, room.id, lastaction.id if lastaction else NewActionID)
+
+                # Calculate any badge updates that the client needs to know about, including
+                # badges on newly-joined rooms.
+                lastseen = userservice.get_last_seen_counts(user.id)
+                counts: Dict[RoomID, int] = {}
+                for roomid, count in lastseen.items():
+                    if roomid in includes or count < info.lastseen.get(roomid, 0):
+                        counts[roomid] = count
+                    info.lastseen[roomid] = count
+
+                if updated or counts:
+                    clientdata: Dict[str, object] = {}
+                    if updated:
+                        clientdata['rooms'] = [room.to_dict() for room in rooms]
+                    if counts:
+                        clientdata['counts'] = [{'roomid': Room.from_id(k), 'count': v} for k, v in counts.items()]
+
+                    # Notify the client of any room rearranges, or any new rooms.
+                    socketio.emit('roomlist', clientdata, room=info.sid)
+
+                # Figure out if preferences or profile changed since our last poll,
+                # and send an updated "preferences" or "profile" response to said
+                # client if it has. This should keep prefs and profiles in sync
+                # across multiple sessions at once.
+                profilets = info.profilets
+                prefsts = info.prefsts
+
+                if profilets is not None:
+                    ts = Time.now()
+                    if userservice.has_updated_user(user.id, profilets):
+                        userprofile = userservice.lookup_user(user.id)
+                        admin = userprofile is not None and UserPermission.ADMINISTRATOR in userprofile.permissions
+                        if userprofile:
+                            info.profilets = ts
+                            socketio.emit('profile', userprofile.to_dict(config=config, admin=admin), room=info.sid)
+
+                if prefsts is not None:
+                    ts = Time.now()
+                    if userservice.has_updated_preferences(user.id, prefsts):
+                        userpreferences = userservice.get_preferences(user.id)
+                        if userpreferences:
+                            info.prefsts = ts
+                            socketio.emit('preferences', userpreferences.to_dict(), room=info.sid)
+
+            finally:
+                info.lock.release()
+
+        retry = newretry
 
 
 def register_sid(data: Data, sid: Any, sessionid: Optional[str]) -> None:
@@ -255,11 +366,64 @@ def register_sid(data: Data, sid: Any, sessionid: Optional[str]) -> None:
         socket_to_info[sid] = SocketInfo(sid, sessionid, user.id if user is not None else None)
 
 
-def unregister_sid(sid: Any) -> None:
+def unregister_sid(sid: Any) -> Optional[SocketInfo]:
     with socket_lock:
         if sid in socket_to_info:
+            info = socket_to_info[sid]
             del socket_to_info[sid]
 
+            for roomid in info.fetchlimit:
+                _unindex_room(sid, roomid)
+            return info
+    return None
+
+
+def _unindex_room(sid: Any, roomid: RoomID) -> None:
+    # Must be called with the socket lock held.
+    sids = room_to_sockets.get(roomid)
+    if sids is not None:
+        sids.discard(sid)
+        if not sids:
+            del room_to_sockets[roomid]
+
+
+def subscribe_room(info: SocketInfo, roomid: RoomID, fetchlimit: Optional[ActionID]) -> None:
+    """
+    Start sending a client deltas for a room, starting after the given action ID. If the client
+    is already watching the room, this just moves where the deltas start. Call this with the
+    client's info lock held.
+    """
+    info.fetchlimit[roomid] = fetchlimit
+    with socket_lock:
+        if socket_to_info.get(info.sid) is info:
+            room_to_sockets.setdefault(roomid, set()).add(info.sid)
+
+
+def unsubscribe_room(info: SocketInfo, roomid: RoomID) -> None:
+    """
+    Stop sending a client deltas for a room. Call this with the client's info lock held.
+    """
+    if roomid in info.fetchlimit:
+        del info.fetchlimit[roomid]
+    with socket_lock:
+        _unindex_room(info.sid, roomid)
+
+
+def check_membership(messageservice: MessageService, info: SocketInfo, userid: UserID, roomid: RoomID) -> bool:
+    """
+    Figure out whether a user is in a room, for authorizing a request against that room. Rooms that
+    we've already confirmed are remembered on the socket until the user joins or leaves a room, or
+    until the message pump notices that their room list changed. Call this with the client's info
+    lock held.
+    """
+    if roomid in info.memberof:
+        return True
+    if not messageservice.is_room_member(roomid, userid):
+        return False
+
+    info.memberof.add(roomid)
+    return True
+
 
 def recover_info(sid: Any) -> SocketInfo:
     with socket_lock:
@@ -312,6 +476,18 @@ def hydrate_tag(request: Dict[str, object], response: Dict[str, object]) -> Dict
     return {**response, 'tag': request['tag']}
 
 
+def get_history_limit(request: Dict[str, object]) -> Optional[int]:
+    # Clients can optionally ask for a smaller page of history. The message service caps this,
+    # so all we need to do here is make sure it's actually a number.
+    limit = request.get('limit')
+    if isinstance(limit, bool) or not isinstance(limit, (int, str)):
+        return None
+    try:
+        return int(limit)
+    except ValueError:
+        return None
+
+
 def flash(severity: Literal["success", "info", "warning", "error"], message: str, *, room: Any) -> None:
     socketio.emit('flash', {'severity': severity, 'message': message}, room=room)
 
@@ -335,19 +511,24 @@ def connect() -> None:
         sessionID = None
 
     # Make sure we track this client so we don't get a premature hang-up.
-    data = Data(config)
+    data = event_data()
     register_sid(data, request.sid, sessionID)
 
 
 @socketio.on('disconnect')  # type: ignore
 def disconnect() -> None:
     # Explicitly kill the presence since we know they're gone.
-    unregister_sid(request.sid)
+    info = unregister_sid(request.sid)
+
+    # Write out anything they saw right before leaving, so it's there when they come back.
+    if info is not None and info.userid is not None:
+        userservice = UserService(config, event_data())
+        userservice.flush_last_seen(info.userid)
 
 
 @socketio.on('motd')  # type: ignore
 def motd(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
     messageservice = MessageService(config, data)
 
@@ -373,7 +554,7 @@ def motd(json: Dict[str, object]) -> None:
 
 @socketio.on('welcomeaccept')  # type: ignore
 def welcomeaccept(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
     messageservice = MessageService(config, data)
 
@@ -394,7 +575,7 @@ def welcomeaccept(json: Dict[str, object]) -> None:
 
 @socketio.on('roomlist')  # type: ignore
 def roomlist(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     messageservice = MessageService(config, data)
     userservice = UserService(config, data)
 
@@ -412,10 +593,7 @@ def roomlist(json: Dict[str, object]) -> None:
         # Pre-charge the delta fetches for all rooms this user is in.
         for room in rooms:
             action = messageservice.get_last_room_action(room.id)
-            if action:
-                info.fetchlimit[room.id] = action.id
-            else:
-                info.fetchlimit[room.id] = NewActionID
+            subscribe_room(info, room.id, action.id if action else NewActionID)
 
             info.lastseen[room.id] = lastseen.get(room.id, 0)
 
@@ -427,7 +605,7 @@ def roomlist(json: Dict[str, object]) -> None:
 
 @socketio.on('lastsettings')  # type: ignore
 def lastsettings(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
 
     # Try to associate with a user and login session if there is one.
@@ -444,7 +622,7 @@ def lastsettings(json: Dict[str, object]) -> None:
 
 @socketio.on('profile')  # type: ignore
 def profile(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
     messageservice = MessageService(config, data)
 
@@ -486,7 +664,7 @@ def profile(json: Dict[str, object]) -> None:
 
 @socketio.on('preferences')  # type: ignore
 def preferences(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
 
     # Try to associate with a user if there is one.
@@ -508,7 +686,7 @@ def preferences(json: Dict[str, object]) -> None:
 
 @socketio.on('updatesettings')  # type: ignore
 def updatesettings(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
 
     # Try to associate with a user and login session if there is one.
@@ -525,7 +703,7 @@ def updatesettings(json: Dict[str, object]) -> None:
 
 @socketio.on('updateprofile')  # type: ignore
 def updateprofile(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
 
     # Try to associate with a user if there is one.
@@ -568,7 +746,7 @@ def updateprofile(json: Dict[str, object]) -> None:
 
 @socketio.on('updatepreferences')  # type: ignore
 def updatepreferences(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
 
     # Try to associate with a user and login session if there is one.
@@ -666,7 +844,7 @@ def updatepreferences(json: Dict[str, object]) -> None:
 
 @socketio.on('chatactions')  # type: ignore
 def chatactions(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     messageservice = MessageService(config, data)
 
     # Try to associate with a user if there is one.
@@ -675,46 +853,79 @@ def chatactions(json: Dict[str, object]) -> None:
     if userid is None or info is None:
         return
 
+    roomid = Room.to_id(str(json.get('roomid')))
+    if not roomid:
+        return
+    after = json.get('after', None)
+    afterid = Action.to_id(str(after)) if after else None
+
     # Locking our socket info so we can keep track of what history we've seen,
     # so that we can send deltas afterwards to the client when new chats happen.
     with info.lock:
-        roomid = Room.to_id(str(json.get('roomid')))
-        if roomid:
-            # Grab the current room in our joined rooms list. There's a way more performant
-            # way to do this but we can fix that later.
-            rooms = messageservice.get_joined_rooms(userid)
-            rooms = [r for r in rooms if r.id == roomid]
-            room = rooms[0] if rooms else None
-
-            if not room:
-                # Trying to grab chat for a room we're not in!
-                return
-
-            if (after := json.get('after', None)) and (afterid := Action.to_id(str(after))):
-                actions = messageservice.get_room_updates(roomid, after=afterid)
-
-                # Starting from the known last seen action ID here, since this is a client
-                # catch-up message after reconnecting. With this pre-charged, we won't end
-                # up re-sending the messages again in the message pump thread above.
-                fetchlimit = afterid
-                for action in actions:
-                    fetchlimit = max(fetchlimit, action.id)
-                    if action.action == ActionType.CHANGE_USERS:
-                        action.details = {
-                            "occupants": [o.to_dict() for o in room.occupants],
-                        }
-
-                info.fetchlimit[roomid] = fetchlimit
+        if not check_membership(messageservice, info, userid, roomid):
+            # Trying to grab chat for a room we're not in!
+            return
+        if afterid is None:
+            return
 
-                socketio.emit('chatactions', hydrate_tag(json, {
-                    'roomid': Room.from_id(roomid),
-                    'actions': [action.to_dict() for action in actions],
-                }), room=request.sid)
+        # Starting from the known last seen action ID here, since this is a client catch-up
+        # message after reconnecting. Hold off the message pump for this room while we catch up,
+        # since we don't keep the lock for the whole catch-up. Remember how far the pump already
+        # got so that we never move the client's floor backwards afterwards.
+        previous = info.fetchlimit.get(roomid)
+        if roomid in info.fetchlimit:
+            info.fetchlimit[roomid] = None
+
+    # A client that was gone for a while could be owed a huge backlog, so send it in bounded
+    # chunks, oldest first, rather than all in one go. The lock isn't held here, so that other
+    # events for this client can be handled between chunks.
+    fetchlimit = afterid
+    occupants: Optional[List[Occupant]] = None
+    sent = False
+    for actions in messageservice.get_room_catchup(roomid, after=afterid):
+        for action in actions:
+            fetchlimit = max(fetchlimit, action.id)
+            if action.action == ActionType.CHANGE_USERS:
+                if occupants is None:
+                    room = messageservice.lookup_room(roomid, userid)
+                    occupants = room.occupants if room else []
+
+                action.details = {
+                    "occupants": [o.to_dict() for o in occupants],
+                }
+
+        socketio.emit('chatactions', hydrate_tag(json, {
+            'roomid': Room.from_id(roomid),
+            'actions': [action.to_dict() for action in actions],
+        }), room=request.sid)
+        sent = True
+
+        # Give other clients a chance to be serviced between chunks.
+        socketio.sleep(0)
+
+    if not sent:
+        # Clients expect a response even when there's nothing new.
+        socketio.emit('chatactions', hydrate_tag(json, {
+            'roomid': Room.from_id(roomid),
+            'actions': [],
+        }), room=request.sid)
+
+    # Now that we've caught up, with this pre-charged we won't end up re-sending the messages
+    # again in the message pump thread above. The pump may also have started watching the room
+    # for this client while we were catching up. If the client left the room in the meantime then
+    # there's nothing to start watching.
+    with info.lock:
+        if roomid in info.memberof:
+            current = info.fetchlimit.get(roomid)
+            for floor in (previous, current):
+                if floor is not None:
+                    fetchlimit = max(fetchlimit, floor)
+            subscribe_room(info, roomid, fetchlimit)
 
 
 @socketio.on('chathistory')  # type: ignore
 def chathistory(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     messageservice = MessageService(config, data)
     userservice = UserService(config, data)
 
@@ -729,32 +940,45 @@ def chathistory(json: Dict[str, object]) -> None:
     with info.lock:
         roomid = Room.to_id(str(json.get('roomid')))
         if roomid:
-            rooms = messageservice.get_joined_rooms(userid)
-            joinedrooms = {room.id for room in rooms}
-            if roomid not in joinedrooms:
+            if not check_membership(messageservice, info, userid, roomid):
                 # Trying to grab chat for a room we're not in!
                 return
 
+            limit = get_history_limit(json)
             before = json.get('before', None)
+            around = json.get('around', None)
             if before:
                 beforeid = Action.to_id(str(before))
-                actions = messageservice.get_room_history(roomid, before=beforeid)
+                actions, hasmore = messageservice.get_room_history(roomid, before=beforeid, limit=limit)
 
                 socketio.emit('chathistory', hydrate_tag(json, {
                     'roomid': Room.from_id(roomid),
                     'history': [action.to_dict() for action in actions],
+                    'hasmore': hasmore,
+                }), room=request.sid)
+
+            elif around and (aroundid := Action.to_id(str(around))):
+                # Jumping to an action that the client doesn't have loaded. This doesn't change what
+                # deltas the client gets, since they're still watching the newest end of the room.
+                actions, hasmore, hasnewer = messageservice.get_room_history_around(roomid, aroundid, limit=limit)
+
+                socketio.emit('chathistory', hydrate_tag(json, {
+                    'roomid': Room.from_id(roomid),
+                    'history': [action.to_dict() for action in actions],
+                    'hasmore': hasmore,
+                    'hasnewer': hasnewer,
                 }), room=request.sid)
 
             else:
                 lastseen = userservice.get_last_seen_actions(userid)
-                actions = messageservice.get_room_history(roomid)
+                actions, hasmore = messageservice.get_room_history(roomid, limit=limit)
                 occupants = messageservice.get_room_occupants(roomid)
 
                 # Starting from scratch here since this messages clears the chat pane on the client.
                 fetchlimit = None
                 for action in actions:
                     fetchlimit = action.id if fetchlimit is None else max(fetchlimit, action.id)
-                info.fetchlimit[roomid] = fetchlimit or NewActionID
+                subscribe_room(info, roomid, fetchlimit or NewActionID)
 
                 # Also report the last seen message, so that a "new" indicator can be displayed.
                 lastaction = lastseen.get(roomid, None)
@@ -764,12 +988,13 @@ def chathistory(json: Dict[str, object]) -> None:
                     'history': [action.to_dict() for action in actions],
                     'occupants': [occupant.to_dict() for occupant in occupants],
                     'lastseen': Action.from_id(lastaction) if lastaction else None,
+                    'hasmore': hasmore,
                 }), room=request.sid)
 
 
 @socketio.on('invite')  # type: ignore
 def invite(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
 
     # Only allow generating invites if the server allows it or the user is
@@ -793,11 +1018,12 @@ def invite(json: Dict[str, object]) -> None:
 
 @socketio.on('message')  # type: ignore
 def message(json: Dict[str, object]) -> Dict[str, object]:
-    data = Data(config)
+    data = event_data()
     messageservice = MessageService(config, data)
 
     # Try to associate with a user if there is one.
     userid = recover_userid(data, request.sid)
+    info = recover_info(request.sid)
     if userid is None:
         return {'status': 'failed'}
 
@@ -806,9 +1032,10 @@ def message(json: Dict[str, object]) -> Dict[str, object]:
     # While we allow funny formatting and spaces, we don't allow space-only messages.
     message = str(json.get('message')).strip()
     if roomid:
-        rooms = messageservice.get_joined_rooms(userid)
-        joinedrooms = {room.id for room in rooms}
-        if roomid not in joinedrooms:
+        # Joins and leaves change what rooms we remember being in, so look at them under the lock.
+        with info.lock:
+            member = check_membership(messageservice, info, userid, roomid)
+        if not member:
             # Trying to insert a chat for a room we're not in!
             return {'status': 'failed'}
 
@@ -844,7 +1071,7 @@ def message(json: Dict[str, object]) -> Dict[str, object]:
 
 @socketio.on('leaveroom')  # type: ignore
 def leaveroom(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     messageservice = MessageService(config, data)
 
     # Try to associate with a user if there is one.
@@ -857,15 +1084,14 @@ def leaveroom(json: Dict[str, object]) -> None:
     with info.lock:
         roomid = Room.to_id(str(json.get('roomid')))
         if roomid:
-            if roomid in info.fetchlimit:
-                del info.fetchlimit[roomid]
-
+            unsubscribe_room(info, roomid)
+            info.memberof.discard(roomid)
             messageservice.leave_room(roomid, userid)
 
 
 @socketio.on('searchrooms')  # type: ignore
 def searchrooms(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     messageservice = MessageService(config, data)
 
     # Try to associate with a user if there is one.
@@ -882,7 +1108,7 @@ def searchrooms(json: Dict[str, object]) -> None:
 
 @socketio.on('joinroom')  # type: ignore
 def joinroom(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     messageservice = MessageService(config, data)
 
     # Try to associate with a user if there is one.
@@ -914,15 +1140,13 @@ def joinroom(json: Dict[str, object]) -> None:
 
         if actual_id:
             # Grab all rooms that the user is in, based on their user ID.
+            info.memberof.discard(actual_id)
             rooms = messageservice.get_joined_rooms(userid)
 
             # Pre-charge the delta fetches for all rooms this user is in.
             for room in rooms:
                 action = messageservice.get_last_room_action(room.id)
-                if action:
-                    info.fetchlimit[room.id] = action.id
-                else:
-                    info.fetchlimit[room.id] = NewActionID
+                subscribe_room(info, room.id, action.id if action else NewActionID)
 
     if actual_id:
         socketio.emit('roomlist', {
@@ -933,7 +1157,7 @@ def joinroom(json: Dict[str, object]) -> None:
 
 @socketio.on('lastaction')  # type: ignore
 def lastaction(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
 
     # Try to associate with a user if there is one.
@@ -950,7 +1174,7 @@ def lastaction(json: Dict[str, object]) -> None:
 
 @socketio.on('updateroom')  # type: ignore
 def updateroom(json: Dict[str, object]) -> None:
-    data = Data(config)
+    data = event_data()
     messageservice = MessageService(config, data)
     userservice = UserService(config, data)
 
@@ -1018,7 +1242,7 @@ def updateroom(json: Dict[str, object]) -> None:
 
 @socketio.on('admin')  # type: ignore
 def adminaction(json: Dict[str, object]) -> Dict[str, object]:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
     messageservice = MessageService(config, data)
 
@@ -1096,7 +1320,7 @@ def adminaction(json: Dict[str, object]) -> Dict[str, object]:
 
 @socketio.on('mod')  # type: ignore
 def modaction(json: Dict[str, object]) -> Dict[str, object]:
-    data = Data(config)
+    data = event_data()
     userservice = UserService(config, data)
     messageservice = MessageService(config, data)
 
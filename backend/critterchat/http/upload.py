@@ -3,11 +3,17 @@ import urllib.request
 from flask import Blueprint, request
 from pydub import AudioSegment  # type: ignore
 from pydub.exceptions import CouldntDecodeError  # type: ignore
-from typing import Dict, List, Optional
+from typing import IO, Any, Dict, List, Optional, Union, cast
+from werkzeug.formparser import FormDataParser
 
 from .app import UserException, app, static_location, templates_location, loginrequired, jsonify, g
 from ..data import Attachment, UserNotification, MetadataType
-from ..service import AttachmentService, AttachmentServiceUnsupportedImageException, AttachmentServiceInvalidSizeException
+from ..service import (
+    AttachmentService,
+    AttachmentServiceException,
+    AttachmentServiceUnsupportedImageException,
+    AttachmentServiceInvalidSizeException,
+)
 
 
 upload = Blueprint(
@@ -153,10 +159,105 @@ def notifications_upload() -> Dict[str, object]:
     return {"notif_sounds": response}
 
 
+class _LimitedUpload:
+    """
+    A temporary file that a multipart upload is streamed into as it arrives, which refuses to grow
+    past the attachment size limit instead of finding out after the whole file has been received.
+    It has a real name on disk so that image processing can read it directly from the file.
+    """
+
+    def __init__(self, filename: str, limit: int) -> None:
+        self.__file = tempfile.NamedTemporaryFile("wb+")
+        self.__filename = filename
+        self.__limit = limit
+        self.size = 0
+
+    @property
+    def name(self) -> str:
+        return self.__file.name
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > self.__limit:
+            raise UserException(f'Chosen attachment {self.__filename} file size is too large. Attachments cannot be larger than {self.__limit // 1024}kb.')
+        return self.__file.write(data)
+
+    def __getattr__(self, name: str) -> Any:
+        # Everything else, such as seeking, reading and closing, goes straight to the file.
+        return getattr(self.__file, name)
+
+
+def _clean_filename(filename: str) -> str:
+    if "\\" in filename:
+        _, filename = filename.rsplit("\\", 1)
+    if "/" in filename:
+        _, filename = filename.rsplit("/", 1)
+    return filename
+
+
+def _store_message_attachment(
+    attachmentservice: AttachmentService,
+    filename: str,
+    alt_text: str,
+    sensitive: bool,
+    image: Union[bytes, str],
+) -> str:
+    # Remember the old content type, because if we detect that it's wrong, or we convert the image
+    # we will want to update the filename with the new correct extension.
+    presumed_content_type = attachmentservice.get_content_type(filename)
+
+    # Now, verify the image is actually loadable and the right mimetype. Stop
+    # people from trying to abuse uploads to store executables or zip files.
+    converted: Optional[bytes]
+    try:
+        if isinstance(image, str):
+            converted, width, height, content_type = attachmentservice.prepare_attachment_image_file(image)
+        else:
+            converted, width, height, content_type = attachmentservice.prepare_attachment_image(image)
+    except AttachmentServiceUnsupportedImageException:
+        raise UserException(f'Chosen attachment {filename} is not a supported image.')
+
+    if content_type != presumed_content_type:
+        # Gotta add a new extension to the file.
+        filename = filename + attachmentservice.get_extension(content_type)
+
+    # The image is validated at this point, so we can attach it and return the ID.
+    attachmentid = attachmentservice.create_attachment(
+        content_type,
+        filename,
+        {
+            MetadataType.WIDTH: width,
+            MetadataType.HEIGHT: height,
+            MetadataType.ALT_TEXT: alt_text,
+            MetadataType.SENSITIVE: sensitive,
+        },
+    )
+    if attachmentid is None:
+        raise Exception("Could not insert message attachment!")
+
+    # If the image was converted we have new data to store, otherwise store what was uploaded.
+    if converted is not None:
+        attachmentservice.put_attachment_data(attachmentid, converted)
+    else:
+        attachmentservice.put_attachment_file(attachmentid, cast(str, image))
+
+    # Generate smaller previews so that clients aren't loading full size images in chat history.
+    # These are optional, so if it fails the original is still served and a backfill can fix it.
+    try:
+        attachmentservice.create_attachment_variants(attachmentid, converted if converted is not None else image)
+    except AttachmentServiceException:
+        pass
+
+    return Attachment.from_id(attachmentid)
+
+
 @upload.route("/upload/attachments", methods=["POST"])
 @loginrequired
 @jsonify
 def attachments_upload() -> Dict[str, object]:
+    if request.mimetype == "multipart/form-data":
+        return _multipart_attachments_upload()
+
     # Ensure that we only allow certain size uploads.
     request.max_content_length = ((((g.config.limits.attachment_size * 1024) * 4) // 3) + 2048) * g.config.limits.attachment_max
 
@@ -184,14 +285,7 @@ def attachments_upload() -> Dict[str, object]:
         if len(alt_text) > g.config.limits.alt_text_length:
             raise UserException(f'Chosen attachment {filename} alt text is too long! Alt text cannot be longer than {g.config.limits.alt_text_length} characters.')
 
-        # Remember the old content type, because if we detect that it's wrong, or we convert the image
-        # we will want to update the filename with the new correct extension.
-        presumed_content_type = attachmentservice.get_content_type(filename)
-
-        if "\\" in filename:
-            _, filename = filename.rsplit("\\", 1)
-        if "/" in filename:
-            _, filename = filename.rsplit("/", 1)
+        filename = _clean_filename(filename)
 
         # TODO: At some point we'll support arbitrary attachments, but for now limit
         # to known image types.
@@ -207,34 +301,71 @@ def attachments_upload() -> Dict[str, object]:
         with urllib.request.urlopen(rawdata) as fp:
             attachmentdata = fp.read()
 
-        # Now, verify the image is actually loadable and the right mimetype. Stop
-        # people from trying to abuse uploads to store executables or zip files.
-        try:
-            attachmentdata, width, height, content_type = attachmentservice.prepare_attachment_image(attachmentdata)
-        except AttachmentServiceUnsupportedImageException:
-            raise UserException(f'Chosen attachment {filename} is not a supported image.')
-
-        if content_type != presumed_content_type:
-            # Gotta add a new extension to the file.
-            filename = filename + attachmentservice.get_extension(content_type)
-
-        # The image is validated at this point, so we can attach it and return the ID.
-        attachmentid = attachmentservice.create_attachment(
-            content_type,
-            filename,
-            {
-                MetadataType.WIDTH: width,
-                MetadataType.HEIGHT: height,
-                MetadataType.ALT_TEXT: alt_text,
-                MetadataType.SENSITIVE: sensitive,
-            },
-        )
-        if attachmentid is None:
-            raise Exception("Could not insert message attachment!")
-        attachmentservice.put_attachment_data(attachmentid, attachmentdata)
-        attachmentids.append(Attachment.from_id(attachmentid))
+        attachmentids.append(_store_message_attachment(attachmentservice, filename, alt_text, sensitive, attachmentdata))
 
     return {"attachments": attachmentids}
 
 
+def _multipart_attachments_upload() -> Dict[str, object]:
+    # Unlike the base64 upload, files are streamed straight to disk here and never held in
+    # memory. The overall request is capped, and each file is capped as it's written.
+    limit = g.config.limits.attachment_size * 1024
+    request.max_content_length = (limit + 2048) * g.config.limits.attachment_max
+
+    attachmentservice = AttachmentService(g.config, g.data)
+    uploads: List[_LimitedUpload] = []
+
+    def stream_factory(
+        total_content_length: Optional[int],
+        content_type: Optional[str],
+        filename: Optional[str],
+        content_length: Optional[int] = None,
+    ) -> IO[bytes]:
+        if len(uploads) >= g.config.limits.attachment_max:
+            raise UserException(f'Too many attachments! You cannot upload more than {g.config.limits.attachment_max} attachments at once.')
+
+        upload = _LimitedUpload(_clean_filename(filename or ""), limit)
+        uploads.append(upload)
+        return cast(IO[bytes], upload)
+
+    try:
+        parser = FormDataParser(
+            stream_factory=stream_factory,
+            # Alt text is the only non-file field that can be large, and it's limited in characters.
+            max_form_memory_size=(g.config.limits.alt_text_length * 4) + 1024,
+            max_form_parts=(g.config.limits.attachment_max * 3) + 10,
+        )
+        _, form, files = parser.parse(request.stream, request.mimetype, request.content_length, request.mimetype_params)
+
+        # Each file has a matching alt text and sensitive field, in the same order as the files.
+        atchlist = files.getlist('attachments')
+        alt_texts = form.getlist('alt_text')
+        sensitives = form.getlist('sensitive')
+        if alt_texts and len(alt_texts) != len(atchlist):
+            raise Exception("Attachment data corrupt or not provided in upload.")
+        if sensitives and len(sensitives) != len(atchlist):
+            raise Exception("Attachment data corrupt or not provided in upload.")
+
+        attachmentids: List[str] = []
+        for i, atch in enumerate(atchlist):
+            filename = _clean_filename(atch.filename or "")
+            alt_text = str(alt_texts[i]) if alt_texts else ""
+            sensitive = str(sensitives[i]).lower() in {"1", "true", "on"} if sensitives else False
+
+            stream = atch.stream
+            if not filename or not isinstance(stream, _LimitedUpload) or stream.size == 0:
+                raise Exception("Attachment data corrupt or not provided in upload.")
+            if len(alt_text) > g.config.limits.alt_text_length:
+                raise UserException(f'Chosen attachment {filename} alt text is too long! Alt text cannot be longer than {g.config.limits.alt_text_length} characters.')
+
+            # Make sure everything is on disk before image processing reads it back.
+            stream.flush()
+            attachmentids.append(_store_message_attachment(attachmentservice, filename, alt_text, sensitive, stream.name))
+
+        return {"attachments": attachmentids}
+    finally:
+        for upload in uploads:
+            upload.close()
+
+
 app.register_blueprint(upload)
@@ -3,7 +3,7 @@ import getpass
 import os
 import string
 import sys
-from typing import Optional
+from typing import List, Optional, cast
 
 from critterchat.data import (
     Data,
@@ -35,6 +35,8 @@ from critterchat.service import (
     UserServiceException,
 )
 from critterchat.http.static import default_avatar, default_room, default_icon
+from critterchat.manage.benchmark import benchmark_badge_counts, benchmark_text_filters
+from critterchat.manage.explain import audit_history_queries, explain_hot_queries
 
 
 class CLIException(Exception):
@@ -90,6 +92,137 @@ def generate_migration(config: Config, message: str, allow_empty: bool) -> None:
     data.close()
 
 
+def rebuild_badges(config: Config) -> None:
+    """
+    Given a config pointing at a valid MySQL DB, recompute every room's unread badge counter and
+    every user's position in those counters from the room history. These are maintained as actions
+    are added, so this should only be needed if they get out of sync.
+    """
+
+    data = Data(config)
+    try:
+        data.room.rebuild_badge_sequences()
+        data.user.rebuild_last_seen_sequences()
+        print("Rebuilt unread badge counters for all rooms.")
+    finally:
+        data.close()
+
+
+def rebuild_search(config: Config) -> None:
+    """
+    Given a config pointing at a valid MySQL DB, rebuild the room and user search index from
+    scratch. The index is maintained as names change, so this should only be needed if it gets
+    out of sync with the rooms and users themselves.
+    """
+
+    data = Data(config)
+    try:
+        rooms, users = data.search.rebuild_search_index()
+        print(f"Rebuilt search index for {rooms} rooms and {users} users.")
+    finally:
+        data.close()
+
+
+def benchmark_badges(config: Config, rooms: List[int], actions: int, iterations: int) -> None:
+    """
+    Given a config pointing at a scratch MySQL DB, time the original per-room unread badge count
+    calculation against the current one for a user in various numbers of rooms. This creates
+    fixture users, rooms and actions, so never point it at a production DB.
+    """
+
+    results = benchmark_badge_counts(config, rooms, actions, iterations)
+
+    print(f"{'Rooms':>6}  {'Original (ms)':>13}  {'Current (ms)':>12}  {'Speedup':>7}  Results")
+    for result in results:
+        legacy = float(str(result['legacy_ms']))
+        current = float(str(result['current_ms']))
+        speedup = f"{legacy / current:.1f}x" if current > 0 else "n/a"
+        matches = "match" if result['matches'] else "MISMATCH"
+        print(f"{result['rooms']:>6}  {legacy:>13.2f}  {current:>12.2f}  {speedup:>7}  {matches}")
+
+
+def benchmark_text(config: Config, iterations: int) -> None:
+    """
+    Time the original message text filters against the current ones over a range of realistic and
+    adversarial messages. This never touches the DB, so it's safe to run anywhere.
+    """
+
+    results = benchmark_text_filters(config, iterations)
+
+    print(f"{'Sample':<22}  {'Filter':<20}  {'Length':>6}  {'Original (ms)':>13}  {'Current (ms)':>12}  {'Speedup':>7}  Results")
+    for result in results:
+        legacy = float(str(result['legacy_ms']))
+        current = float(str(result['current_ms']))
+        speedup = f"{legacy / current:.1f}x" if current > 0 else "n/a"
+        matches = "match" if result['matches'] else "MISMATCH"
+        print(
+            f"{result['sample']:<22}  {result['filter']:<20}  {result['length']:>6}  "
+            f"{legacy:>13.4f}  {current:>12.4f}  {speedup:>7}  {matches}"
+        )
+
+
+def explain_queries(config: Config, roomid: Optional[str]) -> None:
+    """
+    Given a config pointing at a valid MySQL DB, run EXPLAIN on the hot queries against room history
+    and report whether each one is served by the expected index. Optionally takes a room ID to plan
+    against, otherwise uses the room with the most recent activity.
+    """
+
+    actual_id = None
+    if roomid is not None:
+        actual_id = Room.to_id(roomid)
+        if actual_id is None:
+            raise CommandException("Room ID is not valid!")
+
+    results = explain_hot_queries(config, actual_id)
+    if not results:
+        raise CommandException("There is no room history to plan queries against!")
+
+    print(f"{'Query':<32}  {'Key':<28}  {'Rows':>8}  Indexed")
+    for result in results:
+        indexed = "yes" if result['indexed'] else "NO"
+        print(f"{str(result['query']):<32}  {str(result['key']):<28}  {result['rows']:>8}  {indexed}")
+        if not result['indexed']:
+            print(f"{'':<32}  possible keys: {result['possible_keys'] or 'none'}, extra: {result['extra'] or 'none'}")
+
+
+def audit_queries(config: Config, roomid: Optional[str]) -> None:
+    """
+    Given a config pointing at a valid MySQL DB, load a room's history at a few page sizes and check
+    that the number of queries doesn't grow with the size of the page. Optionally takes a room ID to
+    load, otherwise uses the room with the most recent activity.
+    """
+
+    actual_id = None
+    if roomid is not None:
+        actual_id = Room.to_id(roomid)
+        if actual_id is None:
+            raise CommandException("Room ID is not valid!")
+
+    results = audit_history_queries(config, actual_id)
+    if not results:
+        raise CommandException("There is no room history to load!")
+
+    print(f"{'Page size':>9}  {'Actions':>7}  {'Attachments':>11}  {'Queries':>7}  {'Cache hits':>10}")
+    for result in results:
+        print(f"{result['limit']:>9}  {result['actions']:>7}  {result['attachments']:>11}  {result['queries']:>7}  {result['cache_hits']:>10}")
+
+    if len({result['queries'] for result in results}) > 1:
+        raise CommandException("Loading a larger page of history took more queries, something is being looked up per action!")
+
+    # If the room is too quiet to fill the largest page, then the pages didn't really differ in size
+    # and matching query counts prove nothing, so don't let that pass.
+    largest = results[-1]
+    if cast(int, largest['actions']) < cast(int, largest['limit']):
+        raise CommandException(
+            f"Room only has {largest['actions']} actions, which doesn't fill a page of {largest['limit']}, "
+            "so this can't tell whether queries grow with page size! Pick a busier room with --id."
+        )
+    if not any(result['attachments'] for result in results):
+        print("None of the loaded actions had attachments, so attachment lookups were not checked.")
+    print("Loading history takes the same number of queries regardless of page size.")
+
+
 def mastodon_register_all(config: Config) -> None:
     """
     Given configured Mastodon instances in our config, ensure that all of them are registered so that
@@ -481,6 +614,48 @@ def update_attachment(config: Config, attachment: str, file: str) -> None:
         data.close()
 
 
+def generate_attachment_variants(config: Config, force: bool) -> None:
+    """
+    Given a config pointing at a valid MySQL DB, generate the downscaled preview variants for every
+    message attachment image that doesn't have them yet, spreading the work across the image
+    processing workers. With force, variants are regenerated for every image.
+    """
+
+    data = Data(config)
+    try:
+        attachmentservice = AttachmentService(config, data)
+        processed, failed = attachmentservice.backfill_attachment_variants(force)
+
+        print(f"Generated variants for {processed} attachments.")
+        if failed:
+            print(f"Failed to generate variants for {failed} attachments, run this again to retry them.")
+    except AttachmentServiceException as e:
+        raise CommandException(str(e))
+    finally:
+        data.close()
+
+
+def dedupe_attachments(config: Config) -> None:
+    """
+    Given a config pointing at a valid MySQL DB, find every stored attachment that isn't sharing
+    storage yet and point identical ones at a single copy. New uploads are deduplicated as they
+    come in, so this only needs to be run once for attachments uploaded before that.
+    """
+
+    data = Data(config)
+    try:
+        attachmentservice = AttachmentService(config, data)
+        processed, deduplicated, saved = attachmentservice.deduplicate_attachments()
+        blobs, refs, size = data.attachment.get_blob_stats()
+
+        print(f"Checked {processed} attachments, {deduplicated} were duplicates saving {saved / (1024 * 1024):.1f}MB.")
+        print(f"{refs} attachments now share {blobs} stored files totalling {size / (1024 * 1024):.1f}MB.")
+    except AttachmentServiceException as e:
+        raise CommandException(str(e))
+    finally:
+        data.close()
+
+
 def list_public_rooms(config: Config) -> None:
     """
     List all public rooms on the instance.
@@ -862,6 +1037,91 @@ def main() -> None:
         help="tag that we should downgrade to",
     )
 
+    # No params for this one
+    database_commands.add_parser(
+        "rebuild_badges",
+        help="rebuild unread badge counters from room history",
+        description="Rebuild unread badge counters from room history.",
+    )
+
+    # No params for this one
+    database_commands.add_parser(
+        "rebuild_search",
+        help="rebuild the room and user search index",
+        description="Rebuild the room and user search index.",
+    )
+
+    # A few params for this one
+    explain_parser = database_commands.add_parser(
+        "explain",
+        help="check that hot room history queries are using indexes",
+        description="Run EXPLAIN on hot room history queries and report whether each one uses the expected index.",
+    )
+    explain_parser.add_argument(
+        "-i",
+        "--id",
+        type=str,
+        default=None,
+        help="ID of the room to plan queries against (defaults to the most recently active room)",
+    )
+
+    # A few params for this one
+    auditqueries_parser = database_commands.add_parser(
+        "audit_queries",
+        help="check that loading room history doesn't make a query per action",
+        description="Load room history at several page sizes and check that the number of queries doesn't grow with the page size.",
+    )
+    auditqueries_parser.add_argument(
+        "-i",
+        "--id",
+        type=str,
+        default=None,
+        help="ID of the room to load history for (defaults to the most recently active room)",
+    )
+
+    # A few params for this one
+    benchmarkbadges_parser = database_commands.add_parser(
+        "benchmark_badges",
+        help="benchmark unread badge counts against a scratch DB",
+        description="Benchmark unread badge counts against a scratch DB. This writes fixture data, never run it against a production DB.",
+    )
+    benchmarkbadges_parser.add_argument(
+        "-r",
+        "--rooms",
+        type=int,
+        nargs="+",
+        default=[10, 100, 500],
+        help="numbers of joined rooms to benchmark at (defaults to 10 100 500)",
+    )
+    benchmarkbadges_parser.add_argument(
+        "-a",
+        "--actions",
+        type=int,
+        default=50,
+        help="number of actions to create in each benchmark room (defaults to 50)",
+    )
+    benchmarkbadges_parser.add_argument(
+        "-i",
+        "--iterations",
+        type=int,
+        default=20,
+        help="number of times to run each calculation per size (defaults to 20)",
+    )
+
+    # A few params for this one
+    benchmarktext_parser = database_commands.add_parser(
+        "benchmark_text",
+        help="benchmark message text filtering",
+        description="Benchmark the text filters applied to every message and name. This doesn't touch the DB.",
+    )
+    benchmarktext_parser.add_argument(
+        "-i",
+        "--iterations",
+        type=int,
+        default=1000,
+        help="number of times to run each filter per sample (defaults to 1000)",
+    )
+
     # Another subcommand here.
     mastodon_parser = commands.add_parser(
         "mastodon",
@@ -1103,6 +1363,25 @@ def main() -> None:
         help="file you would like to use as the new attachment, or \"default\" to revert to the default",
     )
 
+    # No params for this one
+    attachment_commands.add_parser(
+        "dedupe",
+        help="deduplicate stored attachments",
+        description="Point identical stored attachments at a single shared copy.",
+    )
+
+    # A few params for this one.
+    variantsattachment_parser = attachment_commands.add_parser(
+        "variants",
+        help="generate preview variants for message attachments",
+        description="Generate downscaled preview variants for message attachment images that are missing them.",
+    )
+    variantsattachment_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="regenerate variants for every image, even ones that already have them",
+    )
+
     # Another subcommand here.
     room_parser = commands.add_parser(
         "room",
@@ -1344,6 +1623,18 @@ def main() -> None:
                 upgrade_db(config)
             elif args.database == "downgrade":
                 downgrade_db(config, args.tag)
+            elif args.database == "rebuild_badges":
+                rebuild_badges(config)
+            elif args.database == "rebuild_search":
+                rebuild_search(config)
+            elif args.database == "explain":
+                explain_queries(config, args.id)
+            elif args.database == "audit_queries":
+                audit_queries(config, args.id)
+            elif args.database == "benchmark_badges":
+                benchmark_badges(config, args.rooms, args.actions, args.iterations)
+            elif args.database == "benchmark_text":
+                benchmark_text(config, args.iterations)
             else:
                 raise CLIException(f"Unknown database operation '{args.database}'")
 
@@ -1398,6 +1689,10 @@ def main() -> None:
                 raise CLIException("Unspecified attachment operation!")
             elif args.attach == "update":
                 update_attachment(config, args.attachment, args.file)
+            elif args.attach == "variants":
+                generate_attachment_variants(config, args.force)
+            elif args.attach == "dedupe":
+                dedupe_attachments(config)
             else:
                 raise CLIException(f"Unknown attachment operation '{args.attach}'")
 
@@ -0,0 +1,246 @@
+import random
+import string
+import time
+from typing import Callable, Dict, List, Tuple
+
+from critterchat.common import Time, convert_spaces, represents_real_text
+from critterchat.common.text import KNOWN_CONTROL, KNOWN_MUSICAL_SYMBOLS, KNOWN_SPACES, KNOWN_WHITE_SPACE
+from critterchat.config import Config
+from critterchat.data import (
+    Data,
+    Action,
+    ActionType,
+    Occupant,
+    Room,
+    RoomPurpose,
+    NewActionID,
+    NewOccupantID,
+    NewRoomID,
+    ActionID,
+    RoomID,
+    UserID,
+)
+
+
+def _time_it(func: Callable[[], object], iterations: int) -> float:
+    """
+    Run a function a number of times and return the average wall time in milliseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return ((time.perf_counter() - start) * 1000.0) / iterations
+
+
+def _legacy_get_last_seen_counts(data: Data, userid: UserID) -> List[Tuple[RoomID, int]]:
+    """
+    The original per-room implementation of UserData.get_last_seen_counts, kept here so that
+    the current version can be compared against it.
+    """
+    sql = """
+        SELECT lastseen.room_id AS room_id, lastseen.action_id AS action_id, room.purpose AS purpose
+        FROM lastseen
+        JOIN room ON room.id = lastseen.room_id
+        WHERE user_id = :userid
+    """
+    cursor = data.user.execute(sql, {"userid": userid})
+    counts = [
+        (RoomID(result['room_id']), ActionID(result['action_id']), str(result['purpose']))
+        for result in cursor.mappings()
+    ]
+
+    def types_for(purpose: str) -> List[str]:
+        if purpose == RoomPurpose.DIRECT_MESSAGE:
+            return [str(t) for t in ActionType.unread_dm_types()]
+        else:
+            return [str(t) for t in ActionType.unread_types()]
+
+    computed_counts: List[Tuple[RoomID, int]] = []
+    for roomid, actionid, purpose in counts:
+        sql = """
+            SELECT COUNT(id) AS count FROM action WHERE `room_id` = :roomid AND `id` > :actionid AND `action` IN :types
+        """
+        cursor = data.user.execute(sql, {"roomid": roomid, "actionid": actionid, "types": types_for(purpose)})
+        computed_counts.append((roomid, int(cursor.mappings().fetchone()["count"])))
+
+    seen = [c[0] for c in computed_counts]
+    if seen:
+        sql = """
+            SELECT id, purpose FROM room WHERE id NOT IN :seen AND id IN (
+                SELECT room_id FROM occupant WHERE user_id = :userid AND inactive != TRUE
+            )
+        """
+    else:
+        sql = """
+            SELECT id, purpose FROM room WHERE id IN (
+                SELECT room_id FROM occupant WHERE user_id = :userid AND inactive != TRUE
+            )
+        """
+    cursor = data.user.execute(sql, {"seen": seen, "userid": userid})
+    extra_rooms = [(RoomID(result['id']), str(result['purpose'])) for result in cursor.mappings()]
+
+    for roomid, purpose in extra_rooms:
+        sql = """
+            SELECT COUNT(id) AS count FROM action WHERE `room_id` = :roomid AND `action` IN :types
+        """
+        cursor = data.user.execute(sql, {"roomid": roomid, "types": types_for(purpose)})
+        computed_counts.append((roomid, int(cursor.mappings().fetchone()["count"])))
+
+    return computed_counts
+
+
+def benchmark_badge_counts(config: Config, sizes: List[int], actions: int, iterations: int) -> List[Dict[str, object]]:
+    """
+    Create a throwaway user in increasing numbers of private chats and DMs, each with some history
+    and with a mix of seen and never-seen rooms, and time the original per-room badge count
+    calculation against the current one at each size. Note that this writes fixture
+    data and leaves it behind, so it should only be run against a scratch database.
+
+    Returns:
+        A list of dictionaries, one per size, with the timings and whether the results matched.
+    """
+
+    data = Data(config)
+    try:
+        suffix = "".join(random.choice(string.ascii_lowercase + string.digits) for _ in range(8))
+        user = data.user.create_account(f"badge_benchmark_{suffix}", suffix)
+        if user is None:
+            raise Exception("Logic error, could not create benchmark user!")
+
+        results: List[Dict[str, object]] = []
+        rooms = 0
+        for size in sorted(sizes):
+            # Grow the fixture to the requested size, reusing the rooms from smaller sizes.
+            while rooms < size:
+                # Mix in some DMs so both sets of unread types get exercised.
+                purpose = RoomPurpose.DIRECT_MESSAGE if rooms % 3 == 0 else RoomPurpose.CHAT
+                room = Room(NewRoomID, f"Badge Benchmark {rooms}", "", purpose, False, None, None)
+                data.room.create_room(room)
+                data.room.join_room(room.id, user.id)
+
+                lastid = NewActionID
+                for i in range(actions):
+                    action = Action(
+                        actionid=NewActionID,
+                        timestamp=Time.now(),
+                        occupant=Occupant(occupantid=NewOccupantID, userid=user.id),
+                        action=ActionType.MESSAGE,
+                        details={"message": f"Benchmark message {i}"},
+                    )
+                    data.room.insert_action(room.id, action)
+                    if i == actions // 2:
+                        lastid = action.id
+
+                # Leave every other room without a last seen marker, so both halves of the
+                # calculation get exercised.
+                if rooms % 2 == 0 and lastid != NewActionID:
+                    data.user.mark_last_seen(user.id, room.id, lastid)
+
+                rooms += 1
+
+            legacy = sorted(_legacy_get_last_seen_counts(data, user.id))
+            current = sorted(data.user.get_last_seen_counts(user.id))
+
+            results.append({
+                "rooms": size,
+                "legacy_ms": _time_it(lambda: _legacy_get_last_seen_counts(data, user.id), iterations),
+                "current_ms": _time_it(lambda: data.user.get_last_seen_counts(user.id), iterations),
+                "matches": legacy == current,
+            })
+
+        return results
+    finally:
+        data.close()
+
+
+def _legacy_convert_spaces(string: str) -> str:
+    """
+    The original replace-per-character implementation of convert_spaces, kept here so that
+    the current version can be compared against it.
+    """
+    for space in KNOWN_SPACES:
+        string = string.replace(space, " ")
+    return string
+
+
+def _legacy_represents_real_text(string: str) -> bool:
+    """
+    The original replace-per-character implementation of represents_real_text, kept here so
+    that the current version can be compared against it.
+    """
+    for char in KNOWN_SPACES:
+        string = string.replace(char, "")
+    for char in KNOWN_WHITE_SPACE:
+        string = string.replace(char, "")
+    for char in KNOWN_CONTROL:
+        string = string.replace(char, "")
+    for char in KNOWN_MUSICAL_SYMBOLS:
+        string = string.replace(char, "")
+    for val in range(0xE0001, 0xE0080):
+        string = string.replace(chr(val), "")
+    for val in range(0xFE00, 0xFE10):
+        string = string.replace(chr(val), "")
+    for val in range(0xE0100, 0xE01F0):
+        string = string.replace(chr(val), "")
+
+    return bool(string.strip())
+
+
+def _text_samples(length: int) -> List[Tuple[str, str]]:
+    """
+    Build a handful of messages ranging from what people actually send to what somebody trying
+    to slow the server down would send, each capped at the given length.
+    """
+    rng = random.Random(1337)
+
+    words = ["hello", "the", "critter", "chat", "is", "pretty", "neat", "today", ":wiggle:", "lol"]
+    prose = " ".join(rng.choice(words) for _ in range(length))[:length]
+
+    # Every letter buried under a pile of combining marks, the classic zalgo text.
+    zalgo = "".join(
+        rng.choice(string.ascii_letters) + "".join(chr(rng.randint(0x0300, 0x036F)) for _ in range(8))
+        for _ in range(length // 9 + 1)
+    )[:length]
+
+    # Nothing but characters that get stripped, so every replace has to do real work.
+    invisible = KNOWN_SPACES + KNOWN_WHITE_SPACE + KNOWN_CONTROL + KNOWN_MUSICAL_SYMBOLS + [chr(0xFE0F), chr(0xE0020)]
+    blank = "".join(rng.choice(invisible) for _ in range(length))
+
+    return [
+        ("short message", "hey, did anyone see the new emotes? :wiggle:"),
+        ("max length prose", prose),
+        ("max length zalgo", zalgo),
+        ("max length invisible", blank),
+        ("fancy spaced name", "Some\u2003Fancy\u00A0Critter\u3000Name"),
+    ]
+
+
+def benchmark_text_filters(config: Config, iterations: int) -> List[Dict[str, object]]:
+    """
+    Time the original replace-per-character text filters against the current ones over a mix of
+    realistic and adversarial messages up to the configured maximum message length. This doesn't
+    touch the database at all, so it's safe to run anywhere.
+
+    Returns:
+        A list of dictionaries, one per sample and filter, with the timings and whether the
+        results matched.
+    """
+
+    filters: List[Tuple[str, Callable[[str], object], Callable[[str], object]]] = [
+        ("represents_real_text", _legacy_represents_real_text, represents_real_text),
+        ("convert_spaces", _legacy_convert_spaces, convert_spaces),
+    ]
+
+    results: List[Dict[str, object]] = []
+    for name, sample in _text_samples(config.limits.message_length):
+        for filtername, legacy, current in filters:
+            results.append({
+                "sample": name,
+                "filter": filtername,
+                "length": len(sample),
+                "legacy_ms": _time_it(lambda: legacy(sample), iterations),
+                "current_ms": _time_it(lambda: current(sample), iterations),
+                "matches": legacy(sample) == current(sample),
+            })
+
+    return results
@@ -0,0 +1,180 @@
+from typing import Dict, List, Optional, Tuple
+
+from critterchat.config import Config
+from critterchat.data import (
+    Data,
+    ActionType,
+    RoomID,
+)
+from critterchat.service import MessageService
+
+
+# The hot queries against the action table, along with the indexes we expect MySQL to pick
+# for each of them. These mirror the queries in RoomData and UserData, so if one of those
+# changes shape it should be updated here as well.
+_HOT_QUERIES: List[Tuple[str, str, Tuple[str, ...]]] = [
+    (
+        "room history, newest page",
+        """
+            SELECT id, timestamp, occupant_id, action, details
+            FROM action
+            WHERE room_id = :roomid AND action IN :types
+            ORDER BY id DESC LIMIT :limit
+        """,
+        ("ix_action_room_id_id", "ix_action_room_id_action_id"),
+    ),
+    (
+        "room history, before an action",
+        """
+            SELECT id, timestamp, occupant_id, action, details
+            FROM action
+            WHERE room_id = :roomid AND id < :actionid AND action IN :types
+            ORDER BY id DESC LIMIT :limit
+        """,
+        ("ix_action_room_id_id", "ix_action_room_id_action_id"),
+    ),
+    (
+        "room history, after an action",
+        """
+            SELECT id, timestamp, occupant_id, action, details
+            FROM action
+            WHERE room_id = :roomid AND id > :actionid AND action IN :types
+            ORDER BY id ASC LIMIT :limit
+        """,
+        ("ix_action_room_id_id", "ix_action_room_id_action_id"),
+    ),
+    (
+        "room updates, after an action",
+        """
+            SELECT id, timestamp, occupant_id, action, details
+            FROM action
+            WHERE room_id = :roomid AND id > :actionid AND action IN :types
+            ORDER BY id DESC
+        """,
+        ("ix_action_room_id_id", "ix_action_room_id_action_id"),
+    ),
+    (
+        "last seen badge position",
+        """
+            SELECT badge_seq FROM action WHERE room_id = :roomid AND id <= :actionid ORDER BY id DESC LIMIT 1
+        """,
+        ("ix_action_room_id_id",),
+    ),
+]
+
+
+# Page sizes to load history with when counting queries. Everything on a page is resolved in
+# batches, so the smallest and largest page should take exactly the same number of queries.
+_AUDIT_PAGE_SIZES: Tuple[int, ...] = (1, 10, MessageService.MAX_HISTORY)
+
+
+def _get_active_room(data: Data) -> Optional[RoomID]:
+    # The room which most recently had an action, if there's any history at all.
+    cursor = data.room.execute("SELECT room_id FROM action ORDER BY id DESC LIMIT 1", {})
+    result = cursor.mappings().fetchone()
+    if result is None:
+        return None
+    return RoomID(result['room_id'])
+
+
+def explain_hot_queries(config: Config, roomid: Optional[RoomID]) -> List[Dict[str, object]]:
+    """
+    Run EXPLAIN against each of the hot queries on the action table and report which index
+    MySQL chose for each one. Nothing is written, so this is safe to run against a production DB,
+    though the plans are only meaningful on a DB with a realistic amount of history.
+
+    Parameters:
+        roomid - Optional room to plan the queries against. If not provided, the room which most
+                 recently had an action is used instead.
+
+    Returns:
+        A list of dictionaries, one per query, with the chosen key, the candidate keys, the estimated
+        number of rows examined and whether one of the expected indexes was used. If there is no
+        history to plan against, an empty list is returned.
+    """
+
+    data = Data(config)
+    try:
+        if roomid is None:
+            roomid = _get_active_room(data)
+            if roomid is None:
+                return []
+
+        # Plan around the middle of the room's history so that range scans look realistic.
+        room = data.room.get_room(roomid)
+        if room is None or room.oldest_action is None or room.newest_action is None:
+            return []
+        actionid = (room.oldest_action + room.newest_action) // 2
+
+        params: Dict[str, object] = {
+            "roomid": roomid,
+            "actionid": actionid,
+            "limit": 100,
+            "types": [str(t) for t in ActionType.unread_types()],
+        }
+
+        results: List[Dict[str, object]] = []
+        for name, sql, expected in _HOT_QUERIES:
+            cursor = data.room.execute("EXPLAIN " + sql, params)
+            plan = [row for row in cursor.mappings() if row['table'] == "action"]
+            key = str(plan[0]['key']) if plan and plan[0]['key'] is not None else None
+
+            results.append({
+                "query": name,
+                "key": key,
+                "possible_keys": str(plan[0]['possible_keys'] or "") if plan else "",
+                "rows": int(plan[0]['rows'] or 0) if plan else 0,
+                "extra": str(plan[0]['Extra'] or "") if plan else "",
+                "indexed": key in expected,
+            })
+
+        return results
+    finally:
+        data.close()
+
+
+def audit_history_queries(config: Config, roomid: Optional[RoomID]) -> List[Dict[str, object]]:
+    """
+    Load the newest page of a room's history through the message service at a few different page
+    sizes, counting the queries each load makes. Actions, occupants, attachments and icons on a page
+    are all looked up in batches, so if a larger page takes more queries than a smaller one then
+    something has started looking things up per action. Nothing is written, so this is safe to run
+    against a production DB.
+
+    Parameters:
+        roomid - Optional room to load history for. If not provided, the room which most recently
+                 had an action is used instead.
+
+    Returns:
+        A list of dictionaries, one per page size, with the number of actions loaded and the number
+        of queries and cache hits it took. If there is no history to load, an empty list is returned.
+    """
+
+    if roomid is None:
+        data = Data(config)
+        try:
+            roomid = _get_active_room(data)
+        finally:
+            data.close()
+        if roomid is None:
+            return []
+
+    results: List[Dict[str, object]] = []
+    for limit in _AUDIT_PAGE_SIZES:
+        # Use a fresh data object for each load so that nothing is served out of the identity map
+        # from a previous one.
+        data = Data(config)
+        try:
+            messageservice = MessageService(config, data)
+            actions, _ = messageservice.get_room_history(roomid, limit=limit)
+            results.append({
+                "limit": limit,
+                "actions": len(actions),
+                "attachments": sum(len(action.attachments) for action in actions),
+                "queries": data.query_count,
+                "cache_hits": data.cache_hits,
+            })
+        finally:
+            data.close()
+
+    return results
@@ -3,6 +3,7 @@ from .attachment import (
     AttachmentServiceException,
     AttachmentServiceInvalidSizeException,
     AttachmentServiceUnsupportedImageException,
+    local_attachment_file,
 )
 from .emote import (
     EmoteService,
@@ -26,6 +27,7 @@ __all__ = [
     "AttachmentServiceException",
     "AttachmentServiceInvalidSizeException",
     "AttachmentServiceUnsupportedImageException",
+    "local_attachment_file",
     "EmoteService",
     "EmoteServiceException",
     "MastodonService",
@@ -1,14 +1,29 @@
 import io
 import hashlib
+import hmac
 import mimetypes
 import os
+import random
+import re
+import shutil
 from PIL import Image, ImageOps
-from typing import Dict, Final, Optional, Tuple, cast
-
+from typing import Dict, Final, Iterable, Iterator, List, Optional, Set, Tuple, Union, cast
+
+from ..common import LRUCache
+from ..common.imaging import (
+    ERROR_SIZE,
+    ERROR_UNSUPPORTED,
+    ImageJobException,
+    VariantResult,
+    run_image_job,
+    run_variant_job,
+    run_variant_jobs,
+)
 from ..config import Config
 from ..data import (
     Data,
     Attachment,
+    AttachmentVariant,
     Action,
     ActionType,
     MetadataType,
@@ -21,6 +36,7 @@ from ..data import (
     DefaultRoomID,
     FaviconID,
 )
+from ..data.attachment import Attachment as StoredAttachment
 from ..http.static import default_avatar, default_room, default_icon
 
 
@@ -40,10 +56,65 @@ class AttachmentServiceInvalidSizeException(AttachmentServiceException):
     pass
 
 
+# Attachment names are needed for every icon and attachment we send to clients, and they never change
+# once an attachment is created, so remember the ones we've used recently to save on DB lookups.
+_ATTACHMENT_NAME_CACHE_SIZE: Final[int] = 10000
+_attachment_names: LRUCache[AttachmentID, str] = LRUCache(_ATTACHMENT_NAME_CACHE_SIZE)
 _hash_to_id_lut: Dict[str, AttachmentID] = {}
-_id_to_hash_lut: Dict[AttachmentID, str] = {}
 _emotes_initialized: bool = False
 
+# Hashed attachment names are 40 hex characters followed by an optional extension.
+_hashed_name_re = re.compile(r"^[0-9a-f]{40}(\.[A-Za-z0-9]+)?$")
+
+# The extensions that we pick ourselves based on an attachment's content type, and that content type.
+# Attachments can also keep any extension from their original filename, so names with an extension
+# that isn't one of these have to be looked up in the DB to find out what was stored.
+_extension_types: Final[Dict[str, str]] = {
+    ".apng": "image/apng",
+    ".gif": "image/gif",
+    ".jpg": "image/jpeg",
+    ".mp3": "audio/mpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+}
+
+
+def local_attachment_file(config: Config, name: str) -> Optional[Tuple[str, str]]:
+    """
+    Given the name of an attachment as it appears in its URL, figure out where it lives in local
+    storage and what content type it is, without touching the DB. This works because attachments
+    are stored under the same hashed name that they're served under, and that name usually carries
+    the extension that the content type was derived from.
+
+    Returns:
+        A tuple of the path to the file and its content type, or None if that can't be determined
+        from the name alone. In that case, use AttachmentService.get_local_attachment_file instead.
+        Note that the file is not guaranteed to exist.
+    """
+    if config.attachments.system != "local" or not config.attachments.directory:
+        return None
+
+    # Default attachments are copied from our static files, so use those to know their type.
+    defaults = {
+        Attachment.from_id(DefaultAvatarID): default_avatar,
+        Attachment.from_id(DefaultRoomID): default_room,
+        Attachment.from_id(FaviconID): default_icon,
+    }
+    if name in defaults:
+        try:
+            content_type = mimetypes.types_map[os.path.splitext(defaults[name].lower())[1]]
+        except KeyError:
+            content_type = "application/octet-stream"
+    elif _hashed_name_re.match(name):
+        ext = os.path.splitext(name)[1]
+        if ext not in _extension_types:
+            return None
+        content_type = _extension_types[ext]
+    else:
+        return None
+
+    return os.path.join(os.path.abspath(config.attachments.directory), name), content_type
+
 
 class AttachmentService:
     MAX_ICON_WIDTH: Final[int] = 512
@@ -51,6 +122,9 @@ class AttachmentService:
     SUPPORTED_IMAGE_TYPES = {"image/apng", "image/gif", "image/jpeg", "image/png", "image/webp"}
     CONVERTIBLE_IMAGE_TYPES = {"image/bmp"}
 
+    # Bounding sizes of the downscaled previews generated for message attachment images.
+    VARIANT_SIZES: Final[Tuple[int, ...]] = (256, 768)
+
     def __init__(self, config: Config, data: Data) -> None:
         self.__config = config
         self.__data = data
@@ -59,10 +133,8 @@ class AttachmentService:
         if not _emotes_initialized:
             emotes = self.__data.attachment.get_emotes()
             for emote in emotes:
-                _id_to_hash_lut[emote.attachmentid] = self._get_hashed_attachment_name(
-                    # Emotes always have an empty filename, we don't store it.
-                    emote.attachmentid, emote.content_type, None,
-                )
+                # Emotes always have an empty filename, we don't store it.
+                self._remember_attachment_name(emote.attachmentid, emote.content_type, None)
 
             _emotes_initialized = True
 
@@ -107,6 +179,38 @@ class AttachmentService:
 
         return os.path.join(directory, self._get_hashed_attachment_name(aid, content_type, original_filename))
 
+    def _get_local_blob_path(self, hashval: str) -> str:
+        directory = self.__config.attachments.directory
+        if not directory:
+            raise AttachmentServiceException("Cannot find directory for local attachment storage!")
+
+        # Blobs live in their own directory under the attachment directory, since attachments are
+        # hard links to them and those can't cross filesystems. That directory is still reachable
+        # wherever attachments are served from, so name blobs by a keyed hash of their contents
+        # rather than the plain hash, otherwise anybody could fetch a file just by knowing its hash.
+        hashkey = self.__config.attachments.attachment_key
+        blobname = hmac.new(hashkey.encode('utf-8'), hashval.encode('utf-8'), hashlib.sha256).hexdigest()
+        return os.path.join(directory, "blobs", blobname)
+
+    def _get_hashed_variant_name(self, aid: AttachmentID, variant: Dict[str, object]) -> str:
+        # Variants are hashed the same way as the original but with their size mixed in, so they
+        # can't be guessed from the original's name or from each other. Variants can be regenerated,
+        # and are served as immutable, so a digest of their contents is mixed in as well so that
+        # regenerating one gives it a new name. Variants from before we did this don't have one.
+        hashkey = self.__config.attachments.attachment_key
+        inval = f"{hashkey}-{Attachment.from_id(aid)}-{variant['size']}"
+        if variant.get("digest"):
+            inval = f"{inval}-{variant['digest']}"
+        hashval = hashlib.shake_256(inval.encode('utf-8')).hexdigest(20)
+        return f"{hashval}{self.get_extension(str(variant['content_type']))}"
+
+    def _get_local_variant_path(self, aid: AttachmentID, variant: Dict[str, object]) -> str:
+        directory = self.__config.attachments.directory
+        if not directory:
+            raise AttachmentServiceException("Cannot find directory for local attachment storage!")
+
+        return os.path.join(directory, self._get_hashed_variant_name(aid, variant))
+
     def create_default_attachments(self) -> None:
         for aid, default in [
             (DefaultAvatarID, default_avatar),
@@ -253,10 +357,37 @@ class AttachmentService:
         for attachment in attachments:
             calculated = self._get_hashed_attachment_name(attachment.id, attachment.content_type, attachment.original_filename)
             _hash_to_id_lut[calculated] = attachment.id
-            _id_to_hash_lut[attachment.id] = calculated
 
         return _hash_to_id_lut.get(path, None)
 
+    def get_local_attachment_file(self, name: str) -> Optional[Tuple[str, str]]:
+        """
+        Given the name of an attachment as it appears in its URL, figure out where it lives in local
+        storage and what content type it was stored as, looking it up in the DB if the name alone
+        isn't enough to go on.
+
+        Returns:
+            A tuple of the path to the file and its content type, or None if there's no such
+            attachment. Note that the file is not guaranteed to exist.
+        """
+        location = local_attachment_file(self.__config, name)
+        if location is not None:
+            return location
+
+        if self.__config.attachments.system != "local":
+            return None
+
+        attachmentid = self.id_from_path(name)
+        if attachmentid is None:
+            return None
+
+        attachment = self.__data.attachment.lookup_attachment(attachmentid)
+        if not attachment or attachment.system != "local":
+            return None
+
+        path = self._get_local_attachment_path(attachment.id, attachment.content_type, attachment.original_filename)
+        return os.path.abspath(path), attachment.content_type
+
     def create_attachment(
         self,
         content_type: str,
@@ -327,14 +458,128 @@ class AttachmentService:
             return
 
         if attachment.system == "local":
-            # Local storage, look up the storage directory and write the data.
-            path = self._get_local_attachment_path(attachment.id, attachment.content_type, attachment.original_filename)
-            with open(path, "wb") as bfp:
-                bfp.write(data)
+            # Local storage, store the data in a blob shared with anything identical.
+            self.__put_local_blob(attachment, data)
+        else:
+            # Unknown backend, throw.
+            raise AttachmentServiceException("Unrecognized backend system!")
+
+    def put_attachment_file(self, attachmentid: AttachmentID, path: str) -> None:
+        attachment = self.__data.attachment.lookup_attachment(attachmentid)
+        if not attachment:
+            return
+
+        if attachment.system == "local":
+            # Local storage, same as above but without reading the whole file into memory.
+            self.__put_local_blob(attachment, path)
         else:
             # Unknown backend, throw.
             raise AttachmentServiceException("Unrecognized backend system!")
 
+    def __hash_contents(self, source: Union[bytes, str]) -> Tuple[str, int]:
+        if isinstance(source, bytes):
+            return hashlib.sha256(source).hexdigest(), len(source)
+
+        hasher = hashlib.sha256()
+        size = 0
+        with open(source, "rb") as bfp:
+            while chunk := bfp.read(1024 * 1024):
+                hasher.update(chunk)
+                size += len(chunk)
+        return hasher.hexdigest(), size
+
+    def __write_local_file(self, path: str, source: Union[bytes, str]) -> None:
+        # Write next to the destination and move it into place, so nobody ever sees half a file.
+        tmppath = f"{path}.{random.randint(0, 2 ** 31)}.tmp"
+        if isinstance(source, bytes):
+            with open(tmppath, "wb") as bfp:
+                bfp.write(source)
+        else:
+            shutil.copyfile(source, tmppath)
+        os.replace(tmppath, path)
+
+    def __link_local_file(self, blobpath: str, path: str, source: Union[bytes, str]) -> None:
+        # Attachments are hard links to their blob, so that they can keep being served by name
+        # without a DB lookup while only taking up the space of one copy.
+        tmppath = f"{path}.{random.randint(0, 2 ** 31)}.tmp"
+        try:
+            os.link(blobpath, tmppath)
+        except FileNotFoundError:
+            # The last other reference to this blob was released at the same time, so put it back.
+            self.__write_local_file(blobpath, source)
+            os.link(blobpath, tmppath)
+        except OSError:
+            # The filesystem doesn't support hard links, so fall back to a plain copy.
+            shutil.copyfile(blobpath, tmppath)
+        os.replace(tmppath, path)
+
+    def __put_local_blob(self, attachment: StoredAttachment, source: Union[bytes, str]) -> None:
+        previous = attachment.blobid
+        hashval, size = self.__hash_contents(source)
+        blobid, created = self.__data.attachment.reference_blob(hashval, size)
+
+        blobpath = self._get_local_blob_path(hashval)
+        if created or not os.path.isfile(blobpath):
+            os.makedirs(os.path.dirname(blobpath), exist_ok=True)
+            self.__write_local_file(blobpath, source)
+
+        path = self._get_local_attachment_path(attachment.id, attachment.content_type, attachment.original_filename)
+        self.__link_local_file(blobpath, path, source)
+        self.__data.attachment.set_attachment_blob(attachment.id, blobid)
+
+        # If this attachment was overwritten, let go of whatever it used to point at.
+        if previous is not None:
+            self.__release_local_blob(previous)
+
+    def __release_local_blob(self, blobid: int) -> None:
+        hashval = self.__data.attachment.release_blob(blobid)
+        if hashval is not None:
+            try:
+                os.remove(self._get_local_blob_path(hashval))
+            except FileNotFoundError:
+                pass
+
+    def deduplicate_attachments(self) -> Tuple[int, int, int]:
+        if self.__config.attachments.system != "local":
+            # Unknown backend, throw.
+            raise AttachmentServiceException("Unrecognized backend system!")
+
+        processed = 0
+        deduplicated = 0
+        saved = 0
+        for attachment in self.__data.attachment.get_attachments():
+            if attachment.system != "local" or attachment.blobid is not None:
+                # Either not something we know how to handle, or it's already stored in a blob.
+                continue
+
+            path = self._get_local_attachment_path(attachment.id, attachment.content_type, attachment.original_filename)
+            if not os.path.isfile(path):
+                continue
+
+            hashval, size = self.__hash_contents(path)
+            blobid, created = self.__data.attachment.reference_blob(hashval, size)
+
+            blobpath = self._get_local_blob_path(hashval)
+            if created or not os.path.isfile(blobpath):
+                # First time we've seen these contents, so this attachment's file becomes the blob.
+                os.makedirs(os.path.dirname(blobpath), exist_ok=True)
+                try:
+                    os.link(path, blobpath)
+                except FileExistsError:
+                    pass
+                except OSError:
+                    shutil.copyfile(path, blobpath)
+            else:
+                # We already have these contents, so swap this copy out for a link to the blob.
+                self.__link_local_file(blobpath, path, path)
+                deduplicated += 1
+                saved += size
+
+            self.__data.attachment.set_attachment_blob(attachment.id, blobid)
+            processed += 1
+
+        return processed, deduplicated, saved
+
     def delete_attachment_data(self, attachmentid: AttachmentID) -> None:
         attachment = self.__data.attachment.lookup_attachment(attachmentid)
         if not attachment:
@@ -347,43 +592,168 @@ class AttachmentService:
                 os.remove(path)
             except FileNotFoundError:
                 pass
+
+            # The contents only go away once nothing else is sharing them.
+            previous = attachment.blobid
+            if previous is not None:
+                self.__data.attachment.set_attachment_blob(attachment.id, None)
+                self.__release_local_blob(previous)
         else:
             # Unknown backend, throw.
             raise AttachmentServiceException("Unrecognized backend system!")
 
-    def prepare_attachment_image(self, data: bytes, max_width: Optional[int] = None, max_height: Optional[int] = None) -> Tuple[bytes, int, int, str]:
-        try:
-            img = Image.open(io.BytesIO(data))
-        except Exception:
-            raise AttachmentServiceUnsupportedImageException("Unsupported image provided for attachment.")
+        self._delete_variant_data(attachment.id, attachment.system, attachment.metadata)
 
-        transposed = ImageOps.exif_transpose(img)
-        width, height = transposed.size
-        if max_width is not None and width > max_width:
-            raise AttachmentServiceInvalidSizeException("Invalid image size for attachment.")
-        if max_height is not None and height > max_height:
-            raise AttachmentServiceInvalidSizeException("Invalid image size for attachment.")
+    def _delete_variant_data(self, attachmentid: AttachmentID, system: str, metadata: Dict[MetadataType, object]) -> None:
+        for variant in cast(List[Dict[str, object]], metadata.get(MetadataType.VARIANTS) or []):
+            if system == "local":
+                path = self._get_local_variant_path(attachmentid, variant)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            else:
+                # Unknown backend, throw.
+                raise AttachmentServiceException("Unrecognized backend system!")
 
-        content_type = img.get_format_mimetype()
-        if not content_type:
-            raise AttachmentServiceUnsupportedImageException("Attachment image is an unrecognized format.")
-        content_type = content_type.lower()
+    def _put_variant_data(self, attachmentid: AttachmentID, variants: List[VariantResult]) -> None:
+        attachment = self.__data.attachment.lookup_attachment(attachmentid)
+        if not attachment:
+            return
+
+        # Each variant is named after its contents, so a regenerated variant never replaces a file
+        # that clients may have cached. Write each one next to where it goes and move it into place,
+        # so nothing is ever served a half-written file.
+        generated: List[Dict[str, object]] = []
+        for size, data, width, height, content_type in variants:
+            variant: Dict[str, object] = {
+                "size": size,
+                "width": width,
+                "height": height,
+                "content_type": content_type,
+                "digest": hashlib.sha256(data).hexdigest()[:16],
+            }
+            if attachment.system == "local":
+                path = self._get_local_variant_path(attachment.id, variant)
+                self.__write_local_file(path, data)
+            else:
+                # Unknown backend, throw.
+                raise AttachmentServiceException("Unrecognized backend system!")
+            generated.append(variant)
+
+        # Record what we generated, even if that's nothing, so that backfills know this was handled.
+        self.__data.attachment.update_attachment_metadata(attachment.id, {MetadataType.VARIANTS: generated})
+
+        # Now that nothing points at them anymore, get rid of any variants from a previous run
+        # that didn't come out exactly the same this time.
+        current = {self._get_hashed_variant_name(attachment.id, variant) for variant in generated}
+        stale = [
+            variant
+            for variant in cast(List[Dict[str, object]], attachment.metadata.get(MetadataType.VARIANTS) or [])
+            if self._get_hashed_variant_name(attachment.id, variant) not in current
+        ]
+        if stale:
+            self._delete_variant_data(attachment.id, attachment.system, {MetadataType.VARIANTS: stale})
+
+    def create_attachment_variants(self, attachmentid: AttachmentID, source: Union[bytes, str]) -> int:
+        # Resizing is just as slow as preparing the image in the first place, so it's also done in
+        # a worker process while we wait. The source can be the image data or a path to it.
+        try:
+            variants = run_variant_job(self.__config, source, self.VARIANT_SIZES)
+        except ImageJobException as e:
+            raise AttachmentServiceException(str(e))
+
+        self._put_variant_data(attachmentid, variants)
+        return len(variants)
+
+    def backfill_attachment_variants(self, force: bool = False) -> Tuple[int, int]:
+        attachments = [
+            attachment for attachment in self.__data.attachment.get_message_attachments()
+            if attachment.content_type in self.SUPPORTED_IMAGE_TYPES and (force or MetadataType.VARIANTS not in attachment.metadata)
+        ]
+
+        def jobs() -> Iterator[Tuple[AttachmentID, bytes]]:
+            # Only load each attachment as the worker pool is ready for it, instead of all of them at once.
+            for attachment in attachments:
+                content_type_and_data = self.get_attachment_data(attachment.id)
+                if content_type_and_data:
+                    yield attachment.id, content_type_and_data[1]
+
+        processed = 0
+        failed = 0
+        for attachmentid, variants in run_variant_jobs(self.__config, jobs(), self.VARIANT_SIZES):
+            if variants is None:
+                failed += 1
+                continue
+
+            self._put_variant_data(attachmentid, variants)
+            processed += 1
+
+        return processed, failed
 
-        if content_type in self.CONVERTIBLE_IMAGE_TYPES:
-            # We want to convert this to a PNG file so that we can support uploading it.
-            converted = transposed.convert("RGB")
-            converted_array = io.BytesIO()
-            converted.save(converted_array, format='PNG')
-            data = converted_array.getvalue()
+    def prepare_attachment_image(self, data: bytes, max_width: Optional[int] = None, max_height: Optional[int] = None) -> Tuple[bytes, int, int, str]:
+        return self.__prepare_image(data, max_width, max_height)
 
-            # We've updated the content type to a PNG now, so reflect that.
-            content_type = "image/png"
+    def prepare_attachment_image_file(self, path: str, max_width: Optional[int] = None, max_height: Optional[int] = None) -> Tuple[Optional[bytes], int, int, str]:
+        # The file is only read by the worker, so we get data back only if it had to be converted.
+        # Otherwise, None is returned and the file itself should be stored.
+        data, width, height, content_type = self.__prepare_image(path, max_width, max_height)
+        return data or None, width, height, content_type
 
-        if content_type not in self.SUPPORTED_IMAGE_TYPES:
+    def __prepare_image(self, source: Union[bytes, str], max_width: Optional[int], max_height: Optional[int]) -> Tuple[bytes, int, int, str]:
+        # Decoding and converting images is slow enough to stall every other client, so it's done
+        # in a worker process while we wait.
+        try:
+            error, data, width, height, content_type = run_image_job(
+                self.__config,
+                source,
+                max_width,
+                max_height,
+                frozenset(self.SUPPORTED_IMAGE_TYPES),
+                frozenset(self.CONVERTIBLE_IMAGE_TYPES),
+            )
+        except ImageJobException as e:
+            raise AttachmentServiceException(str(e))
+
+        if error == ERROR_UNSUPPORTED:
+            raise AttachmentServiceUnsupportedImageException("Unsupported image provided for attachment.")
+        if error == ERROR_SIZE:
+            raise AttachmentServiceInvalidSizeException("Invalid image size for attachment.")
+        if error is not None:
             raise AttachmentServiceUnsupportedImageException("Attachment image is an unrecognized format.")
 
         return data, width, height, content_type
 
+    def resolve_attachment(
+        self,
+        attachmentid: AttachmentID,
+        content_type: str,
+        original_filename: Optional[str],
+        metadata: Dict[MetadataType, object],
+    ) -> Attachment:
+        # We already know everything needed to name this attachment, so no need to look it up.
+        name = self._remember_attachment_name(attachmentid, content_type, original_filename)
+
+        variants: List[AttachmentVariant] = []
+        for variant in cast(List[Dict[str, object]], metadata.get(MetadataType.VARIANTS) or []):
+            variant_type = str(variant["content_type"])
+            variants.append(
+                AttachmentVariant(
+                    self._get_url_for_name(self._get_hashed_variant_name(attachmentid, variant)),
+                    variant_type,
+                    int(cast(int, variant["width"])),
+                    int(cast(int, variant["height"])),
+                )
+            )
+
+        return Attachment(
+            attachmentid,
+            self._get_url_for_name(name),
+            content_type,
+            {key: value for key, value in metadata.items() if key != MetadataType.VARIANTS},
+            variants,
+        )
+
     def resolve_user_icon(self, user: User) -> User:
         if user.iconid is None:
             user.icon = self.get_attachment_url(DefaultAvatarID)
@@ -398,6 +768,23 @@ class AttachmentService:
             occupant.icon = self.get_attachment_url(occupant.iconid)
         return occupant
 
+    def resolve_occupant_icons(self, occupants: List[Occupant]) -> List[Occupant]:
+        self.get_attachment_urls({o.iconid for o in occupants if o.iconid is not None})
+        return [self.resolve_occupant_icon(o) for o in occupants]
+
+    def resolve_action_icons(self, actions: List[Action]) -> List[Action]:
+        # Look up every icon these actions refer to at once, so resolving them one at a time below
+        # never needs to go to the DB.
+        ids: Set[AttachmentID] = set()
+        for action in actions:
+            if action.occupant and action.occupant.iconid is not None:
+                ids.add(action.occupant.iconid)
+            if action.action in {ActionType.CHANGE_INFO, ActionType.CHANGE_PROFILE} and action.details.get("iconid") is not None:
+                ids.add(AttachmentID(cast(int, action.details["iconid"])))
+        self.get_attachment_urls(ids)
+
+        return [self.resolve_action_icon(a) for a in actions]
+
     def resolve_action_icon(self, action: Action) -> Action:
         if action.occupant:
             self.resolve_occupant_icon(action.occupant)
@@ -455,37 +842,51 @@ class AttachmentService:
             room.deficon = self.get_attachment_url(room.deficonid)
         return room
 
-    def _get_attachment_name(self, attachmentid: AttachmentID) -> str:
-        if attachmentid in _id_to_hash_lut:
-            return _id_to_hash_lut[attachmentid]
-
-        if attachmentid in {DefaultAvatarID, DefaultRoomID, FaviconID}:
-            _id_to_hash_lut[attachmentid] = self._get_hashed_attachment_name(attachmentid, 'application/octet-stream', None)
-            return _id_to_hash_lut[attachmentid]
-
-        attachment = self.__data.attachment.lookup_attachment(attachmentid)
-        if not attachment:
-            # We can't find the attachment, so assume that it has no extension and try that.
-            _id_to_hash_lut[attachmentid] = self._get_hashed_attachment_name(attachmentid, 'application/octet-stream', None)
-            return _id_to_hash_lut[attachmentid]
-
-        _id_to_hash_lut[attachmentid] = self._get_hashed_attachment_name(attachment.id, attachment.content_type, attachment.original_filename)
-        return _id_to_hash_lut[attachmentid]
+    def _remember_attachment_name(self, attachmentid: AttachmentID, content_type: str, original_filename: Optional[str]) -> str:
+        name = self._get_hashed_attachment_name(attachmentid, content_type, original_filename)
+        _attachment_names.put(attachmentid, name)
+        return name
+
+    def _get_attachment_names(self, attachmentids: Iterable[AttachmentID]) -> Dict[AttachmentID, str]:
+        names: Dict[AttachmentID, str] = {}
+        missing: Set[AttachmentID] = set()
+        for attachmentid in attachmentids:
+            if attachmentid in names or attachmentid in missing:
+                continue
+
+            name = _attachment_names.get(attachmentid)
+            if name is not None:
+                names[attachmentid] = name
+            elif attachmentid in {DefaultAvatarID, DefaultRoomID, FaviconID}:
+                names[attachmentid] = self._remember_attachment_name(attachmentid, 'application/octet-stream', None)
+            else:
+                missing.add(attachmentid)
+
+        if missing:
+            # Anything we haven't used recently gets looked up all in one go.
+            attachments = self.__data.attachment.lookup_attachments(missing)
+            for attachmentid in missing:
+                attachment = attachments.get(attachmentid)
+                if attachment:
+                    names[attachmentid] = self._remember_attachment_name(attachment.id, attachment.content_type, attachment.original_filename)
+                else:
+                    # We can't find the attachment, so assume that it has no extension and try that.
+                    # Don't remember this guess, since the attachment may just not be committed yet
+                    # and the real name would then be stuck behind the wrong one until evicted.
+                    names[attachmentid] = self._get_hashed_attachment_name(attachmentid, 'application/octet-stream', None)
+
+        return names
+
+    def get_attachment_urls(self, attachmentids: Iterable[AttachmentID]) -> Dict[AttachmentID, str]:
+        prefix = self.__config.attachments.url_prefix
+        return {aid: f"{prefix}{name}" for aid, name in self._get_attachment_names(attachmentids).items()}
 
     def get_attachment_url(self, attachmentid: AttachmentID) -> str:
-        prefix = self.__config.attachments.prefix
-        while prefix and (prefix[-1] == "/"):
-            prefix = prefix[:-1]
-
-        possibly_relative = f"{prefix}/{self._get_attachment_name(attachmentid)}"
-        if possibly_relative.startswith("http://") or possibly_relative.startswith("https://"):
-            return possibly_relative
-
-        while possibly_relative[0] == "/":
-            possibly_relative = possibly_relative[1:]
+        return self.get_attachment_urls([attachmentid])[attachmentid]
 
-        base = self.__config.base_url
-        while base[-1] == "/":
-            base = base[:-1]
+    def _get_url_for_name(self, name: str) -> str:
+        return f"{self.__config.attachments.url_prefix}{name}"
 
-        return f"{base}/{possibly_relative}"
+    @staticmethod
+    def url_cache_stats() -> Dict[str, int]:
+        return _attachment_names.stats()
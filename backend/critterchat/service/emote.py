@@ -1,4 +1,5 @@
-from typing import Dict, cast
+from threading import Lock
+from typing import Dict, Iterable, Optional, Tuple, cast
 
 from ..config import Config
 from ..data import Data, Emote, MetadataType
@@ -9,24 +10,61 @@ class EmoteServiceException(Exception):
     pass
 
 
+# The full set of emotes only changes when somebody adds or removes one, so hang onto it along
+# with the version it was loaded at and only load it again once the version moves.
+_emote_lock: Lock = Lock()
+_emote_cache: Optional[Tuple[int, Dict[str, Emote]]] = None
+
+
 class EmoteService:
     def __init__(self, config: Config, data: Data) -> None:
         self.__config = config
         self.__data = data
         self.__attachments = AttachmentService(self.__config, self.__data)
 
-    def get_all_emotes(self) -> Dict[str, Emote]:
-        emotes = self.__data.attachment.get_emotes()
+    def __load_emotes(self, aliases: Optional[Iterable[str]] = None) -> Dict[str, Emote]:
+        emotes = self.__data.attachment.get_emotes(aliases)
+        urls = self.__attachments.get_attachment_urls(e.attachmentid for e in emotes)
         results: Dict[str, Emote] = {}
 
         for emote in emotes:
-            url = self.__attachments.get_attachment_url(emote.attachmentid)
             results[emote.alias] = Emote(
-                url,
+                urls[emote.attachmentid],
                 (cast(int, emote.metadata[MetadataType.WIDTH]), cast(int, emote.metadata[MetadataType.HEIGHT])),
             )
         return results
 
+    def get_emote_version(self) -> int:
+        return self.__data.attachment.get_emote_version()
+
+    def get_all_emotes(self, version: Optional[int] = None) -> Dict[str, Emote]:
+        global _emote_cache
+
+        if version is None:
+            version = self.get_emote_version()
+
+        with _emote_lock:
+            cached = _emote_cache
+        if cached is not None and cached[0] == version:
+            return dict(cached[1])
+
+        # Note that we looked up the version before loading, so if somebody changes an emote in
+        # between we will just load it again next time, rather than caching something stale.
+        results = self.__load_emotes()
+        with _emote_lock:
+            _emote_cache = (version, results)
+        return dict(results)
+
+    def get_emote_changes(self, version: int) -> Tuple[int, Dict[str, Optional[Emote]]]:
+        newversion, aliases = self.__data.attachment.get_emote_changes(version)
+        if not aliases:
+            return newversion, {}
+
+        # Anything that changed and still exists was added, anything that is gone was removed.
+        found = self.__load_emotes(aliases)
+        changes: Dict[str, Optional[Emote]] = {alias: found.get(alias) for alias in aliases}
+        return newversion, changes
+
     def validate_emote(self, alias: str) -> bool:
         # First, sanitize the name of the emote.
         alias = alias.lower()
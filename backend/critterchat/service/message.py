@@ -1,5 +1,5 @@
 import emoji
-from typing import Dict, Final, List, Optional, Set
+from typing import Dict, Final, Iterator, List, Optional, Set, Tuple
 
 from ..config import Config
 from ..common import Time
@@ -13,7 +13,6 @@ from ..data import (
     RoomPurpose,
     RoomSearchResult,
     User,
-    UserPermission,
     DefaultAvatarID,
     DefaultRoomID,
     FaviconID,
@@ -36,6 +35,7 @@ class MessageServiceException(Exception):
 
 class MessageService:
     MAX_HISTORY: Final[int] = 100
+    MAX_SEARCH_RESULTS: Final[int] = 50
 
     def __init__(self, config: Config, data: Data) -> None:
         self.__config = config
@@ -63,10 +63,10 @@ class MessageService:
             attachments: List[Attachment] = []
             for actionattachment in actionattachments:
                 attachments.append(
-                    Attachment(
+                    self.__attachments.resolve_attachment(
                         actionattachment.attachmentid,
-                        self.__attachments.get_attachment_url(actionattachment.attachmentid),
                         actionattachment.content_type,
+                        actionattachment.original_filename,
                         actionattachment.metadata,
                     )
                 )
@@ -81,34 +81,91 @@ class MessageService:
         history = self._resolve_attachments(history)
         return self.__attachments.resolve_action_icon(history[0]) if history else None
 
-    def get_room_history(self, roomid: RoomID, before: Optional[ActionID] = None) -> List[Action]:
+    def _history_limit(self, limit: Optional[int]) -> int:
+        # Clients can ask for smaller pages, but never more than we're willing to send at once.
+        if limit is None:
+            return self.MAX_HISTORY
+        return max(1, min(limit, self.MAX_HISTORY))
+
+    def _resolve_history(self, history: List[Action]) -> List[Action]:
+        history = self._resolve_attachments(history)
+        return self.__attachments.resolve_action_icons(history)
+
+    def get_room_history(
+        self,
+        roomid: RoomID,
+        before: Optional[ActionID] = None,
+        limit: Optional[int] = None,
+    ) -> Tuple[List[Action], bool]:
+        # Returns a page of history, newest first, along with whether there is any older history
+        # to page back through. We over-fetch by one so we can tell without a second query. Note
+        # that joins and leaves are included even for DMs, so that the very first action in every
+        # room is part of its history.
         room = self.__data.room.get_room(roomid)
         if not room:
-            return []
+            return [], False
 
-        history = self.__data.room.get_room_history(room.id, before=before, limit=self.MAX_HISTORY)
-        history = self._resolve_attachments(history)
-        history = [
-            self.__attachments.resolve_action_icon(e)
-            for e in history
-            # We intentionally over-fetch joins/leaves for DMs here, because the "load more history"
-            # component needs to know if there's any more history, and it does that by comparing
-            # its own list of events to the oldest event to see if there's anything more to load. If
-            # we filter out the first events (a join in every case) for DMs, it never knows to stop
-            # showing the load more indicator.
-            if e.action in ActionType.unread_types()
-        ]
-        return history
+        limit = self._history_limit(limit)
+        history = self.__data.room.get_room_history(room.id, before=before, limit=limit + 1, types=ActionType.unread_types())
+        hasmore = len(history) > limit
+        return self._resolve_history(history[:limit]), hasmore
+
+    def get_room_history_around(
+        self,
+        roomid: RoomID,
+        around: ActionID,
+        limit: Optional[int] = None,
+    ) -> Tuple[List[Action], bool, bool]:
+        # Returns a page of history centered on a given action, newest first, for jumping to a
+        # message that isn't loaded. Also returns whether there's older and newer history on either
+        # side of the page, so the client can keep paging in either direction from here.
+        room = self.__data.room.get_room(roomid)
+        if not room:
+            return [], False, False
+
+        limit = self._history_limit(limit)
+        newercount = (limit - 1) // 2
+        oldercount = limit - newercount
+
+        # The older half includes the action itself, while the newer half starts right after it.
+        older = self.__data.room.get_room_history(
+            room.id, before=ActionID(around + 1), limit=oldercount + 1, types=ActionType.unread_types()
+        )
+        hasolder = len(older) > oldercount
+        older = older[:oldercount]
+
+        newer = self.__data.room.get_room_history(
+            room.id, after=around, limit=newercount + 1, types=ActionType.unread_types()
+        )
+        hasnewer = len(newer) > newercount
+        if hasnewer:
+            # History comes back newest first, so the one we over-fetched is at the front.
+            newer = newer[1:]
+
+        return self._resolve_history(newer + older), hasolder, hasnewer
 
     def get_room_updates(self, roomid: RoomID, after: ActionID) -> List[Action]:
-        history = self.__data.room.get_room_history(roomid, after=after)
-        history = self._resolve_attachments(history)
-        history = [
-            self.__attachments.resolve_action_icon(e)
-            for e in history
-            if e.action in ActionType.update_types()
-        ]
-        return history
+        history = self.__data.room.get_room_history(roomid, after=after, types=ActionType.update_types())
+        return self._resolve_history(history)
+
+    def get_room_catchup(self, roomid: RoomID, after: ActionID) -> Iterator[List[Action]]:
+        # Yields everything after a given action in chunks of at most MAX_HISTORY actions, oldest
+        # chunk first and each chunk newest first, so that a client that was gone for a long time
+        # doesn't get an entire day of backlog in one go.
+        while True:
+            history = self.__data.room.get_room_history(
+                roomid, after=after, limit=self.MAX_HISTORY + 1, types=ActionType.update_types()
+            )
+            hasmore = len(history) > self.MAX_HISTORY
+            if hasmore:
+                # History comes back newest first, so the one we over-fetched is at the front.
+                history = history[1:]
+
+            if history:
+                yield self._resolve_history(history)
+                after = history[0].id
+            if not hasmore:
+                return
 
     def add_message(
         self,
@@ -128,15 +185,18 @@ class MessageService:
         if not room:
             raise MessageServiceException("You cannot message a room that does not exist!")
 
-        # Now, make sure the user adding to the room is here and not muted.
-        occupants = self.__data.room.get_room_occupants(room.id, room.purpose == RoomPurpose.DIRECT_MESSAGE)
-        for occupant in occupants:
-            if occupant.userid == userid:
-                if occupant.muted:
-                    raise MessageServiceException("You are muted!")
-                break
+        # Now, make sure the user adding to the room is here and not muted. Direct messages can still
+        # be sent to after leaving them, since sending one re-opens it for everyone.
+        if room.purpose == RoomPurpose.DIRECT_MESSAGE:
+            members = [o for o in self.__data.room.get_room_occupants(room.id, include_left=True) if o.userid == userid]
+            member = members[0] if members else None
         else:
+            member = self.__data.room.get_membership(room.id, userid)
+
+        if member is None:
             raise MessageServiceException("You cannot message a room that you are not a member of!")
+        if member.muted:
+            raise MessageServiceException("You are muted!")
 
         # Now that we've passed checks, ensure that DMs re-open when messaging the other user again.
         self.rejoin_direct_message(roomid)
@@ -172,10 +232,10 @@ class MessageService:
 
             attachmentids.append(adata.id)
             response_attachments.append(
-                Attachment(
+                self.__attachments.resolve_attachment(
                     adata.id,
-                    self.__attachments.get_attachment_url(adata.id),
                     adata.content_type,
+                    adata.original_filename,
                     adata.metadata,
                 )
             )
@@ -183,14 +243,15 @@ class MessageService:
         if len(attachmentids) != len(response_attachments):
             raise Exception("Logic error, mismatched message attachment structures!")
 
-        # Locking a bunch of tables is expensive, so only do it when we really need to be atomic.
+        # Insert the action and link its attachments in one transaction, so that nobody can see
+        # the action until its attachments are there too. We rely on this rather than locking
+        # tables, since MySQL releases table locks as soon as a transaction starts and inserting
+        # an action always needs one to keep the room's badge sequence in order.
         if attachmentids:
-            with self.__data.room.lock_actions():
+            with self.__data.room.transaction():
                 self.__data.room.insert_action(roomid, action)
-
-                with self.__data.attachment.lock_action_attachments():
-                    for attachmentid in attachmentids:
-                        self.__data.attachment.link_action_attachment(action.id, attachmentid)
+                for attachmentid in attachmentids:
+                    self.__data.attachment.link_action_attachment(action.id, attachmentid)
         else:
             self.__data.room.insert_action(roomid, action)
 
@@ -330,16 +391,45 @@ class MessageService:
 
         self.__data.room.unmute_room_occupant(room.id, user.id)
 
-    def __infer_room_info(self, userid: UserID, room: Room) -> None:
+    def __infer_rooms_info(
+        self,
+        userid: UserID,
+        rooms: List[Room],
+        occupantcache: Optional[Dict[RoomID, List[Occupant]]] = None,
+    ) -> None:
+        # Look up the occupants of every room we haven't already seen in two queries total, one
+        # for direct messages which include occupants that have left and one for everything else.
+        if occupantcache is None:
+            occupantcache = {}
+
+        missing = [r for r in rooms if r.id not in occupantcache]
+        occupantcache.update(self.__data.room.get_room_occupants_many(
+            [r.id for r in missing if r.purpose == RoomPurpose.DIRECT_MESSAGE],
+            include_left=True,
+        ))
+        occupantcache.update(self.__data.room.get_room_occupants_many(
+            [r.id for r in missing if r.purpose != RoomPurpose.DIRECT_MESSAGE],
+        ))
+
+        # Similarly, look up every icon we're about to need at once rather than one at a time.
+        iconids = {r.iconid for r in rooms if r.iconid is not None}
+        for room in rooms:
+            iconids.update(o.iconid for o in occupantcache.get(room.id, []) if o.iconid is not None)
+        self.__attachments.get_attachment_urls(iconids)
+
+        for room in rooms:
+            self.__infer_room_info(userid, room, occupantcache.get(room.id, []))
+
+    def __infer_room_info(self, userid: UserID, room: Room, occupants: Optional[List[Occupant]] = None) -> None:
+        if occupants is None:
+            occupants = self.__data.room.get_room_occupants(room.id, include_left=room.purpose == RoomPurpose.DIRECT_MESSAGE)
+
         if room.purpose == RoomPurpose.ROOM:
             room_name = "Unnamed Public Chat"
-            occupants = self.__data.room.get_room_occupants(room.id)
         elif room.purpose == RoomPurpose.CHAT:
             room_name = "Unnamed Private Chat"
-            occupants = self.__data.room.get_room_occupants(room.id)
         else:
             # Figure out how many people are in the direct message, name it after them.
-            occupants = self.__data.room.get_room_occupants(room.id, include_left=True)
             if not occupants:
                 # This shouldn't happen, since we would have to be the sole occupant,
                 # but I guess there could be a race between grabbing the rooms and occupants,
@@ -389,12 +479,7 @@ class MessageService:
 
         if autojoin:
             self.__data.room.set_room_autojoin(room.id, True)
-
-            for user in self.__data.user.get_users():
-                if UserPermission.ACTIVATED not in user.permissions:
-                    continue
-
-                self.__data.room.join_room(room.id, user.id)
+            self.__data.room.join_activated_users(room.id)
         else:
             self.__data.room.set_room_autojoin(room.id, False)
 
@@ -580,53 +665,65 @@ class MessageService:
         if changed:
             self.__data.room.update_room(room, userid)
 
-    def get_joined_rooms(self, userid: UserID) -> List[Room]:
+    def get_joined_rooms(self, userid: UserID, occupantcache: Optional[Dict[RoomID, List[Occupant]]] = None) -> List[Room]:
         rooms = self.__data.room.get_joined_rooms(userid)
 
-        # Figure out any rooms that don't have a set name, and infer the name of the room.
-        for room in rooms:
-            self.__infer_room_info(userid, room)
+        # Figure out any rooms that don't have a set name, and infer the name of the room. Callers
+        # looking up rooms for many users at once can share occupants between them with the cache.
+        self.__infer_rooms_info(userid, rooms, occupantcache)
 
         return sorted(rooms, key=lambda r: r.last_action_timestamp, reverse=True)
 
+    def is_room_member(self, roomid: RoomID, userid: UserID) -> bool:
+        return self.__data.room.is_room_member(roomid, userid)
+
+    def get_membership(self, roomid: RoomID, userid: UserID) -> Optional[Occupant]:
+        occupant = self.__data.room.get_membership(roomid, userid)
+        if occupant:
+            self.__attachments.resolve_occupant_icon(occupant)
+        return occupant
+
     def get_room_occupants(self, roomid: RoomID) -> List[Occupant]:
         room = self.__data.room.get_room(roomid)
         if not room:
             return []
 
-        occupants = [
-            self.__attachments.resolve_occupant_icon(o)
-            for o in self.__data.room.get_room_occupants(roomid, include_left=room.purpose == RoomPurpose.DIRECT_MESSAGE)
-        ]
+        occupants = self.__attachments.resolve_occupant_icons(
+            self.__data.room.get_room_occupants(roomid, include_left=room.purpose == RoomPurpose.DIRECT_MESSAGE)
+        )
         return sorted(occupants, key=lambda o: o.nickname)
 
     def get_autojoin_rooms(self, userid: UserID) -> List[Room]:
         rooms = self.__data.room.get_autojoin_rooms()
 
         # Figure out any rooms that don't have a set name, and infer the name of the room.
-        for room in rooms:
-            self.__infer_room_info(userid, room)
+        self.__infer_rooms_info(userid, rooms)
 
         return sorted(rooms, key=lambda r: r.name)
 
     def join_autojoin_rooms(self, userid: UserID) -> None:
-        rooms = self.__data.room.get_autojoin_rooms()
-        for room in rooms:
-            self.__data.room.join_room(room.id, userid)
+        self.__data.room.join_autojoin_rooms(userid)
 
     def get_public_rooms(self, userid: UserID) -> List[Room]:
         rooms = self.__data.room.get_public_rooms()
-        for room in rooms:
-            self.__infer_room_info(userid, room)
+        self.__infer_rooms_info(userid, rooms)
         return rooms
 
     def get_matching_rooms(self, userid: UserID, *, name: Optional[str] = None) -> List[RoomSearchResult]:
-        # First get the list of rooms that we can see based on our user ID (joined rooms).
+        name = name or ""
+        lowername = name.lower()
+
+        # Rank anything that starts with the search above anything that merely contains it.
+        def rank(text: str) -> Tuple[bool, str]:
+            return (not text.lower().startswith(lowername), text.lower())
+
+        # First get the list of rooms that we can see based on our user ID (joined rooms). This
+        # includes rooms without names, since we can only match those after inferring a name.
         inrooms = self.__data.room.get_matching_rooms(userid, name=name)
         memberof = {r.id for r in inrooms}
 
-        # Now look up all the rooms we COULD join based on our permissions.
-        potentialrooms = self.__data.room.get_visible_rooms(userid, name=name)
+        # Now look up the rooms we COULD join based on our permissions, using the search index.
+        potentialrooms = self.__data.room.search_visible_rooms(userid, name, self.MAX_SEARCH_RESULTS)
 
         # Merge them down to one, prioritizing joined over potential.
         rooms_by_id = {r.id: r for r in potentialrooms}
@@ -635,14 +732,12 @@ class MessageService:
         rooms = [val for _, val in rooms_by_id.items()]
 
         # Figure out any rooms that don't have a set name, and infer the name of the room.
-        for room in rooms:
-            self.__infer_room_info(userid, room)
+        self.__infer_rooms_info(userid, rooms)
 
         # Now, filter out any rooms that still don't meet our criteria.
         if name:
-            lowername = name.lower()
             rooms = [r for r in rooms if lowername in r.name.lower()]
-        rooms = sorted(rooms, key=lambda r: r.name)
+        rooms = sorted(rooms, key=lambda r: rank(r.name))
 
         # Now, figure out all of the private conversations that we shouldn't duplicate users for.
         ignored: Set[UserID] = set()
@@ -657,14 +752,15 @@ class MessageService:
 
         # Now, look up all users we could chat with, given our criteria.
         potentialusers = sorted(
-            self.__data.user.get_visible_users(userid, name=name),
-            key=lambda u: u.nickname,
+            self.__data.user.search_visible_users(userid, name, self.MAX_SEARCH_RESULTS),
+            key=lambda u: min(rank(u.nickname), rank(u.username)),
         )
 
         # Now, filter out any users that we've already got a chat with.
         potentialusers = [u for u in potentialusers if u.id not in ignored]
 
         # Now, resolve the icons of anyone left.
+        self.__attachments.get_attachment_urls({u.iconid for u in potentialusers if u.iconid is not None})
         for user in potentialusers:
             self.__attachments.resolve_user_icon(user)
 
@@ -693,4 +789,4 @@ class MessageService:
                 raise Exception("Logic error, should have been inferred above!")
             results.append(RoomSearchResult(user.nickname, f"@{user.username}", RoomPurpose.DIRECT_MESSAGE, False, None, user.id, icon))
 
-        return results
+        return results[:self.MAX_SEARCH_RESULTS]
@@ -389,7 +389,12 @@ class UserService:
             self.__data.room.insert_action(room.id, action)
 
     def mark_last_seen(self, userid: UserID, roomid: RoomID, actionid: ActionID) -> None:
-        self.__data.user.mark_last_seen(userid, roomid, actionid)
+        # Clients report these as messages scroll into view, so buffer them up and let the
+        # message pump write them out in batches.
+        self.__data.user.buffer_last_seen(userid, roomid, actionid)
+
+    def flush_last_seen(self, userid: Optional[UserID] = None) -> None:
+        self.__data.user.flush_last_seen(userid)
 
     def get_last_seen_counts(self, userid: UserID) -> Dict[RoomID, int]:
         lastseen = self.__data.user.get_last_seen_counts(userid)
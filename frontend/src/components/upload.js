@@ -2,7 +2,7 @@ import $ from "jquery";
 import { flash } from "../utils.js";
 
 /**
- * Handles taking base64-encoded URL data and uploading it to the backend, getting in
+ * Handles taking base64-encoded URL data or files and uploading it to the backend, getting in
  * return an attachment ID that can be used to refer to an attachment of some type.
  * Used for uploading room icons, avatars, message attachments and notification sounds.
  */
@@ -58,12 +58,21 @@ class Uploader {
     }
 
     uploadAttachments(data, callback) {
+        // Send the original files as a multipart upload so the server can stream them to disk,
+        // instead of sending the much larger base64 data URLs we keep around for previews.
+        const form = new FormData();
+        data.forEach((attachment) => {
+            form.append('attachments', attachment.file, attachment.filename);
+            form.append('alt_text', attachment.alt_text);
+            form.append('sensitive', attachment.sensitive ? 'true' : 'false');
+        });
+
         $.ajax(
             window.uploadAttachments,
             {
                 method: "POST",
-                contentType: "application/json",
-                data: JSON.stringify({attachments: data}),
+                contentType: false,
+                data: form,
                 processData: false,
                 error: (xhr) => {
                     const resp = JSON.parse(xhr.responseText);
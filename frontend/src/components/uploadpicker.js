@@ -125,6 +125,7 @@ class UploadPicker {
                     var fr = new FileReader();
                     fr.onload = () => {
                         room.files.push({
+                            file: file,
                             filename: file.name,
                             data: fr.result,
                             alt_text: '',
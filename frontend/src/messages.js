@@ -952,6 +952,26 @@ class Messages {
         return ' width="' + width + '" height="' + height + '" ';
     }
 
+    /**
+     * Pick the smallest preview variant of an attachment that will still look sharp when drawn
+     * at the desired height, falling back to the original if none of them are large enough.
+     */
+    _getPreviewUri( attachment, desiredHeight ) {
+        const neededHeight = desiredHeight * (window.devicePixelRatio || 1);
+        var best = undefined;
+
+        (attachment.variants || []).forEach((variant) => {
+            if (variant.height < neededHeight && variant.height < attachment.metadata.height) {
+                return;
+            }
+            if (best === undefined || variant.height < best.height) {
+                best = variant;
+            }
+        });
+
+        return best ? best.uri : attachment.uri;
+    }
+
     /**
      * The actual function that handles DOM manipulation for rendering a new or updated action.
      * Note that right now while the server CAN send us old actions that have been edited in some
@@ -999,7 +1019,7 @@ class Messages {
                     html += '    <div class="attachments">';
                     message.attachments.forEach((attachment) => {
                         var attachImg = $(
-                            '<img src="' + attachment.uri + '"' + this._getDims(attachment, desiredHeight) + '/>'
+                            '<img src="' + this._getPreviewUri(attachment, desiredHeight) + '"' + this._getDims(attachment, desiredHeight) + '/>'
                         ).attr('alt', attachment.metadata.alt_text || "message attachment");
 
                         if (attachment.metadata.sensitive) {